@@ -25,6 +25,14 @@ class TriggerSettings(object):
     def __str__(self):
         return ("TriggerSettings(%s, %s, %s, %s)" % (self.trigtype, self.fstart, self.fstop, self.amplitude))
 
+    def __eq__(self, other):
+        return (isinstance(other, TriggerSettings)
+            and (self.trigtype, self.fstart, self.fstop, self.amplitude)
+            == (other.trigtype, other.fstart, other.fstop, other.amplitude))
+
+    def __ne__(self, other):
+        return not self == other
+
 
 class SweepEntry(object):
     """
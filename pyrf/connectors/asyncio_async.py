@@ -0,0 +1,202 @@
+try:
+    import asyncio
+except ImportError:
+    # to allow docstrings to be visible even when asyncio
+    # (Python 3.4+) is not available
+    asyncio = None
+
+import socket
+from collections import deque
+
+from pyrf.connectors.base import sync_async, SCPI_PORT, VRT_PORT
+
+import logging
+logger = logging.getLogger(__name__)
+
+class AsyncioConnector(object):
+    """
+    A connector that makes SCPI/VRT connections asynchronously using
+    asyncio streams.
+
+    :param loop: the event loop to use, defaults to the current event
+        loop when :meth:`connect` is called
+
+    Every method of the device decorated with ``@sync_async`` returns an
+    asyncio Future, so it may be awaited from a coroutine:
+
+    .. code-block:: python
+
+       dut = WSA4000(connector=AsyncioConnector())
+       await dut.connect(host)
+       await dut.freq(2450e6)
+       pkt = await dut.read()
+
+    SCPI queries may be sent before earlier responses arrive, responses
+    are matched to queries in the order they were sent.
+    """
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._eof = False
+
+    def connect(self, host):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        scpi = asyncio.ensure_future(
+            asyncio.open_connection(host, SCPI_PORT), loop=self._loop)
+        vrt = asyncio.ensure_future(
+            asyncio.open_connection(host, VRT_PORT), loop=self._loop)
+        both = asyncio.gather(scpi, vrt)
+        result = self._loop.create_future()
+
+        def connected(f):
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+                return
+            (scpi_streams, vrt_streams) = f.result()
+            self._connected(scpi_streams, vrt_streams)
+            result.set_result(None)
+        both.add_done_callback(connected)
+        return result
+
+    def _connected(self, scpi_streams, vrt_streams):
+        self._scpi_reader, self._scpi_writer = scpi_streams
+        self._vrt_reader, self._vrt_writer = vrt_streams
+        self._pending_responses = deque()
+        self._reading_responses = False
+        self._last_vrt_read = None
+        self._eof = False
+
+    def disconnect(self):
+        self._scpi_writer.close()
+        self._vrt_writer.close()
+
+    def scpiset(self, cmd):
+        cmd = "%s\n" % cmd
+        logger.debug('scpiset %r', cmd)
+        self._scpi_writer.write(cmd.encode('ascii'))
+
+    def scpiget(self, cmd):
+        cmd = "%s\n" % cmd
+        logger.debug('scpiget %r', cmd)
+        self._scpi_writer.write(cmd.encode('ascii'))
+        response = self._loop.create_future()
+        self._pending_responses.append(response)
+        if not self._reading_responses:
+            self._reading_responses = True
+            self._read_response()
+        return response
+
+    def scpiget_many(self, cmds):
+        """
+        Send several SCPI queries without waiting for each response.
+
+        :returns: a Future that completes with a list of the responses
+        """
+        return asyncio.gather(*[self.scpiget(cmd) for cmd in cmds])
+
+    def _read_response(self):
+        line = asyncio.ensure_future(self._scpi_reader.readline(),
+            loop=self._loop)
+        line.add_done_callback(self._response_received)
+
+    def _response_received(self, line):
+        response = self._pending_responses.popleft()
+        error = line.exception()
+        if error is None and not line.result().endswith(b'\n'):
+            # a partial line or nothing at all means the device closed
+            # the connection before answering
+            error = socket.error("SCPI connection closed")
+        # the caller may have cancelled or timed out the query
+        if response.done():
+            pass
+        elif error is not None:
+            response.set_exception(error)
+        else:
+            data = line.result().decode('ascii').rstrip('\r\n')
+            logger.debug('scpigot %r', data)
+            response.set_result(data)
+
+        if self._pending_responses:
+            self._read_response()
+        else:
+            self._reading_responses = False
+
+    def sync_async(self, gen):
+        """
+        Handler for the @sync_async decorator.  Each value yielded by the
+        generator that is a Future or coroutine is waited on and its
+        result sent back in to the generator.
+
+        :returns: a Future that completes with the last value yielded
+        """
+        result = self._loop.create_future()
+
+        def advance(value, exc=None):
+            while True:
+                try:
+                    if exc is not None:
+                        step = gen.throw(exc)
+                    else:
+                        step = gen.send(value)
+                except StopIteration:
+                    result.set_result(value)
+                    return
+                except Exception as e:
+                    result.set_exception(e)
+                    return
+                exc = None
+
+                if asyncio.isfuture(step) or asyncio.iscoroutine(step):
+                    step = asyncio.ensure_future(step, loop=self._loop)
+                    step.add_done_callback(resume)
+                    return
+                value = step
+
+        def resume(f):
+            if f.cancelled():
+                advance(None, asyncio.CancelledError())
+            elif f.exception() is not None:
+                advance(None, f.exception())
+            else:
+                advance(f.result())
+
+        advance(None)
+        return result
+
+    def eof(self):
+        return self._eof
+
+    def raw_read(self, num_bytes):
+        """
+        Read VRT data.
+
+        :param num_bytes: the number of bytes to read
+        :returns: a Future that completes with *num_bytes* bytes, or
+            False if the connection was closed
+        """
+        result = self._loop.create_future()
+        previous = self._last_vrt_read
+        self._last_vrt_read = result
+
+        def start(_=None):
+            read = asyncio.ensure_future(
+                self._vrt_reader.readexactly(num_bytes), loop=self._loop)
+            read.add_done_callback(finished)
+
+        def finished(read):
+            if read.cancelled():
+                result.cancel()
+            elif isinstance(read.exception(), asyncio.IncompleteReadError):
+                self._eof = True
+                result.set_result(False)
+            elif read.exception() is not None:
+                result.set_exception(read.exception())
+            else:
+                result.set_result(read.result())
+
+        # StreamReader allows only one read at a time
+        if previous is None or previous.done():
+            start()
+        else:
+            previous.add_done_callback(start)
+        return result
@@ -1,6 +1,15 @@
 import socket
+import select
+import struct
+import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from pyrf.connectors.base import sync_async, SCPI_PORT, VRT_PORT
+from pyrf.vrt import parse_packet, ConnectionGap
 
 import logging
 logger = logging.getLogger(__name__)
@@ -8,56 +17,601 @@ logger = logging.getLogger(__name__)
 class PlainSocketConnector(object):
     """
     This connector makes SCPI/VRT socket connections using plain sockets.
+
+    :param reconnect: True to reconnect automatically when the
+        connection to the device is lost, see :meth:`read_packet`
+    :param max_backoff: the longest time in seconds to wait between
+        reconnection attempts
+    :param max_attempts: the number of reconnection attempts to make
+        before giving up, None to keep trying
+    :param metrics: a :class:`Metrics <pyrf.metrics.Metrics>` instance
+        to record bytes and packets received, parse time, SCPI query
+        latency and reconnections, None to record nothing
     """
 
+    VRT_BUFFER_SIZE = 2 ** 21
+    MIN_BACKOFF = 0.5
+
+    def __init__(self, reconnect=False, max_backoff=30.0, max_attempts=None,
+            metrics=None):
+        self.reconnect = reconnect
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.metrics = metrics
+        self.reconnect_handler = None
+        self._reconnecting = False
+        self._batching = 0
+
     def connect(self, host):
-        self._sock_scpi = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock_scpi.connect((host, SCPI_PORT))
-        self._sock_scpi.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
-        self._sock_vrt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock_vrt.connect((host, VRT_PORT))
+        self._host = host
+        self._sock_scpi = self._sock_vrt = None
+        sock_scpi = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock_vrt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock_scpi.connect((host, SCPI_PORT))
+            sock_scpi.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            sock_vrt.connect((host, VRT_PORT))
+        except socket.error:
+            sock_scpi.close()
+            sock_vrt.close()
+            raise
+        self._connected(sock_scpi, sock_vrt)
+
+    def _connected(self, sock_scpi, sock_vrt):
+        self._sock_scpi = sock_scpi
+        self._sock_vrt = sock_vrt
+        self._vrt = SocketReadBuffer(self._sock_vrt, self.VRT_BUFFER_SIZE)
+        self._scpi_unsent = []
+        self._scpi_received = b''
 
     def disconnect(self):
+        self._scpi_flush()
         self._sock_scpi.shutdown(socket.SHUT_RDWR)
         self._sock_scpi.close()
         self._sock_vrt.shutdown(socket.SHUT_RDWR)
         self._sock_vrt.close()
 
+    def _close(self):
+        for sock in (self._sock_scpi, self._sock_vrt):
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def _reconnect(self):
+        """
+        Reconnect with exponential backoff then call reconnect_handler
+        to restore the device state.
+
+        :returns: a :class:`ConnectionGap <pyrf.vrt.ConnectionGap>`
+        """
+        lost = time.time()
+        delay = self.MIN_BACKOFF
+        attempts = 0
+        if self.metrics is not None:
+            self.metrics.count('reconnects')
+        self._close()
+        self._reconnecting = True
+        try:
+            while True:
+                attempts += 1
+                try:
+                    self.connect(self._host)
+                    if self.reconnect_handler:
+                        self._restore()
+                    break
+                except socket.error as e:
+                    logger.warning('reconnecting to %s failed: %s',
+                        self._host, e)
+                    if self._sock_scpi:
+                        self._close()
+                    if attempts == self.max_attempts:
+                        raise
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+        finally:
+            self._reconnecting = False
+        return ConnectionGap(time.time() - lost, attempts)
+
+    def _restore(self):
+        """
+        Call reconnect_handler and send the commands it sets right away,
+        even inside an outer batch, so they reach the device before the
+        batch that was interrupted is sent again.
+        """
+        batching, self._batching = self._batching, 0
+        try:
+            self.reconnect_handler()
+            self._scpi_flush()
+        finally:
+            self._batching = batching
+
+    def _connection_failed(self):
+        "True if the caller should reconnect after a socket error"
+        return self.reconnect and not self._reconnecting
+
     def scpiset(self, cmd):
         cmd = "%s\n" % cmd
         logger.debug('scpiset %r', cmd)
-        self._sock_scpi.send(cmd)
+        if self.metrics is not None:
+            self.metrics.count('scpi_commands')
+        self._scpi_unsent.append(cmd)
+        if not self._batching:
+            self._scpi_flush()
+
+    def _scpi_flush(self):
+        if self._scpi_unsent:
+            data = ''.join(self._scpi_unsent)
+            self._scpi_unsent = []
+            try:
+                self._sock_scpi.sendall(data)
+            except socket.error:
+                if not self._connection_failed():
+                    raise
+                self._reconnect()
+                # reconnect_handler restores the settings but not commands
+                # such as captures, so send everything again
+                self._sock_scpi.sendall(data)
 
     def scpiget(self, cmd):
-        cmd = "%s\n" % cmd
-        logger.debug('scpiset %r', cmd)
-        self._sock_scpi.send(cmd)
-        buf = self._sock_scpi.recv(1024)
-        logger.debug('scpigot %r', buf)
-        return buf
+        return self.scpiget_many([cmd])[0]
+
+    def scpiget_many(self, cmds):
+        """
+        Send several SCPI queries in a single write then read all the
+        responses, so they cost a single network round trip.
+
+        :returns: a list of the responses
+        """
+        for cmd in cmds:
+            cmd = "%s\n" % cmd
+            logger.debug('scpiget %r', cmd)
+            self._scpi_unsent.append(cmd)
+        metrics = self.metrics
+        try:
+            if metrics is None:
+                self._scpi_flush()
+                return [self._scpi_readline() for cmd in cmds]
+            start = time.time()
+            self._scpi_flush()
+            responses = [self._scpi_readline() for cmd in cmds]
+            metrics.observe('scpi_query_latency', time.time() - start)
+            metrics.count('scpi_queries', len(cmds))
+            return responses
+        except socket.error:
+            if not self._connection_failed():
+                raise
+            self._reconnect()
+            # the queries were lost with the connection, send them again
+            return self.scpiget_many(cmds)
+
+    def _scpi_readline(self):
+        searched = 0
+        while True:
+            end = self._scpi_received.find(b'\n', searched)
+            if end >= 0:
+                break
+            searched = len(self._scpi_received)
+            data = self._sock_scpi.recv(4096)
+            if not data:
+                raise socket.error("SCPI connection closed")
+            self._scpi_received += data
+        line = self._scpi_received[:end].rstrip(b'\r')
+        self._scpi_received = self._scpi_received[end + 1:]
+        logger.debug('scpigot %r', line)
+        return line
 
     def eof(self):
-        # FIXME: lies
-        return False
+        # FIXME: only true once a read has found the connection closed
+        return self._vrt.eof
 
     def has_data(self):
-        # FIXME: broken
         return self._vrt.has_data()
 
+    def vrt_socket(self):
+        """
+        :returns: the connected VRT socket, for readers such as
+            :class:`pyrf.recording.VRTRecorder` that bypass
+            :meth:`raw_read`.  Data already buffered by :meth:`raw_read`
+            is not available from the socket.
+        """
+        return self._sock_vrt
+
     def raw_read(self, num):
-        return socketread(self._sock_vrt, num)
+        """
+        Read VRT data.
+
+        :param num: the number of bytes to read
+        :returns: a memoryview of *num* bytes, or False if the
+            connection was closed.  Earlier versions returned a str, use
+            ``tobytes()`` for one.
+        """
+        self._scpi_flush()
+        data = self._vrt.read(num)
+        if data and self.metrics is not None:
+            self.metrics.count('bytes_received', num)
+        return data
+
+    def read_packet(self):
+        """
+        Read a single VRT packet with one read for the header word and
+        one for the rest of the packet.
+
+        :returns: a :class:`DataPacket <pyrf.vrt.DataPacket>` or
+            :class:`ContextPacket <pyrf.vrt.ContextPacket>`, or False if
+            the connection was closed.  When reconnecting is enabled a
+            lost connection is re-established instead and a
+            :class:`ConnectionGap <pyrf.vrt.ConnectionGap>` returned.
+        """
+        self._scpi_flush()
+        try:
+            data = self._read_packet_data()
+            if data:
+                return self._parse(data)
+        except socket.error:
+            if not self._connection_failed():
+                raise
+        if self._connection_failed():
+            return self._reconnect()
+        return False
+
+    def _read_packet_data(self):
+        "returns the bytes of one packet or False if the connection closed"
+        header = self._vrt.peek(4)
+        if not header:
+            return False
+        (word,) = struct.unpack_from(">I", header)
+        size = (word & 0xffff) * 4
+        data = self._vrt.read(size)
+        if data and self.metrics is not None:
+            self.metrics.count('bytes_received', size)
+            self.metrics.count('packets_received')
+        return data
+
+    def _parse(self, data):
+        metrics = self.metrics
+        if metrics is None:
+            return parse_packet(data)
+        start = time.time()
+        pkt = parse_packet(data)
+        metrics.observe('parse_time', time.time() - start)
+        return pkt
+
+    def background_reader(self, max_packets=1000, policy='block',
+            parse=True):
+        """
+        :returns: a new :class:`BackgroundReader` for this connection
+        """
+        return BackgroundReader(self, max_packets, policy, parse)
 
     def sync_async(self, gen):
         """
         Handler for the @sync_async decorator.  We convert the
         generator to a single return value for simple synchronous use.
+
+        SCPI commands set by the generator are held and sent together
+        with the next query, read or when the generator completes.
         """
         val = None
+        self._batching += 1
         try:
             while True:
                 val = gen.send(val)
         except StopIteration:
             return val
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self._scpi_flush()
+
+
+class BackgroundReader(object):
+    """
+    Read VRT packets on a separate thread into a bounded queue, so the
+    socket is drained while the packets are being processed.
+
+    :param connector: a connected :class:`PlainSocketConnector`
+    :param max_packets: the number of packets the queue may hold
+    :param policy: what to do when the queue is full: ``'block'`` to
+        stop reading until there is room, leaving the device to wait
+        on TCP flow control; ``'drop_oldest'`` to discard the oldest
+        queued packet or ``'drop_newest'`` to discard the packet just
+        read
+    :param parse: True to queue :class:`DataPacket <pyrf.vrt.DataPacket>`
+        and :class:`ContextPacket <pyrf.vrt.ContextPacket>` objects,
+        False to queue the bytes of each packet as a memoryview
+
+    Iterate over the reader to get packets until :meth:`stop` is
+    called or the connection is closed:
+
+    .. code-block:: python
+
+       reader = dut.background_read(max_packets=5000, policy='drop_oldest')
+       dut.capture(1024, 1000)
+       for pkt in reader:
+           ...
+       print reader.stats()
+
+    Don't call :meth:`WSA4000.read() <pyrf.devices.thinkrf.WSA4000.read>`
+    or raw_read() while the reader is running.  SCPI commands may still
+    be sent from the main thread.  Lost connections are not
+    re-established by the reader.
+    """
+    POLICIES = ('block', 'drop_oldest', 'drop_newest')
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, connector, max_packets=1000, policy='block',
+            parse=True):
+        if policy not in self.POLICIES:
+            raise ValueError("policy must be one of %s" % (self.POLICIES,))
+        self._connector = connector
+        self.policy = policy
+        self.parse = parse
+        self.max_packets = max_packets
+        self._queue = queue.Queue(max_packets)
+        self._thread = None
+        self._running = False
+        self._done = True
+        self._error = None
+
+        self.packets_read = 0
+        self.dropped_packets = 0
+        self.high_water = 0
+
+    def start(self):
+        """
+        Start the reader thread.
+        """
+        self._running = True
+        self._done = False
+        self._thread = threading.Thread(target=self._read_loop,
+            name='BackgroundReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the reader thread.  Packets already queued may still be
+        retrieved.
+        """
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :returns: a dict of counters: packets_read, dropped_packets,
+            queued (packets waiting now) and high_water (the most
+            packets that have been waiting at once)
+        """
+        return {
+            'packets_read': self.packets_read,
+            'dropped_packets': self.dropped_packets,
+            'queued': self._queue.qsize(),
+            'high_water': self.high_water,
+            }
+
+    def _read_loop(self):
+        try:
+            self._read_until_stopped()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+
+    def _read_until_stopped(self):
+        vrt = self._connector._vrt
+        sock = self._connector.vrt_socket()
+        while self._running:
+            if not vrt.buffered():
+                readable, _, _ = select.select([sock], [], [],
+                    self.POLL_INTERVAL)
+                if not readable:
+                    continue
+            data = self._connector._read_packet_data()
+            if not data:
+                break
+            self.packets_read += 1
+            self._put(self._connector._parse(data) if self.parse else data)
+
+    def _put(self, item):
+        if self.policy == 'block':
+            while True:
+                try:
+                    self._queue.put(item, timeout=self.POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    if not self._running:
+                        return
+            self._update_high_water()
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped_packets += 1
+            if self._connector.metrics is not None:
+                self._connector.metrics.count('dropped_packets')
+            if self.policy == 'drop_newest':
+                return
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(item)
+        self._update_high_water()
+
+    def _update_high_water(self):
+        queued = self._queue.qsize()
+        if self._connector.metrics is not None:
+            self._connector.metrics.gauge('queue_depth', queued)
+        if queued > self.high_water:
+            self.high_water = queued
+
+    def get(self, timeout=None):
+        """
+        Return the next packet, waiting for one to arrive.
+
+        :param timeout: the longest time in seconds to wait, None to
+            wait until a packet arrives or the reader finishes
+        :returns: the next packet, or None if the reader has finished
+            or *timeout* passed
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            wait = self.POLL_INTERVAL
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.time()))
+            try:
+                return self._queue.get(timeout=wait)
+            except queue.Empty:
+                pass
+            if self._done and self._queue.empty():
+                error, self._error = self._error, None
+                if error is not None:
+                    raise error
+                return None
+            if deadline is not None and time.time() >= deadline:
+                return None
+
+    def __iter__(self):
+        while True:
+            pkt = self.get()
+            if pkt is None:
+                return
+            yield pkt
+
+
+class SocketReadBuffer(object):
+    """
+    Buffered reads from a socket that return memoryview slices of the
+    data received instead of copies.
+
+    :param sock: the socket to read from
+    :param size: the size of each buffer in bytes, must be larger than
+        the largest read requested
+
+    Data is received with ``recv_into`` as far as the end of the
+    current buffer, so many small reads are served from a single system
+    call.  When a read doesn't fit at the end of the buffer the unread
+    bytes are moved to the start of a buffer that no slice returned
+    earlier is still using, so returned slices remain valid for as long
+    as they are referenced.  A new buffer is allocated only when every
+    existing buffer is still in use.
+
+    Each slice kept by the caller keeps its whole buffer in memory, so
+    at most MAX_BUFFERS buffers are shared this way.  When all of them
+    are in use, reads return copies of the data instead of slices until
+    a buffer is released.
+    """
+    MAX_BUFFERS = 4
+
+    def __init__(self, sock, size):
+        self._sock = sock
+        self._size = size
+        self._buffers = [bytearray(size), bytearray(size)]
+        self._buf = self._buffers[0]
+        self._copying = False
+        self._start = 0
+        self._end = 0
+        self.eof = False
+
+    def buffered(self):
+        """
+        :returns: the number of bytes received but not yet read
+        """
+        return self._end - self._start
+
+    def has_data(self):
+        """
+        :returns: True if data is available to read without blocking
+        """
+        if self._end > self._start:
+            return True
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
+
+    def _unused_buffer(self):
+        for buf in self._buffers:
+            if buf is self._buf:
+                continue
+            try:
+                # resizing fails while any memoryview of buf exists
+                buf.append(0)
+            except BufferError:
+                continue
+            del buf[-1]
+            return buf
+        if len(self._buffers) >= self.MAX_BUFFERS:
+            return None
+        buf = bytearray(self._size)
+        self._buffers.append(buf)
+        return buf
+
+    def _compact(self):
+        buf = self._unused_buffer()
+        self._copying = buf is None
+        if buf is None:
+            # no slices of a private buffer are ever returned, so it
+            # can be reused in place
+            if any(b is self._buf for b in self._buffers):
+                buf = bytearray(self._size)
+            else:
+                buf = self._buf
+        unread = self._end - self._start
+        buf[:unread] = self._buf[self._start:self._end]
+        self._buf = buf
+        self._start = 0
+        self._end = unread
+
+    def _fill(self, num):
+        "returns False if the connection closed before num bytes arrived"
+        if self._start + num > self._size:
+            if num > self._size:
+                raise ValueError("read of %d bytes larger than buffer" % num)
+            self._compact()
+
+        while self._end - self._start < num:
+            received = self._sock.recv_into(
+                memoryview(self._buf)[self._end:], self._size - self._end)
+            if not received:
+                self.eof = True
+                return False
+            self._end += received
+        return True
+
+    def peek(self, num):
+        """
+        Wait for *num* bytes like :meth:`read` without consuming them.
+
+        :returns: a memoryview of *num* bytes, or False if the
+            connection was closed
+        """
+        if not self._fill(num):
+            return False
+        view = memoryview(self._buf)[self._start:self._start + num]
+        if self._copying:
+            return memoryview(bytearray(view))
+        return view
+
+    def read(self, num):
+        """
+        Read exactly *num* bytes, blocking until they are available.
+
+        :returns: a memoryview of *num* bytes, or False if the
+            connection was closed
+        """
+        if not self._fill(num):
+            return False
+
+        start = self._start
+        self._start += num
+        view = memoryview(self._buf)[start:start + num]
+        if self._copying:
+            return memoryview(bytearray(view))
+        return view
 
 
 def socketread(socket, count, flags = None):
@@ -67,14 +621,17 @@ def socketread(socket, count, flags = None):
     """
     if not flags:
         flags = 0
-    data = socket.recv(count, flags)
-    datalen = len(data)
+    data = bytearray(count)
+    view = memoryview(data)
+    datalen = socket.recv_into(view, count, flags)
 
     if datalen == 0:
         return False
 
     while datalen < count:
-        data = data + socket.recv(count - datalen)
-        datalen = len(data)
+        received = socket.recv_into(view[datalen:], count - datalen)
+        if not received:
+            return False
+        datalen += received
 
-    return data
+    return bytes(data)
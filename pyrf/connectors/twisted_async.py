@@ -1,5 +1,6 @@
 try:
     from twisted.internet.protocol import Factory, Protocol
+    from twisted.protocols.basic import LineOnlyReceiver
     from twisted.internet import defer
     from twisted.internet.endpoints import TCP4ClientEndpoint
     try: # Twisted >= 13.0 for IPv6 support
@@ -10,14 +11,14 @@ try:
 except ImportError:
     # to allow docstrings to be visible even when twisted
     # imports fail
-    Factory = Protocol = StatefulProtocol = object
+    Factory = Protocol = StatefulProtocol = LineOnlyReceiver = object
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import struct
+import time
+from collections import deque
 
 from pyrf.connectors.base import sync_async, SCPI_PORT, VRT_PORT
+from pyrf.vrt import parse_packet, ConnectionGap
 
 import logging
 logger = logging.getLogger(__name__)
@@ -26,35 +27,172 @@ class TwistedConnector(object):
     """
     A connector that makes SCPI/VRT connections asynchronously using
     Twisted.
+
+    :param reactor: the Twisted reactor to use
+    :param flow_control: optional dict of keyword arguments for
+        :meth:`VRTClient.setFlowControl`, applied to the VRT connection
+        when it is made
+    :param reconnect: True to reconnect automatically when either
+        connection to the device is lost
+    :param max_backoff: the longest time in seconds to wait between
+        reconnection attempts
+    :param metrics: a :class:`Metrics <pyrf.metrics.Metrics>` instance
+        to record bytes and packets received, parse time, SCPI query
+        latency, buffered bytes, dropped packets and reconnections,
+        None to record nothing
+
+    After reconnecting, ``reconnect_handler`` is called to restore the
+    device state and packet reads waiting on the lost connection fire
+    with a :class:`ConnectionGap <pyrf.vrt.ConnectionGap>`, as does the
+    packet consumer.  Byte reads waiting on the lost connection fire
+    with False and SCPI queries fail.  SCPI commands and queries sent
+    while reconnecting are held and sent once the device state has been
+    restored, or the queries fail if the connector is disconnected.
     """
-    def __init__(self, reactor):
-        self._reactor = reactor
+    MIN_BACKOFF = 0.5
 
-    def connect(self, host):
-        point = HostnameEndpoint(self._reactor, host, SCPI_PORT)
-        d = point.connect(SCPIClientFactory())
+    def __init__(self, reactor, flow_control=None, reconnect=False,
+            max_backoff=30.0, metrics=None):
+        self._reactor = reactor
+        self.metrics = metrics
+        self._flow_control = flow_control
+        self.reconnect = reconnect
+        self.max_backoff = max_backoff
+        self.reconnect_handler = None
+        self._disconnecting = False
+        self._reconnecting = False
+        self._scpi = self._vrt = None
+        # commands sent while reconnecting: [(cmd, Deferred or None)]
+        self._scpi_ready = True
+        self._scpi_held = []
+
+    def _open(self, host):
+        "returns a Deferred that fires with (scpi, vrt) clients"
+        scpi = HostnameEndpoint(self._reactor, host, SCPI_PORT
+            ).connect(SCPIClientFactory())
+        vrt = HostnameEndpoint(self._reactor, host, VRT_PORT
+            ).connect(VRTClientFactory())
+        d = defer.gatherResults([scpi, vrt], consumeErrors=True)
+
+        @d.addErrback
+        def connect_failed(failure):
+            failure.trap(defer.FirstError)
+            # close the connection that succeeded, if any
+            for client in (scpi, vrt):
+                client.addCallback(close_client)
+            return failure.value.subFailure
+
+        def close_client(client):
+            if client is not None:
+                client.transport.loseConnection()
 
-        @d.addCallback
-        def connect_vrt(scpi):
-            self._scpi = scpi
-            point = HostnameEndpoint(self._reactor, host, VRT_PORT)
-            return point.connect(VRTClientFactory())
+        return d
 
-        @d.addCallback
-        def save_vrt(vrt):
-            self._vrt = vrt
+    def _save_clients(self, clients):
+        self._scpi, self._vrt = clients
+        self._scpi_ready = True
+        for client in clients:
+            client.lost = self._connection_lost
+            client.metrics = self.metrics
+        if self._flow_control:
+            self._vrt.setFlowControl(**self._flow_control)
 
+    def connect(self, host):
+        """
+        Open the SCPI and VRT connections at the same time.
+
+        :returns: a Deferred that fires once both are connected
+        """
+        self._host = host
+        self._disconnecting = False
+        d = self._open(host)
+        d.addCallback(self._save_clients)
         return d
 
     def disconnect(self):
-        pass # FIXME
+        self._disconnecting = True
+        self._scpi.transport.loseConnection()
+        self._vrt.transport.loseConnection()
+
+    def _connection_lost(self, client):
+        if (self._disconnecting or not self.reconnect or self._reconnecting
+                or client not in (self._scpi, self._vrt)):
+            return
+        logger.warning('connection to %s lost, reconnecting', self._host)
+        self._reconnecting = True
+        self._scpi_ready = False
+        if self.metrics is not None:
+            self.metrics.count('reconnects')
+        self._scpi.transport.loseConnection()
+        self._vrt.transport.loseConnection()
+        self._attempt_reconnect(self._vrt, self._reactor.seconds(), 1,
+            self.MIN_BACKOFF)
+
+    def _attempt_reconnect(self, old_vrt, lost, attempts, delay):
+        d = self._open(self._host)
+
+        opened = []
+
+        @d.addCallback
+        def restore(clients):
+            opened.extend(clients)
+            self._save_clients(clients)
+            if self.reconnect_handler:
+                return self.reconnect_handler()
+
+        @d.addCallback
+        def restored(result):
+            self._reconnecting = False
+            held, self._scpi_held = self._scpi_held, []
+            for cmd, query in held:
+                if query is None:
+                    self._scpi.scpiset(cmd)
+                else:
+                    self._scpi.scpiget(cmd).chainDeferred(query)
+            gap = ConnectionGap(self._reactor.seconds() - lost, attempts)
+            consumer = old_vrt.packetConsumer()
+            old_vrt.connectionReplaced(gap)
+            self._vrt.setPacketConsumer(consumer)
+
+        @d.addErrback
+        def failed(failure):
+            logger.warning('reconnecting to %s failed: %s', self._host,
+                failure.getErrorMessage())
+            # the state couldn't be restored over these connections
+            self._scpi_ready = False
+            for client in opened:
+                client.transport.loseConnection()
+            if self._disconnecting:
+                self._reconnecting = False
+                held, self._scpi_held = self._scpi_held, []
+                for cmd, query in held:
+                    if query is not None:
+                        query.errback(failure)
+                return
+            self._reactor.callLater(delay, self._attempt_reconnect, old_vrt,
+                lost, attempts + 1, min(delay * 2, self.max_backoff))
 
     def scpiset(self, cmd):
+        if not self._scpi_ready:
+            self._scpi_held.append(("%s\n" % cmd, None))
+            return
         self._scpi.scpiset("%s\n" % cmd)
 
     def scpiget(self, cmd):
+        if not self._scpi_ready:
+            d = defer.Deferred()
+            self._scpi_held.append(("%s\n" % cmd, d))
+            return d
         return self._scpi.scpiget("%s\n" % cmd)
 
+    def scpiget_many(self, cmds):
+        """
+        Send several SCPI queries without waiting for each response.
+
+        :returns: a Deferred that fires with a list of the responses
+        """
+        return defer.gatherResults([self.scpiget(cmd) for cmd in cmds])
+
     def sync_async(self, gen):
         def advance(result):
             try:
@@ -73,75 +211,429 @@ class TwistedConnector(object):
     def raw_read(self, num_bytes):
         return self._vrt.expectingData(num_bytes)
 
+    def read_packet(self):
+        """
+        Read a single VRT packet, framed and parsed as soon as it
+        arrives instead of with one read per packet field.
+
+        :returns: a Deferred that fires with a
+            :class:`DataPacket <pyrf.vrt.DataPacket>` or
+            :class:`ContextPacket <pyrf.vrt.ContextPacket>`
+        """
+        return self._vrt.expectingPacket()
+
+    def set_packet_consumer(self, consumer):
+        """
+        Deliver all VRT packets to a consumer as they arrive.
+
+        :param consumer: a function called with a list of the packets
+            parsed from each block of data received, or None to stop
+            delivering packets
+        """
+        self._vrt.setPacketConsumer(consumer)
+
+    def flow_stats(self):
+        """
+        :returns: a dict of VRT buffer flow control statistics, see
+            :meth:`VRTClient.flowStats`
+        """
+        return self._vrt.flowStats()
+
+    def packet_queue(self, max_size=None):
+        """
+        Deliver all VRT packets to a new queue as they arrive.
+
+        :param max_size: the number of lists of packets that may wait
+            in the queue before reading from the device is paused, or
+            None to queue without limit
+        :returns: a :class:`PacketQueue` of lists of packets
+        """
+        queue = PacketQueue(self, max_size)
+        self.set_packet_consumer(queue.put)
+        return queue
+
+
+class PacketQueue(object):
+    """
+    A queue of lists of packets from :meth:`TwistedConnector.packet_queue`.
+    Reading from the device is paused while *max_size* or more lists
+    are waiting and resumed as they are removed with :meth:`get`.
+
+    :param connector: the :class:`TwistedConnector` the packets are from
+    :param max_size: the number of lists that may wait, or None for
+        no limit
+    """
+    def __init__(self, connector, max_size=None):
+        self._connector = connector
+        self.max_size = max_size
+        self._queue = defer.DeferredQueue()
+
+    def __len__(self):
+        return len(self._queue.pending)
+
+    def put(self, packets):
+        self._queue.put(packets)
+        if self.max_size is not None and len(self) >= self.max_size:
+            self._connector._vrt.setConsumerPaused(True)
+
+    def get(self):
+        """
+        :returns: a Deferred that fires with the next list of packets
+        """
+        d = self._queue.get()
+        if self.max_size is not None and len(self) < self.max_size:
+            self._connector._vrt.setConsumerPaused(False)
+        return d
+
 
 class VRTTooMuchData(Exception):
     pass
 
+class ChunkBuffer(object):
+    """
+    A FIFO byte buffer that stores data as the chunks received.
+
+    Appending and consuming take time proportional to the number of
+    chunks involved, not the amount of data buffered.  Data that lies
+    within a single chunk is returned as a memoryview of that chunk
+    without copying.
+    """
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._length += len(data)
+
+    def consume(self, num_bytes):
+        """
+        Remove and return the first *num_bytes* bytes.
+
+        :returns: a chunk, a memoryview of part of a chunk or a new string
+            when the data spans several chunks, or None if fewer than
+            *num_bytes* are buffered
+        """
+        if self._length < num_bytes:
+            return None
+        if not num_bytes:
+            return b''
+        self._length -= num_bytes
+        first = self._chunks[0]
+        start = self._offset
+        end = start + num_bytes
+        if end <= len(first):
+            if end == len(first):
+                self._chunks.popleft()
+                self._offset = 0
+                if not start:
+                    return first
+            else:
+                self._offset = end
+            return memoryview(first)[start:end]
+
+        parts = []
+        while num_bytes:
+            first = self._chunks[0]
+            available = len(first) - self._offset
+            if available > num_bytes:
+                parts.append(first[self._offset:self._offset + num_bytes])
+                self._offset += num_bytes
+                break
+            parts.append(first[self._offset:] if self._offset else first)
+            self._chunks.popleft()
+            self._offset = 0
+            num_bytes -= available
+        return b''.join(parts)
+
+    def peek(self, num_bytes):
+        """
+        Return the first *num_bytes* bytes without removing them,
+        or None if fewer than *num_bytes* are buffered.
+        """
+        if self._length < num_bytes:
+            return None
+        if not num_bytes:
+            return b''
+        first = self._chunks[0]
+        if self._offset + num_bytes <= len(first):
+            return first[self._offset:self._offset + num_bytes]
+        parts = []
+        offset = self._offset
+        for chunk in self._chunks:
+            parts.append(chunk[offset:offset + num_bytes])
+            num_bytes -= len(parts[-1])
+            offset = 0
+            if not num_bytes:
+                break
+        return b''.join(parts)
+
+
 class VRTClient(Protocol):
     """
     A Twisted protocol for the VRT connection
+
+    Data may be requested as a number of bytes with
+    :meth:`expectingData` or as whole packets with
+    :meth:`expectingPacket`.  Requests are served in the order they
+    are made.  When a packet consumer is set with
+    :meth:`setPacketConsumer`, all the complete packets in each block
+    of data received are parsed and passed to it in a single call.
+
+    By default the connection is dropped when more than
+    TOO_MUCH_UNEXPECTED_DATA bytes are buffered unread.  Use
+    :meth:`setFlowControl` to pause the transport or drop packets
+    instead.
     """
     TOO_MUCH_UNEXPECTED_DATA = 10**6
     _buf = None
+    metrics = None
 
     def __init__(self):
         self.eof = False
-        self._expected_responses = []
+        self._expected_responses = deque()
+        self._packet_consumer = None
+        self.lost = None
+        self._high_water = None
+        self._low_water = None
+        self._drop_packets = False
+        self._packet_aligned = True
+        self.paused = False
+        self.consumer_paused = False
+        self.pause_count = 0
+        self.dropped_packets = 0
+        self.dropped_bytes = 0
 
     def makeConnection(self, transport):
         Protocol.makeConnection(self, transport)
-        self._buf = StringIO()
-        self._buf_offset = 0
-
-    def _bufAppend(self, data):
-        if self._buf_offset:
-            self._buf.seek(self._buf_offset)
-            prefix = self._buf.read()
-            self._buf.seek(0)
-            self._buf.truncate()
-            self._buf.write(prefix)
-            self._buf_offset = 0
-        self._buf.seek(0, 2)
-        self._buf.write(data)
-
-    def _bufConsume(self, num_bytes):
-        "returns None if not enough bytes available"
-        if self._bufLength() < num_bytes:
-            return None
-        self._buf.seek(self._buf_offset)
-        self._buf_offset += num_bytes
-        return self._buf.read(num_bytes)
+        self._buf = ChunkBuffer()
 
-    def _bufLength(self):
-        self._buf.seek(0, 2)
-        return self._buf.tell() - self._buf_offset
+    def _consumePacket(self):
+        "returns None if a complete packet is not available"
+        header = self._buf.peek(4)
+        if header is None:
+            return None
+        (word,) = struct.unpack(">I", header)
+        data = self._buf.consume((word & 0xffff) * 4)
+        if data is None:
+            return None
+        self._packet_aligned = True
+        if not isinstance(data, memoryview):
+            data = memoryview(data)
+        metrics = self.metrics
+        if metrics is None:
+            return parse_packet(data)
+        start = time.time()
+        pkt = parse_packet(data)
+        metrics.observe('parse_time', time.time() - start)
+        metrics.count('packets_received')
+        return pkt
+
+    def _consume(self, num_bytes):
+        if num_bytes is None:
+            return self._consumePacket()
+        data = self._buf.consume(num_bytes)
+        if data is not None:
+            # byte reads may leave a partial packet in the buffer
+            self._packet_aligned = False
+        return data
+
+    def _dropPackets(self):
+        "discard the oldest whole packets down to the low water mark"
+        while len(self._buf) > self._low_water:
+            header = self._buf.peek(4)
+            if header is None:
+                break
+            (word,) = struct.unpack(">I", header)
+            data = self._buf.consume((word & 0xffff) * 4)
+            if data is None:
+                break
+            self.dropped_packets += 1
+            self.dropped_bytes += len(data)
+            if self.metrics is not None:
+                self.metrics.count('dropped_packets')
+
+    def _waiting(self):
+        """
+        True when a read or the packet consumer is waiting for more data
+        than is buffered, so the transport must not stay paused
+        """
+        return bool(self._expected_responses or self._packet_consumer)
+
+    def _checkFlow(self):
+        buffered = len(self._buf)
+        if self.paused:
+            if buffered <= self._low_water or self._waiting():
+                self.paused = False
+                if not self.consumer_paused:
+                    self.transport.resumeProducing()
+            return
+        if buffered <= self._high_water or self._waiting():
+            return
+        if self._drop_packets and self._packet_aligned:
+            self._dropPackets()
+        if len(self._buf) > self._high_water:
+            self.paused = True
+            self.pause_count += 1
+            if not self.consumer_paused:
+                self.transport.pauseProducing()
 
     def dataReceived(self, data):
-        self._bufAppend(data)
+        self._buf.append(data)
+        if self.metrics is not None:
+            self.metrics.count('bytes_received', len(data))
         while self._expected_responses:
-            data = self._bufConsume(self._expected_responses[0][1])
-            if not data:
+            data = self._consume(self._expected_responses[0][1])
+            if data is None:
                 break
-            callback, num_bytes = self._expected_responses.pop(0)
+            callback, num_bytes = self._expected_responses.popleft()
 
             callback(data)
 
-        if self._bufLength() > self.TOO_MUCH_UNEXPECTED_DATA:
+        if self._packet_consumer and not self._expected_responses:
+            packets = []
+            while True:
+                pkt = self._consumePacket()
+                if pkt is None:
+                    break
+                packets.append(pkt)
+            if packets:
+                self._packet_consumer(packets)
+
+        if self.metrics is not None:
+            self.metrics.gauge('buffered_bytes', len(self._buf))
+        if self._high_water is not None:
+            self._checkFlow()
+        elif len(self._buf) > self.TOO_MUCH_UNEXPECTED_DATA:
             self.transport.loseConnection()
             raise VRTTooMuchData("Too much unexpected data received")
 
-    def expectingData(self, num_bytes):
+    def _expecting(self, num_bytes):
         d = defer.Deferred()
 
-        data = self._bufConsume(num_bytes)
-        if data:
-            d.callback(data)
-        else:
+        data = None
+        if not self._expected_responses:
+            data = self._consume(num_bytes)
+        if data is None:
             self._expected_responses.append((d.callback, num_bytes))
+        if self.paused:
+            self._checkFlow()
+        if data is not None:
+            d.callback(data)
         return d
 
+    def expectingData(self, num_bytes):
+        return self._expecting(num_bytes)
+
+    def expectingPacket(self):
+        """
+        :returns: a Deferred that fires with the next packet
+        """
+        return self._expecting(None)
+
+    def setPacketConsumer(self, consumer):
+        """
+        :param consumer: a function called with a list of packets each
+            time data is received, or None
+        """
+        self._packet_consumer = consumer
+        if consumer:
+            self.dataReceived(b'')
+
+    def packetConsumer(self):
+        """
+        :returns: the function passed to :meth:`setPacketConsumer`
+        """
+        return self._packet_consumer
+
+    def connectionReplaced(self, gap):
+        """
+        Answer the requests still waiting after this connection was lost
+        and a new one made: packet requests and the packet consumer
+        receive *gap* and byte requests receive False.
+
+        :param gap: a :class:`ConnectionGap <pyrf.vrt.ConnectionGap>`
+        """
+        expected = self._expected_responses
+        self._expected_responses = deque()
+        for callback, num_bytes in expected:
+            callback(gap if num_bytes is None else False)
+        if self._packet_consumer:
+            self._packet_consumer([gap])
+            self._packet_consumer = None
+
+    def setFlowControl(self, high_water, low_water=None,
+            drop_packets=False):
+        """
+        Bound the data buffered unread instead of dropping the connection
+        once TOO_MUCH_UNEXPECTED_DATA bytes are waiting.
+
+        :param high_water: the number of bytes buffered at which to
+            apply flow control, or None to restore the default behaviour
+        :param low_water: the number of bytes buffered at which to
+            resume reading, defaults to half of *high_water*
+        :param drop_packets: True to discard the oldest whole packets
+            down to *low_water* instead of pausing the transport.  Packets
+            are only dropped when the buffer starts at a packet boundary,
+            i.e. when reading with :meth:`expectingPacket`; otherwise the
+            transport is paused
+
+        The transport is never left paused while a read is waiting for
+        more data than is buffered, so a read larger than *high_water*
+        still completes.  A packet consumer receives every complete
+        packet as it arrives and leaves nothing to bound; use
+        :meth:`setConsumerPaused` to stop reading for a slow consumer.
+        """
+        if low_water is None and high_water is not None:
+            low_water = high_water // 2
+        self._high_water = high_water
+        self._low_water = low_water
+        self._drop_packets = drop_packets
+        if self.paused and high_water is None:
+            self.paused = False
+            if not self.consumer_paused:
+                self.transport.resumeProducing()
+
+    def setConsumerPaused(self, paused):
+        """
+        Pause or resume reading from the transport on behalf of the
+        packet consumer, independent of :meth:`setFlowControl`.
+
+        :param paused: True to stop reading, False to continue
+        """
+        if paused == self.consumer_paused:
+            return
+        self.consumer_paused = paused
+        if self.paused:
+            return
+        if paused:
+            self.transport.pauseProducing()
+        else:
+            self.transport.resumeProducing()
+
+    def flowStats(self):
+        """
+        :returns: a dict with the number of bytes buffered, whether the
+            transport is paused, the number of times it was paused and
+            the number of packets and bytes dropped
+        """
+        return {
+            'buffered': len(self._buf),
+            'paused': self.paused,
+            'pause_count': self.pause_count,
+            'dropped_packets': self.dropped_packets,
+            'dropped_bytes': self.dropped_bytes,
+            }
+
     def connectionLost(self, reason):
         self.eof = True
+        if self.lost:
+            self.lost(self)
 
 class VRTClientFactory(Factory):
     def startedConnecting(self, connector):
@@ -153,44 +645,59 @@ class VRTClientFactory(Factory):
     def clientConnectionFailed(self, connector, reason):
         pass
 
-class SCPIClient(Protocol):
-    _pending = None
+class SCPIClient(LineOnlyReceiver):
+    """
+    A Twisted protocol for the SCPI connection
+
+    Commands are written as soon as they are sent, so any number of
+    queries may be waiting for responses.  Responses are matched to
+    queries in the order they were sent.  Commands sent together are
+    combined into a single write by the transport.
+    """
+    delimiter = b'\n'
+    metrics = None
+
+    def __init__(self):
+        self._pending = deque()
+        self.lost = None
 
     def connectionMade(self):
         self.transport.setTcpNoDelay(True)
 
+    def connectionLost(self, reason):
+        pending = self._pending
+        self._pending = deque()
+        for d in pending:
+            d.errback(reason)
+        if self.lost:
+            self.lost(self)
+
     def scpiset(self, cmd):
-        if self._pending:
-            # prevent reordering
-            self._pending.append((cmd, None))
-        else:
-            logger.debug('scpiset %r', cmd)
-            self.transport.write(cmd)
+        logger.debug('scpiset %r', cmd)
+        if self.metrics is not None:
+            self.metrics.count('scpi_commands')
+        self.transport.write(cmd)
 
     def scpiget(self, cmd):
         d = defer.Deferred()
-        if self._pending:
-            # command pipelining not supported
-            self._pending.append((cmd, d))
-        else:
-            self._pending = [('', d)]
-            self.transport.write(cmd)
-            logger.debug('scpiget %r', cmd)
+        self._pending.append(d)
+        logger.debug('scpiget %r', cmd)
+        if self.metrics is not None:
+            d.addCallback(self._queryAnswered, time.time())
+        self.transport.write(cmd)
         return d
 
-    def dataReceived(self, data):
-        cmd, d = self._pending.pop(0)
-        logger.debug('scpigot %r', data)
-        if d:
-            d.callback(data)
-
-        while self._pending:
-            cmd, d = self._pending[0]
-            logger.debug('scpi(%s) %r', 'get' if d else 'set', cmd)
-            self.transport.write(cmd)
-            if d:
-                break
-            self._pending.pop(0)
+    def _queryAnswered(self, response, start):
+        self.metrics.observe('scpi_query_latency', time.time() - start)
+        self.metrics.count('scpi_queries')
+        return response
+
+    def lineReceived(self, line):
+        logger.debug('scpigot %r', line)
+        if not self._pending:
+            logger.warning('unexpected SCPI response %r', line)
+            return
+        self._pending.popleft().callback(line.rstrip(b'\r'))
 
 
 class SCPIClientFactory(Factory):
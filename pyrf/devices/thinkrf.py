@@ -3,6 +3,17 @@ from pyrf.connectors.blocking import PlainSocketConnector
 from pyrf.connectors.base import sync_async
 from pyrf.vrt import vrt_packet_reader, I_ONLY, IQ
 
+# commands for settings replayed by WSA4000 after reconnecting
+SETTING_COMMANDS = [
+    ('freq', ":FREQ:CENTER %d"),
+    ('fshift', ":FREQ:SHIFT %d"),
+    ('decimation', ":SENSE:DECIMATION %d"),
+    ('gain', ":INPUT:GAIN:RF %s"),
+    ('ifgain', ":INPUT:GAIN:IF %d"),
+    ('preselect_filter', ":INPUT:FILTER:PRESELECT %d"),
+    ('antenna', ":INPUT:ANTENNA %d"),
+    ]
+
 class WSA4000(object):
     """
     Interface for WSA4000
@@ -11,6 +22,16 @@ class WSA4000(object):
         defaults to a new
         :class:`PlainSocketConnector <pyrf.connectors.blocking.PlainSocketConnector>`
         instance
+    :param cache_settings: True to answer setting queries such as
+        :meth:`freq() <WSA4000.freq>` from the values last set or read
+        instead of asking the device each time.  Only use this when
+        nothing else changes the device settings; the center frequency
+        is also updated from context packets returned by
+        :meth:`read() <WSA4000.read>`.
+    :param metrics: a :class:`Metrics <pyrf.metrics.Metrics>` instance
+        to count the packets read by type, connection gaps and settings
+        sent or answered from the cache, None to record nothing.  Pass
+        another instance to the connector for network level metrics.
 
     :meth:`connect() <WSA4000.connect>` must be called before other methods are used.
 
@@ -20,7 +41,9 @@ class WSA4000(object):
        or if you passed a
        :class:`TwistedConnector <pyrf.connectors.twisted_async.TwistedConnector>`
        instance to the constructor they will immediately return a
-       Twisted Deferred object.
+       Twisted Deferred object.  With an
+       :class:`AsyncioConnector <pyrf.connectors.asyncio_async.AsyncioConnector>`
+       they return an asyncio Future.
 
     """
 
@@ -30,10 +53,106 @@ class WSA4000(object):
     CAPTURE_FREQ_RANGES = [(0, 40*M, I_ONLY), (90*M, 10000*M, IQ)]
     SWEEP_FREQ_RANGE = (90*M, 10000*M)
 
-    def __init__(self, connector=None):
+    def __init__(self, connector=None, cache_settings=False, metrics=None):
         if not connector:
             connector = PlainSocketConnector()
         self.connector = connector
+        self.cache_settings = cache_settings
+        self.metrics = metrics
+
+        # last settings made or read, restored by connectors that
+        # reconnect and compared by configure()
+        self._settings = {}
+        self._sweep_entries = []
+        self._sweep_start = None
+        self._read_perm = False
+        if hasattr(connector, 'reconnect_handler'):
+            connector.reconnect_handler = self._restore_state
+
+    def _set(self, name, value):
+        self._settings[name] = value
+        self.scpiset(dict(SETTING_COMMANDS)[name] % value)
+
+    def _cached(self, name):
+        if self.cache_settings:
+            value = self._settings.get(name)
+            if value is not None and self.metrics is not None:
+                self.metrics.count('settings_cache_hits')
+            return value
+
+    @sync_async
+    def configure(self, **settings):
+        """
+        Change several settings at once, sending only the ones that
+        differ from the values last set or read.  The commands are sent
+        together without waiting for each one in turn.
+
+        :param settings: new values for any of *freq*, *fshift*,
+            *decimation*, *gain*, *ifgain*, *preselect_filter*, *antenna*
+            and *trigger*, as passed to the method of the same name
+        :returns: a list of the names of the settings sent
+        """
+        names = [name for name, cmd in SETTING_COMMANDS] + ['trigger']
+        unknown = set(settings) - set(names)
+        if unknown:
+            raise TypeError("unknown settings: %s" % ", ".join(sorted(unknown)))
+
+        changed = [name for name in names if name in settings
+            and (name not in self._settings
+                or settings[name] != self._settings[name])]
+        if self.metrics is not None:
+            self.metrics.count('settings_sent', len(changed))
+            self.metrics.count('settings_skipped', len(settings) - len(changed))
+        results = [getattr(self, name)(settings[name]) for name in changed]
+        for result in results:
+            yield result
+        yield changed
+
+    def update_from_context(self, fields):
+        """
+        Update the settings last read from the device with the values
+        in context packets.  Only the center frequency is reported.
+
+        Context packets returned by :meth:`read` are applied
+        automatically when *cache_settings* is enabled.  Packets read
+        any other way, e.g. with :meth:`background_read` or a packet
+        consumer, must be passed here to keep the cache current.
+
+        :param fields: the ``fields`` of a context packet, or the
+            context values collected by
+            :func:`read_data_and_context() <pyrf.util.read_data_and_context>`
+        """
+        if 'rffreq' in fields:
+            self._settings['freq'] = int(fields['rffreq'])
+
+    def forget_settings(self):
+        """
+        Forget the settings last set or read, so the next queries and
+        :meth:`configure` ask the device.
+        """
+        self._settings = {}
+
+    @sync_async
+    def _restore_state(self):
+        """
+        Send the settings last made again after reconnecting, with a
+        single write where the connector allows it.
+        """
+        cmds = [cmd % self._settings[name]
+            for name, cmd in SETTING_COMMANDS if name in self._settings]
+        if 'trigger' in self._settings:
+            cmds.extend(_trigger_commands(self._settings['trigger']))
+        if self._sweep_entries:
+            cmds.append(":sweep:entry:del all")
+            for entry in self._sweep_entries:
+                cmds.extend(_sweep_entry_commands(entry))
+        if cmds:
+            self.scpiset("\n".join(cmds))
+        if self._read_perm:
+            yield self.request_read_perm()
+        if self._sweep_start is not None:
+            self.sweep_start(*self._sweep_start)
+        yield
 
     @sync_async
     def connect(self, host):
@@ -77,6 +196,19 @@ class WSA4000(object):
         """
         return self.connector.scpiget(cmd)
 
+    def scpiget_many(self, cmds):
+        """
+        Send several SCPI commands and wait for all the responses.
+
+        The commands are sent together so the responses arrive after a
+        single network round trip instead of one round trip per command.
+
+        :param cmds: the commands to send
+        :type cmds: list of str
+        :returns: a list of the responses
+        """
+        return self.connector.scpiget_many(cmds)
+
     @sync_async
     def id(self):
         """
@@ -97,10 +229,12 @@ class WSA4000(object):
         :returns: the frequency in Hz
         """
         if freq is None:
-            buf = yield self.scpiget("FREQ:CENTER?")
-            freq = int(buf)
+            freq = self._cached('freq')
+            if freq is None:
+                buf = yield self.scpiget("FREQ:CENTER?")
+                freq = self._settings['freq'] = int(buf)
         else:
-            self.scpiset(":FREQ:CENTER %d\n" % freq)
+            self._set('freq', freq)
 
         yield freq
 
@@ -114,10 +248,12 @@ class WSA4000(object):
         :returns: the amount of frequency shift
         """
         if shift is None:
-            buf = yield self.scpiget("FREQ:SHIFT?")
-            shift = float(buf)
+            shift = self._cached('fshift')
+            if shift is None:
+                buf = yield self.scpiget("FREQ:SHIFT?")
+                shift = self._settings['fshift'] = float(buf)
         else:
-            self.scpiset(":FREQ:SHIFT %d\n" % shift)
+            self._set('fshift', shift)
 
         yield shift
 
@@ -136,16 +272,18 @@ class WSA4000(object):
         :returns: the decimation value
         """
         if value is None:
-            buf = yield self.scpiget("SENSE:DECIMATION?")
-            value = int(buf)
+            value = self._cached('decimation')
+            if value is None:
+                buf = yield self.scpiget("SENSE:DECIMATION?")
+                value = self._settings['decimation'] = int(buf)
         else:
-            self.scpiset(":SENSE:DECIMATION %d\n" % value)
+            self._set('decimation', value)
             if value == 1:
                 # verify decimation was disabled correctly
                 actual = yield self.scpiget("SENSE:DECIMATION?")
                 if int(actual) != 1:
                     # firmware < 2.5.3
-                    self.scpiset(":SENSE:DECIMATION %d\n" % 0)
+                    self._set('decimation', 0)
 
         # firmware < 2.5.3 returned 0 instead of 1
         if value == 0:
@@ -166,9 +304,12 @@ class WSA4000(object):
         :returns: the RF gain value
         """
         if gain is None:
-            gain = yield self.scpiget("INPUT:GAIN:RF?")
+            gain = self._cached('gain')
+            if gain is None:
+                gain = yield self.scpiget("INPUT:GAIN:RF?")
+                self._settings['gain'] = gain
         else:
-            self.scpiset(":INPUT:GAIN:RF %s\n" % gain)
+            self._set('gain', gain)
 
         yield gain.lower()
 
@@ -184,11 +325,13 @@ class WSA4000(object):
         :returns: the ifgain in dB
         """
         if gain is None:
-            gain = yield self.scpiget(":INPUT:GAIN:IF?")
-            gain = gain.partition(" ")
-            gain = int(gain[0])
+            gain = self._cached('ifgain')
+            if gain is None:
+                gain = yield self.scpiget(":INPUT:GAIN:IF?")
+                gain = gain.partition(" ")
+                gain = self._settings['ifgain'] = int(gain[0])
         else:
-            self.scpiset(":INPUT:GAIN:IF %d\n" % gain)
+            self._set('ifgain', gain)
 
         yield gain
 
@@ -201,10 +344,13 @@ class WSA4000(object):
         :returns: the RFE preselect filter selection state
         """
         if enable is None:
-            enable = yield self.scpiget(":INPUT:FILTER:PRESELECT?")
-            enable = bool(int(enable))
+            enable = self._cached('preselect_filter')
+            if enable is None:
+                enable = yield self.scpiget(":INPUT:FILTER:PRESELECT?")
+                enable = self._settings['preselect_filter'] = int(enable)
+            enable = bool(enable)
         else:
-            self.scpiset(":INPUT:FILTER:PRESELECT %d" % int(enable))
+            self._set('preselect_filter', int(enable))
         yield enable
 
     @sync_async
@@ -216,10 +362,12 @@ class WSA4000(object):
         :returns: active antenna port
         """
         if number is None:
-            number = yield self.scpiget(":INPUT:ANTENNA?")
-            number = int(number)
+            number = self._cached('antenna')
+            if number is None:
+                number = yield self.scpiget(":INPUT:ANTENNA?")
+                number = self._settings['antenna'] = int(number)
         else:
-            self.scpiset(":INPUT:ANTENNA %d" % number)
+            self._set('antenna', number)
         yield number
 
 
@@ -227,7 +375,15 @@ class WSA4000(object):
         """
         Resets the WSA4000 to its default settings. It does not affect
         the registers or queues associated with the IEEE mandated commands.
+
+        The settings, sweep list and sweep state remembered for
+        :meth:`configure` and reconnecting are forgotten.  Read
+        permission is kept: it is a lock held by this connection, not a
+        device setting.
         """
+        self._settings = {}
+        self._sweep_entries = []
+        self._sweep_start = None
         self.scpiset(":*rst")
 
 
@@ -235,7 +391,7 @@ class WSA4000(object):
         """
         Flush capture memory of sweep captures.
         """
-        self.scpiset(":sweep:flush\n")
+        self.scpiset(":sweep:flush")
 
     @sync_async
     def trigger(self, settings=None):
@@ -249,7 +405,13 @@ class WSA4000(object):
         :type settings: pyrf.config.TriggerSettings
         :returns: the trigger settings
         """
+        cached = None
         if settings is None:
+            cached = self._cached('trigger')
+        if cached is not None:
+            settings = cached
+
+        elif settings is None:
             # find out what kind of trigger is set
             trigstr = yield self.scpiget(":TRIGGER:TYPE?")
             if trigstr == "NONE":
@@ -270,19 +432,18 @@ class WSA4000(object):
 
             else:
                 raise TriggerSettingsError("unsupported trigger type set: %s" % trigstr)
+            self._settings['trigger'] = settings
 
         else:
-            if settings.trigtype == "NONE":
-                self.scpiset(":TRIGGER:TYPE NONE")
-
-            elif settings.trigtype == "LEVEL":
-                self.scpiset(":TRIGGER:LEVEL %d, %d, %d" % (settings.fstart, settings.fstop, settings.amplitude))
-                self.scpiset(":TRIGGER:TYPE LEVEL")
+            self._settings['trigger'] = settings
+            for cmd in _trigger_commands(settings):
+                self.scpiset(cmd)
 
         yield settings
 
 
 
+    @sync_async
     def capture(self, spp, ppb):
         """
         This command will start the single block capture and the return of
@@ -294,9 +455,10 @@ class WSA4000(object):
         :param spp: the number of samples in a packet
         :param ppb: the number of packets in a capture
         """
-        self.scpiset(":TRACE:SPP %s\n" % (spp))
-        self.scpiset(":TRACE:BLOCK:PACKETS %s\n" % (ppb))
-        self.scpiset(":TRACE:BLOCK:DATA?\n")
+        self.scpiset(":TRACE:SPP %s" % (spp))
+        self.scpiset(":TRACE:BLOCK:PACKETS %s" % (ppb))
+        self.scpiset(":TRACE:BLOCK:DATA?")
+        yield
 
     @sync_async
     def request_read_perm(self):
@@ -305,8 +467,9 @@ class WSA4000(object):
 
         :returns: True if allowed to read, False if not
         """
-        lockstr = yield self.scpiget(":SYSTEM:LOCK:REQUEST? ACQ\n")
-        yield lockstr == "1"
+        lockstr = yield self.scpiget(":SYSTEM:LOCK:REQUEST? ACQ")
+        self._read_perm = lockstr == "1"
+        yield self._read_perm
 
     @sync_async
     def have_read_perm(self):
@@ -315,7 +478,7 @@ class WSA4000(object):
 
         :returns: True if allowed to read, False if not
         """
-        lockstr = yield self.scpiget(":SYSTEM:LOCK:HAVE? ACQ\n")
+        lockstr = yield self.scpiget(":SYSTEM:LOCK:HAVE? ACQ")
         yield lockstr == "1"
 
 
@@ -362,18 +525,50 @@ class WSA4000(object):
         """
         Read a single VRT packet from the WSA.
         """
-        return vrt_packet_reader(self.connector.raw_read)
+        read_packet = getattr(self.connector, 'read_packet', None)
+        if read_packet:
+            reader = _whole_packet_reader(read_packet)
+        else:
+            reader = vrt_packet_reader(self.connector.raw_read)
+        if self.cache_settings:
+            reader = _context_applied_reader(reader, self)
+        if self.metrics is None:
+            return reader
+        return _counted_packet_reader(reader, self.metrics)
+
+    def background_read(self, max_packets=1000, policy='block', parse=True):
+        """
+        Start reading packets on a background thread.  Only available
+        with :class:`PlainSocketConnector <pyrf.connectors.blocking.PlainSocketConnector>`.
+
+        :param max_packets: the number of packets that may wait to be
+            processed
+        :param policy: 'block', 'drop_oldest' or 'drop_newest', what to
+            do when *max_packets* are waiting
+        :param parse: False to return the bytes of each packet instead
+            of parsed packets
+        :returns: a started
+            :class:`BackgroundReader <pyrf.connectors.blocking.BackgroundReader>`,
+            iterate over it to get the packets
+        """
+        reader = self.connector.background_reader(max_packets, policy, parse)
+        reader.start()
+        return reader
 
     def raw_read(self, num):
         """
         Raw read of VRT socket data from the WSA.
 
         :param num: the number of bytes to read
-        :returns: bytes
+        :returns: bytes, as a memoryview when using
+            :class:`PlainSocketConnector <pyrf.connectors.blocking.PlainSocketConnector>`.
+            A memoryview has no str methods, call its ``tobytes()``
+            method for a str.
         """
         return self.connector.raw_read(num)
 
 
+    @sync_async
     def sweep_add(self, entry):
         """
         Add an entry to the sweep list
@@ -381,19 +576,10 @@ class WSA4000(object):
         :param entry: the sweep entry to add
         :type entry: pyrf.config.SweepEntry
         """
-        self.scpiset(":sweep:entry:new")
-        self.scpiset(":sweep:entry:freq:center %d, %d" % (entry.fstart, entry.fstop))
-        self.scpiset(":sweep:entry:freq:step %d" % (entry.fstep))
-        self.scpiset(":sweep:entry:freq:shift %d" % (entry.fshift))
-        self.scpiset(":sweep:entry:decimation %d" % (entry.decimation))
-        self.scpiset(":sweep:entry:antenna %d" % (entry.antenna))
-        self.scpiset(":sweep:entry:gain:rf %s" % (entry.gain))
-        self.scpiset(":sweep:entry:gain:if %d" % (entry.ifgain))
-        self.scpiset(":sweep:entry:spp %d" % (entry.spp))
-        self.scpiset(":sweep:entry:ppb %d" % (entry.ppb))
-        self.scpiset(":sweep:entry:trigger:type %s" % (entry.trigtype))
-        self.scpiset(":sweep:entry:trigger:level %d, %d, %d" % (entry.level_fstart, entry.level_fstop, entry.level_amplitude))
-        self.scpiset(":sweep:entry:save")
+        self._sweep_entries.append(entry)
+        for cmd in _sweep_entry_commands(entry):
+            self.scpiset(cmd)
+        yield
 
     @sync_async
     def sweep_read(self, index):
@@ -451,6 +637,7 @@ class WSA4000(object):
         """
         Remove all entries from the sweep list.
         """
+        self._sweep_entries = []
         self.scpiset(":sweep:entry:del all")
 
 
@@ -458,6 +645,7 @@ class WSA4000(object):
         """
         Start the sweep engine.
         """
+        self._sweep_start = (start_id,)
         if start_id:
             self.scpiset(":sweep:list:start %d" % start_id);
         else:
@@ -468,6 +656,7 @@ class WSA4000(object):
         """
         Stop the sweep engine.
         """
+        self._sweep_start = None
         self.scpiset(":sweep:list:stop")
 
 
@@ -478,3 +667,69 @@ class WSA4000(object):
         self.scpiset(":sweep:flush")
 
 
+def _whole_packet_reader(read_packet):
+    """
+    Like :func:`pyrf.vrt.vrt_packet_reader` for connectors that frame
+    whole packets themselves.
+    """
+    yield read_packet()
+
+
+def _context_applied_reader(reader, dut):
+    "pass the values of a packet reader through, caching context settings"
+    val = None
+    try:
+        while True:
+            val = yield reader.send(val)
+    except StopIteration:
+        pass
+    if val and val.is_context_packet():
+        dut.update_from_context(val.fields)
+
+
+def _counted_packet_reader(reader, metrics):
+    "pass the values of a packet reader through, counting the packet read"
+    val = None
+    try:
+        while True:
+            val = yield reader.send(val)
+    except StopIteration:
+        pass
+    if not val:
+        return
+    metrics.count('packets_read')
+    if val.is_data_packet():
+        metrics.count('data_packets')
+    elif val.is_context_packet():
+        metrics.count('context_packets')
+    else:
+        metrics.count('connection_gaps')
+
+
+def _trigger_commands(settings):
+    if settings.trigtype == "NONE":
+        return [":TRIGGER:TYPE NONE"]
+    elif settings.trigtype == "LEVEL":
+        return [":TRIGGER:LEVEL %d, %d, %d" % (settings.fstart,
+                settings.fstop, settings.amplitude),
+            ":TRIGGER:TYPE LEVEL"]
+    return []
+
+
+def _sweep_entry_commands(entry):
+    return [
+        ":sweep:entry:new",
+        ":sweep:entry:freq:center %d, %d" % (entry.fstart, entry.fstop),
+        ":sweep:entry:freq:step %d" % (entry.fstep),
+        ":sweep:entry:freq:shift %d" % (entry.fshift),
+        ":sweep:entry:decimation %d" % (entry.decimation),
+        ":sweep:entry:antenna %d" % (entry.antenna),
+        ":sweep:entry:gain:rf %s" % (entry.gain),
+        ":sweep:entry:gain:if %d" % (entry.ifgain),
+        ":sweep:entry:spp %d" % (entry.spp),
+        ":sweep:entry:ppb %d" % (entry.ppb),
+        ":sweep:entry:trigger:type %s" % (entry.trigtype),
+        ":sweep:entry:trigger:level %d, %d, %d" % (entry.level_fstart,
+            entry.level_fstop, entry.level_amplitude),
+        ":sweep:entry:save",
+        ]
@@ -0,0 +1,219 @@
+"""
+Runtime counters and histograms for connectors and devices.
+
+Metrics are disabled unless a :class:`Metrics` instance is passed to
+the connector or device, so the only cost otherwise is a check for
+``None`` where each value would be recorded:
+
+.. code-block:: python
+
+   dut = WSA4000(PlainSocketConnector(metrics=Metrics('wsa-1')),
+       metrics=Metrics('wsa-1'))
+   dut.connect(host)
+   ...
+   print dut.connector.metrics.snapshot()
+
+Snapshots are plain dicts, so they may be passed to any monitoring
+system with an exporter callback, see :class:`PeriodicExporter`.
+"""
+
+import bisect
+import threading
+import time
+
+# histogram bucket upper bounds: 1 us to about 16 s in powers of two
+DEFAULT_BUCKETS = [1e-6 * 2 ** n for n in range(25)]
+
+
+class Histogram(object):
+    """
+    Count of values recorded in fixed buckets, along with their number,
+    sum, minimum and maximum.
+
+    :param buckets: the sorted upper bounds of each bucket, values
+        above the last bound are counted in an overflow bucket
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :returns: the upper bound of the bucket holding the value at
+            *fraction* (0 - 1) of the values recorded, the maximum value
+            if that is in the overflow bucket, or None if no values
+            were recorded
+        """
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        :returns: a dict with count, sum, min, max, mean, p50, p95, p99
+            and buckets, a list of [upper bound, count] for each bucket
+            that is not empty, with None as the overflow bucket bound
+        """
+        bounds = self.bounds + [None]
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'buckets': [[b, c] for b, c in zip(bounds, self.counts) if c],
+            }
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms for one connector or device.
+
+    :param name: a name for these metrics included in snapshots,
+        e.g. the device hostname
+
+    Values may be recorded from any thread.  Updates are not locked, so
+    values recorded from several threads at the same instant may
+    occasionally be lost.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all values recorded.
+        """
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_maximums = {}
+        self.histograms = {}
+        self._start = time.time()
+
+    def count(self, name, value=1):
+        """
+        Add *value* to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Set a gauge to its current *value*, e.g. a queue depth.  The
+        largest value set is also kept.
+        """
+        self.gauges[name] = value
+        if value > self.gauge_maximums.get(name, value - 1):
+            self.gauge_maximums[name] = value
+
+    def observe(self, name, value):
+        """
+        Record *value* in a histogram, e.g. a latency in seconds.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def snapshot(self, previous=None):
+        """
+        :param previous: an earlier snapshot of these metrics kept by
+            the caller, rates are measured from it
+        :returns: a dict with the name, time, elapsed seconds since the
+            metrics were created or reset, counters, rates (the change
+            per second in each counter since *previous*, or since the
+            metrics were created or reset), gauges, gauge_maximums and
+            histograms
+
+        Taking a snapshot does not change the metrics, so any number of
+        callers may take snapshots, each keeping its own previous one.
+        """
+        now = time.time()
+        counters = dict(self.counters)
+        last_time, last_counters = self._start, {}
+        if previous is not None and previous['time'] >= self._start:
+            last_time, last_counters = previous['time'], previous['counters']
+        interval = now - last_time
+        rates = {}
+        if interval > 0:
+            for name, value in counters.items():
+                rates[name] = (value - last_counters.get(name, 0)) / interval
+        return {
+            'name': self.name,
+            'time': now,
+            'elapsed': now - self._start,
+            'counters': counters,
+            'rates': rates,
+            'gauges': dict(self.gauges),
+            'gauge_maximums': dict(self.gauge_maximums),
+            'histograms': dict((name, h.snapshot())
+                for name, h in list(self.histograms.items())),
+            }
+
+
+class PeriodicExporter(object):
+    """
+    Pass snapshots of metrics to a callback at a regular interval from
+    a background thread.
+
+    :param callback: a function called with a list of snapshot dicts
+    :param metrics: a list of :class:`Metrics` instances
+    :param interval: seconds between calls
+
+    Rates in each snapshot are measured from the previous export.
+    With Twisted, use ``LoopingCall`` to call :meth:`export` from the
+    reactor thread instead of starting this thread.
+    """
+    def __init__(self, callback, metrics, interval=10.0):
+        self.callback = callback
+        self.metrics = list(metrics)
+        self.interval = interval
+        self._previous = [None] * len(self.metrics)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def export(self):
+        """
+        Pass snapshots of all the metrics to the callback now.
+        """
+        self._previous = [m.snapshot(previous)
+            for m, previous in zip(self.metrics, self._previous)]
+        self.callback(list(self._previous))
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._export_loop,
+            name='PeriodicExporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _export_loop(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
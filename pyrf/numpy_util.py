@@ -1,8 +1,42 @@
+import bisect
 import math
+import threading
 
 from pyrf.vrt import I_ONLY
 
-def compute_fft(dut, data_pkt, context):
+# i, q values are 14-bit signed
+IQ_SCALE = 1.0 / 2**13
+
+# cosine series coefficients a0, a1, ... of each window shape
+WINDOW_COEFFICIENTS = {
+    'hann': (0.5, 0.5),
+    'blackman-harris': (0.35875, 0.48829, 0.14128, 0.01168),
+    'flattop': (0.21557895, 0.41663158, 0.277263158, 0.083578947,
+        0.006947368),
+    }
+
+# bounds on the difference in dB between float32 and float64 spectra
+# for bins within 40, 60, 80 and 100 dB of the peak.  They are about
+# twice the largest differences measured by
+# pyrf.tests.benchmarks.single_precision_error for tones of 50 to 8000
+# counts with DC offsets, 2% gain and 0.03 radian phase imbalance and
+# noise, at 256 to 32768 points.  The error grows for bins far below
+# the peak, where rounding of the FFT of the larger values dominates.
+# Half a 14-bit step is about 0.004 dB at the 72 dB ADC dynamic range.
+SINGLE_PRECISION_ERROR_DB = {
+    40: 0.00005,
+    60: 0.001,
+    80: 0.01,
+    100: 0.1,
+    }
+
+_windows = {}
+_engines = threading.local()
+_range_starts = {}
+
+
+def compute_fft(dut, data_pkt, context, window='hann', correction=None,
+        iq_corrector=None, dtype='float64'):
     """
     Return an array of dBm values by computing the FFT of
     the passed data and reference level.
@@ -12,77 +46,666 @@ def compute_fft(dut, data_pkt, context):
     :param data_pkt: packet containing samples
     :type data_pkt: pyrf.vrt.DataPacket
     :param context: dict containing context values
+    :param window: the window shape, see :data:`WINDOW_COEFFICIENTS`
+    :param correction: None for the uncorrected window output,
+        'amplitude' to correct for the coherent gain of the window so
+        tones read their true level or 'noise' to also correct for its
+        equivalent noise bandwidth so noise reads its level per bin
+    :param iq_corrector: an :class:`IQCorrector` to remove the DC offset
+        and I/Q imbalance with estimates kept for each frequency and
+        gain, None to estimate them from this packet alone
+    :param dtype: 'float64', or 'float32' to compute the spectrum with
+        single precision, which requires scipy.  See
+        :data:`SINGLE_PRECISION_ERROR_DB` for the accuracy.
 
     This function uses only *dut.ADC_DYNAMIC_RANGE*,
-    *data_pkt.data* and *context['reflevel']*.
+    *dut.NOISEFLOOR_CALIBRATION*, *dut.CAPTURE_FREQ_RANGES*,
+    *data_pkt.data*, *context['reflevel']* and *context['rffreq']*.
+
+    The window and work arrays are reused from the
+    :class:`SpectrumEngine` returned by :func:`spectrum_engine`.
 
-    :returns: numpy array of dBm values as floats
+    :returns: numpy array of dBm values as floats of *dtype*
     """
     import numpy # import here so docstrings are visible even without numpy
 
     reference_level = context['reflevel']
-
     iq_data = data_pkt.data.numpy_array()
-    # i, q values here are 14-bit signed
-    i_data = numpy.array(iq_data[:,0], dtype=float) / 2**13
-    q_data = numpy.array(iq_data[:,1], dtype=float) / 2**13
-
-    freq = context['rffreq']
-    for low, high, valid_data in dut.CAPTURE_FREQ_RANGES:
-        if low <= freq <= high:
-            break
+    engine = spectrum_engine(len(iq_data), window, dtype)
 
+    valid_data = _capture_mode(dut.CAPTURE_FREQ_RANGES, context['rffreq'])
     if valid_data == I_ONLY:
-        power_spectrum = _compute_fft_i_only(i_data)
-    power_spectrum = _compute_fft(i_data, q_data)
+        power_spectrum = engine.spectrum_i_only(iq_data[:, 0], IQ_SCALE,
+            numpy.empty(engine.points // 2 - 1, dtype=engine.dtype))
+    else:
+        power_spectrum = engine.spectrum(iq_data, IQ_SCALE,
+            numpy.empty(engine.points, dtype=engine.dtype), iq_corrector,
+            _setting(context))
 
     noiselevel_offset = (
         reference_level - dut.NOISEFLOOR_CALIBRATION - dut.ADC_DYNAMIC_RANGE)
-    return power_spectrum + noiselevel_offset
+    power_spectrum += noiselevel_offset + engine.correction(correction)
+    return power_spectrum
 
 
-def _compute_fft(i_data, q_data):
+def compute_fft_batch(dut, iq_data, contexts, window='hann',
+        correction=None, iq_corrector=None, dtype='float64'):
+    """
+    Compute the spectra of many data packets of the same size at once,
+    e.g. the packets of a block capture or a sweep.  The result for each
+    packet is the same as :func:`compute_fft`.
+
+    :param dut: WSA device
+    :type dut: pyrf.devices.thinkrf.WSA4000
+    :param iq_data: an (n_packets, spp, 2) array of I, Q values as
+        returned by :func:`stack_packets`, or an (n_packets, spp)
+        complex array of I + jQ values
+    :param contexts: a dict of context values for all the packets, or a
+        list of one dict for each packet
+    :param window: the window shape, as for :func:`compute_fft`
+    :param correction: the window correction, as for :func:`compute_fft`
+    :param iq_corrector: an optional :class:`IQCorrector`, as for
+        :func:`compute_fft`
+    :param dtype: 'float64' or 'float32', as for :func:`compute_fft`
+    :returns: an (n_packets, spp) numpy array of dBm values as floats
+        of *dtype*
+
+    I only captures are not supported, use :func:`compute_fft` for
+    packets captured at frequencies below the IQ capture range.
+    """
     import numpy
 
-    i_removed_dc_offset = i_data - numpy.mean(i_data)
-    q_removed_dc_offset = q_data - numpy.mean(q_data)
-    calibrated_q = _calibrate_i_q(i_removed_dc_offset, q_removed_dc_offset)
-    iq = i_removed_dc_offset + 1j * calibrated_q
-    windowed_iq = iq * numpy.hanning(len(i_data))
+    if isinstance(contexts, dict):
+        contexts = [contexts] * len(iq_data)
+    for context in contexts:
+        if _capture_mode(dut.CAPTURE_FREQ_RANGES,
+                context['rffreq']) == I_ONLY:
+            raise ValueError("I only captures can't be batched, "
+                "use compute_fft")
 
-    power_spectrum = numpy.fft.fftshift(numpy.fft.fft(windowed_iq))
-    power_spectrum = 20 * numpy.log10(numpy.abs(power_spectrum))
+    if numpy.iscomplexobj(iq_data):
+        i_data, q_data = iq_data.real, iq_data.imag
+    else:
+        i_data, q_data = iq_data[..., 0], iq_data[..., 1]
+    engine = spectrum_engine(i_data.shape[1], window, dtype)
+    power_spectra = engine.spectra(i_data, q_data, IQ_SCALE, iq_corrector,
+        [_setting(context) for context in contexts])
 
-    median_index = len(power_spectrum) // 2
-    power_spectrum[median_index] = (power_spectrum[median_index - 1]
-        + power_spectrum[median_index + 1]) / 2
-    return power_spectrum
+    noiselevel_offsets = numpy.array([context['reflevel']
+        for context in contexts], dtype=float)
+    noiselevel_offsets += (engine.correction(correction)
+        - dut.NOISEFLOOR_CALIBRATION - dut.ADC_DYNAMIC_RANGE)
+    power_spectra += noiselevel_offsets[:, numpy.newaxis]
+    return power_spectra
+
+
+def _setting(context):
+    "the key for the IQCorrector estimates of the packets with context"
+    return (context.get('rffreq'), context.get('gain'))
+
+
+def stack_packets(data_pkts):
+    """
+    Copy the I, Q values of data packets into a single array for
+    :func:`compute_fft_batch`.
 
-def _compute_fft_i_only(i_data):
+    :param data_pkts: a list of :class:`pyrf.vrt.DataPacket` objects
+        with the same number of samples, or a list of (N, 2) arrays
+        like the payloads from :func:`pyrf.vrt_stream.decode_packets`
+    :returns: an (n_packets, N, 2) int16 array
+    """
     import numpy
 
-    windowed_i = i_data * numpy.hanning(len(i_data))
+    arrays = [p.data.numpy_array() if hasattr(p, 'data') else p
+        for p in data_pkts]
+    sizes = set(len(a) for a in arrays)
+    if len(sizes) > 1:
+        raise ValueError("packets must have the same number of samples")
+    out = numpy.empty((len(arrays),) + arrays[0].shape, dtype='int16')
+    for row, a in zip(out, arrays):
+        row[...] = a
+    return out
+
+
+def _capture_mode(ranges, freq):
+    """
+    Find the type of data captured at *freq* from a sorted list of
+    (low, high, mode) ranges, with a binary search of their starts.
+    """
+    cached = _range_starts.get(id(ranges))
+    if cached is None or cached[0] is not ranges:
+        cached = (ranges, [low for low, high, mode in ranges])
+        _range_starts[id(ranges)] = cached
+    index = bisect.bisect_right(cached[1], freq) - 1
+    if index >= 0 and freq <= ranges[index][1]:
+        return ranges[index][2]
+    return ranges[-1][2]
+
+
+def _dot(a, b):
+    "the dot product of two vectors accumulated in double precision"
+    import numpy
+    if a.dtype == numpy.float64 and b.dtype == numpy.float64:
+        return numpy.dot(a, b)
+    return numpy.einsum('i,i', a, b, dtype=numpy.float64)
+
+
+def get_window(name, points, dtype='float64'):
+    """
+    Return a symmetric window like ``numpy.hanning(points)``.  Windows
+    are computed once and shared by all callers, so they are read-only.
+
+    :param name: 'hann', 'blackman-harris' or 'flattop'
+    :param points: the length of the window
+    :param dtype: 'float64' or 'float32'
+    """
+    import numpy
+
+    dtype = numpy.dtype(dtype)
+    key = (name, points, dtype.str)
+    window = _windows.get(key)
+    if window is not None:
+        return window
+    if name not in WINDOW_COEFFICIENTS:
+        raise ValueError("window must be one of %s"
+            % ", ".join(sorted(WINDOW_COEFFICIENTS)))
+
+    if name == 'hann':
+        window = numpy.hanning(points)
+    elif points == 1:
+        window = numpy.ones(1)
+    else:
+        phase = numpy.arange(points) * (2 * math.pi / (points - 1))
+        window = numpy.zeros(points)
+        for k, a in enumerate(WINDOW_COEFFICIENTS[name]):
+            window += (-1) ** k * a * numpy.cos(k * phase)
+    window = window.astype(dtype)
+    window.flags.writeable = False
+    _windows[key] = window
+    return window
+
+
+def spectrum_engine(points, window='hann', dtype='float64'):
+    """
+    Return a :class:`SpectrumEngine` for *points*, *window* and *dtype*,
+    created on first use and then reused.  Each thread has its own
+    engines, since they hold work arrays.
+    """
+    engines = getattr(_engines, 'cache', None)
+    if engines is None:
+        engines = _engines.cache = {}
+    key = (points, window, dtype)
+    engine = engines.get(key)
+    if engine is None:
+        engine = engines[key] = SpectrumEngine(points, window, dtype)
+    return engine
+
+
+class SpectrumEngine(object):
+    """
+    Compute power spectra of a fixed number of samples, reusing the
+    window and the work arrays for each spectrum.
+
+    :param points: the number of samples in each spectrum
+    :param window: 'hann', 'blackman-harris' or 'flattop'
+    :param dtype: 'float64' or 'float32', the precision of the work
+        arrays and the spectra returned.  float32 requires scipy, whose
+        ``fftpack`` computes single precision FFTs.
+
+    ``coherent_gain`` is the mean of the window and ``enbw`` its
+    equivalent noise bandwidth in bins.
+
+    Other than the array returned by ``numpy.fft``, which can't be
+    given an output array, no arrays are allocated once the engine is
+    created.  Spectra are written to the *out* array passed, or to an
+    array owned by the engine that is overwritten by the next spectrum.
+    """
+    def __init__(self, points, window='hann', dtype='float64'):
+        import numpy
+
+        self.points = points
+        self.window_name = window
+        self.dtype = numpy.dtype(dtype)
+        self.window = get_window(window, points, self.dtype)
+
+        self._fft = numpy.fft.fft
+        complex_dtype = numpy.complex128
+        if self.dtype == numpy.float32:
+            # numpy.fft always computes in double precision
+            from scipy import fftpack
+            self._fft = lambda a, axis=-1: fftpack.fft(a, axis=axis,
+                overwrite_x=True)
+            complex_dtype = numpy.complex64
+
+        w = self.window.astype(float)
+        self.coherent_gain = w.sum() / points
+        self.enbw = points * (w ** 2).sum() / w.sum() ** 2
+
+        self._i = numpy.empty(points, dtype=self.dtype)
+        self._q = numpy.empty(points, dtype=self.dtype)
+        self._scratch = numpy.empty(points, dtype=self.dtype)
+        self._iq = numpy.empty(points, dtype=complex_dtype)
+        self._power = numpy.empty(points, dtype=self.dtype)
+        self._out = numpy.empty(points, dtype=self.dtype)
+        self._batch = None
+
+    def correction(self, kind):
+        """
+        :param kind: None, 'amplitude' or 'noise', see
+            :func:`compute_fft`
+        :returns: the dB value to add to spectra for *kind*
+        """
+        if kind is None:
+            return 0.0
+        amplitude = -20 * math.log10(self.coherent_gain)
+        if kind == 'amplitude':
+            return amplitude
+        if kind == 'noise':
+            return amplitude - 10 * math.log10(self.enbw)
+        raise ValueError("correction must be None, 'amplitude' or 'noise'")
+
+    def spectrum(self, iq_data, scale=1.0, out=None, iq_corrector=None,
+            setting=None):
+        """
+        Compute the power spectrum of I and Q samples after removing
+        their DC offsets and correcting the I/Q phase and gain
+        imbalance.
+
+        :param iq_data: an array of (I, Q) samples with shape (points, 2)
+        :param scale: value to multiply the samples by
+        :param out: optional array of *points* values for the result
+        :param iq_corrector: an optional :class:`IQCorrector` to correct
+            the samples with, instead of estimating the corrections from
+            these samples alone
+        :param setting: the key for the *iq_corrector* estimates, e.g.
+            the frequency and gain the samples were captured with
+        :returns: the fftshifted spectrum in dB, with the DC bin
+            replaced by the mean of its neighbours
+        """
+        import numpy
+
+        i = self._i
+        q = self._q
+        numpy.multiply(iq_data[:, 0], scale, out=i, casting='unsafe')
+        numpy.multiply(iq_data[:, 1], scale, out=q, casting='unsafe')
+        if iq_corrector is None:
+            i -= i.mean(dtype=numpy.float64)
+            q -= q.mean(dtype=numpy.float64)
+            self._calibrate_q(i, q)
+        else:
+            iq_corrector.correct(i, q, setting, self._scratch)
+
+        iq = self._iq
+        numpy.multiply(i, self.window, out=iq.real)
+        numpy.multiply(q, self.window, out=iq.imag)
+        return self._shifted_db(self._fft(iq), out)
+
+    def spectrum_i_only(self, i_data, scale=1.0, out=None):
+        """
+        Compute the power spectrum of I only samples.
+
+        :param i_data: an array of *points* I samples
+        :param scale: value to multiply the samples by
+        :param out: optional array of ``points // 2 - 1`` values for
+            the result
+        :returns: the positive frequencies of the spectrum in dB,
+            excluding DC
+        """
+        import numpy
+
+        i = self._i
+        numpy.multiply(i_data, scale, out=i, casting='unsafe')
+        i *= self.window
+        fft = numpy.fft.rfft(i)[1:self.points // 2]
+        power = self._power[:len(fft)]
+        numpy.abs(fft, out=power, casting='unsafe')
+        if out is None:
+            out = self._out[:len(fft)]
+        numpy.log10(power, out=out)
+        out *= 20
+        return out
+
+    def spectra(self, i_data, q_data, scale=1.0, iq_corrector=None,
+            settings=None):
+        """
+        Compute many power spectra at once, like :meth:`spectrum` for
+        each row of *i_data* and *q_data*.
+
+        :param i_data: an (n_spectra, points) array of I samples
+        :param q_data: an (n_spectra, points) array of Q samples
+        :param scale: value to multiply the samples by
+        :param iq_corrector: an optional :class:`IQCorrector`, as for
+            :meth:`spectrum`
+        :param settings: a list of the *iq_corrector* keys for each row
+        :returns: a new (n_spectra, points) array of spectra in dB
+
+        The work arrays for the last number of spectra computed are
+        kept, so batches of the same size reuse them.
+        """
+        import numpy
+
+        shape = i_data.shape
+        if self._batch is None or self._batch[0].shape != shape:
+            self._batch = (numpy.empty(shape, dtype=self.dtype),
+                numpy.empty(shape, dtype=self.dtype),
+                numpy.empty(shape, dtype=self._iq.dtype),
+                numpy.empty(shape, dtype=self.dtype))
+        i, q, iq, power = self._batch
+
+        numpy.multiply(i_data, scale, out=i, casting='unsafe')
+        numpy.multiply(q_data, scale, out=q, casting='unsafe')
+        if iq_corrector is not None:
+            for row, setting in enumerate(settings):
+                iq_corrector.correct(i[row], q[row], setting, power[row])
+        else:
+            i -= i.mean(axis=1, dtype=numpy.float64)[:, numpy.newaxis]
+            q -= q.mean(axis=1, dtype=numpy.float64)[:, numpy.newaxis]
+
+            # phase and gain imbalance of each row, as in _calibrate_q
+            def row_dot(a, b):
+                return numpy.einsum('ij,ij->i', a, b, dtype=numpy.float64)
+            sum_of_squares_i = row_dot(i, i)
+            sum_of_squares_q = row_dot(q, q)
+            ratio = numpy.sqrt(sum_of_squares_i / sum_of_squares_q)
+            sinphi = ratio * row_dot(i, q) / sum_of_squares_i
+            phi_est = -numpy.arcsin(sinphi)
+            q *= (ratio / numpy.cos(phi_est))[:, numpy.newaxis]
+            numpy.multiply(i, numpy.tan(phi_est)[:, numpy.newaxis], out=power)
+            q += power
+
+        numpy.multiply(i, self.window, out=iq.real)
+        numpy.multiply(q, self.window, out=iq.imag)
+        numpy.abs(self._fft(iq, axis=1), out=power, casting='unsafe')
+        numpy.log10(power, out=power)
+        power *= 20
+
+        samples = self.points
+        half = samples // 2
+        out = numpy.empty(shape, dtype=self.dtype)
+        out[:, :half] = power[:, samples - half:]
+        out[:, half:] = power[:, :samples - half]
+        out[:, half] = (out[:, half - 1] + out[:, half + 1]) / 2
+        return out
+
+    def _calibrate_q(self, i, q):
+        "correct q in place for the phase and gain imbalance with i"
+        import numpy
+
+        samples = self.points
+        # accumulate in double precision, the float32 sums are too coarse
+        sum_of_squares_i = float(_dot(i, i))
+        sum_of_squares_q = float(_dot(q, q))
+
+        amplitude_squared = sum_of_squares_i * 2 / samples
+        ratio = math.sqrt(sum_of_squares_i / sum_of_squares_q)
+
+        sinphi = 2 * ratio * float(_dot(i, q)) / (
+            amplitude_squared * samples)
+        phi_est = -math.asin(sinphi)
+
+        q *= ratio / math.cos(phi_est)
+        numpy.multiply(i, math.tan(phi_est), out=self._scratch)
+        q += self._scratch
+
+    def _shifted_db(self, fft, out):
+        import numpy
+
+        power = self._power
+        numpy.abs(fft, out=power, casting='unsafe')
+        numpy.log10(power, out=power)
+        power *= 20
+
+        if out is None:
+            out = self._out
+        # fftshift into out
+        points = self.points
+        half = points // 2
+        out[:half] = power[points - half:]
+        out[half:] = power[:points - half]
+
+        out[half] = (out[half - 1] + out[half + 1]) / 2
+        return out
+
+
+class IQCorrector(object):
+    """
+    Remove the DC offsets of I and Q and the gain and phase imbalance
+    between them, with estimates kept for each capture setting and
+    smoothed over many packets.
+
+    :param interval: the number of packets between estimates for each
+        setting, the first packet with a new setting is always used
+    :param smoothing: the weight of each new estimate in the smoothed
+        estimate, 1 to use only the latest estimate
+
+    Correcting a packet without a new estimate costs a few in-place
+    array operations and no allocations.  Pass the corrector to
+    :func:`compute_fft` or :func:`compute_fft_batch`, which use the
+    frequency and gain from the packet context as the setting.
+    """
+    def __init__(self, interval=16, smoothing=0.25):
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing must be greater than 0 and at most 1")
+        self.interval = interval
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the estimates for all settings.
+        """
+        # {setting: [packets seen, estimate, coefficients]}
+        self._settings = {}
+
+    @staticmethod
+    def estimate(i_data, q_data):
+        """
+        Estimate the corrections for one packet of samples.
+
+        :returns: (dc_i, dc_q, ratio, phase), the mean of I and Q, the
+            ratio of the I and Q amplitudes and the phase error in
+            radians
+        """
+        import numpy
+
+        samples = len(i_data)
+        dc_i = float(i_data.mean(dtype=numpy.float64))
+        dc_q = float(q_data.mean(dtype=numpy.float64))
+        # sums of the products with the means removed
+        sum_of_squares_i = float(_dot(i_data, i_data)) - (
+            samples * dc_i * dc_i)
+        sum_of_squares_q = float(_dot(q_data, q_data)) - (
+            samples * dc_q * dc_q)
+        sum_of_products = float(_dot(i_data, q_data)) - (
+            samples * dc_i * dc_q)
+
+        ratio = math.sqrt(sum_of_squares_i / sum_of_squares_q)
+        phase = -math.asin(ratio * sum_of_products / sum_of_squares_i)
+        return (dc_i, dc_q, ratio, phase)
+
+    def estimates(self, setting):
+        """
+        :returns: the smoothed (dc_i, dc_q, ratio, phase) estimate for
+            *setting*, or None if no packets have been corrected with it
+        """
+        state = self._settings.get(setting)
+        if state is not None:
+            return state[1]
+
+    def correct(self, i, q, setting=None, scratch=None):
+        """
+        Correct one packet of samples in place.
+
+        :param i: a float array of I samples
+        :param q: a float array of Q samples
+        :param setting: a hashable key for the capture setting, e.g.
+            (frequency, gain)
+        :param scratch: an optional work array the size of *i*
+        """
+        import numpy
+
+        state = self._settings.get(setting)
+        if state is None:
+            state = self._settings[setting] = [0, None, None]
+        if not state[0] % self.interval:
+            new = self.estimate(i, q)
+            if state[1] is not None and self.smoothing < 1:
+                new = tuple(old + self.smoothing * (value - old)
+                    for old, value in zip(state[1], new))
+            state[1] = new
+            state[2] = self._coefficients(*new)
+        state[0] += 1
+
+        # i -= dc_i;  q = a * q + b * i + c
+        dc_i, a, b, c = state[2]
+        if scratch is None:
+            scratch = numpy.empty_like(i)
+        i -= dc_i
+        q *= a
+        q += c
+        numpy.multiply(i, b, out=scratch)
+        q += scratch
+
+    @staticmethod
+    def _coefficients(dc_i, dc_q, ratio, phase):
+        a = ratio / math.cos(phase)
+        return (dc_i, a, math.tan(phase), -a * dc_q)
+
+
+class SpectrumAccumulator(object):
+    """
+    Average the power spectra from :func:`compute_fft` and keep their
+    maximum and minimum values, for averaged and peak hold traces.
+
+    :param mode: how spectra are averaged: ``'rms'`` for the mean power
+        of every spectrum added, ``'exponential'`` for a running
+        average that weights each new spectrum by 1/*count* once
+        *count* spectra have been added, or ``'count'`` for the mean of
+        each group of *count* spectra
+    :param count: the number of spectra for the ``'exponential'`` and
+        ``'count'`` modes
+
+    Averages are computed from linear power, not dB values, and
+    converted back to dB only when a trace is read.  Memory use depends
+    only on the number of points in each spectrum, not on the number of
+    spectra added.
+
+    .. code-block:: python
+
+       acc = SpectrumAccumulator('exponential', count=8)
+       while True:
+           data, context = read_data_and_context(dut, 1024)
+           acc.add(compute_fft(dut, data, context))
+           plot(acc.average(), acc.max_hold())
+    """
+    MODES = ('rms', 'exponential', 'count')
+
+    def __init__(self, mode='rms', count=10):
+        if mode not in self.MODES:
+            raise ValueError("mode must be one of %s" % (self.MODES,))
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        self.mode = mode
+        self.count = count
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the average and the hold traces.
+        """
+        self.spectra = 0
+        self._averaged = 0
+        self._average = None
+        self._completed = None
+        self._max = None
+        self._min = None
+        self._linear = None
+
+    def add(self, power_spectrum):
+        """
+        Add one power spectrum in dB, or an (n_spectra, points) array of
+        them as returned by :func:`compute_fft_batch`.
+        """
+        import numpy
+
+        power_spectrum = numpy.asarray(power_spectrum)
+        if power_spectrum.ndim == 2:
+            for row in power_spectrum:
+                self.add(row)
+            return
 
-    power_spectrum = numpy.fft.fftshift(numpy.fft.fft(windowed_i))
-    power_spectrum = 20 * numpy.log10(numpy.abs(power_spectrum))
+        if self._linear is None or len(self._linear) != len(power_spectrum):
+            self._allocate(len(power_spectrum))
+        linear = self._linear
+        numpy.multiply(power_spectrum, 0.1, out=linear)
+        numpy.power(10.0, linear, out=linear)
 
-    median_index = len(fft_result) // 2
-    return fft_result[median_index+1:]
+        if self.spectra:
+            numpy.maximum(self._max, linear, out=self._max)
+            numpy.minimum(self._min, linear, out=self._min)
+        else:
+            self._max[...] = linear
+            self._min[...] = linear
+        self.spectra += 1
 
-def _calibrate_i_q(i_data, q_data):
-    samples = len(i_data)
+        self._averaged += 1
+        if self.mode == 'count' and self._averaged > self.count:
+            # start the next group of spectra
+            self._averaged = 1
+        if self._averaged == 1:
+            self._average[...] = linear
+        else:
+            # running mean, the exponential weight stops at 1/count
+            weight = 1.0 / self._averaged
+            if self.mode == 'exponential':
+                weight = max(weight, 1.0 / self.count)
+            linear -= self._average
+            linear *= weight
+            self._average += linear
+        if self.mode == 'count' and self._averaged == self.count:
+            self._completed[...] = self._average
 
-    sum_of_squares_i = sum(i_data ** 2)
-    sum_of_squares_q = sum(q_data ** 2)
+    def _allocate(self, points):
+        import numpy
 
-    amplitude = math.sqrt(sum_of_squares_i * 2 / samples)
-    ratio = math.sqrt(sum_of_squares_i / sum_of_squares_q)
+        self.reset()
+        self._linear = numpy.empty(points)
+        self._average = numpy.zeros(points)
+        self._completed = numpy.zeros(points)
+        self._max = numpy.empty(points)
+        self._min = numpy.empty(points)
 
-    p = (q_data / amplitude) * ratio * (i_data / amplitude)
+    def _to_db(self, linear):
+        import numpy
 
-    sinphi = 2 * sum(p) / samples
-    phi_est = -math.asin(sinphi)
+        if not self.spectra:
+            return None
+        return 10 * numpy.log10(linear)
 
-    return (math.sin(phi_est) * i_data + ratio * q_data) / math.cos(phi_est)
+    def average(self):
+        """
+        :returns: the average power spectrum in dB, or None if no
+            spectra have been added.  In ``'count'`` mode this is the
+            average of the last complete group of *count* spectra, or
+            of the spectra added so far until the first group is
+            complete.
+        """
+        if self.mode == 'count' and self.spectra >= self.count:
+            return self._to_db(self._completed)
+        return self._to_db(self._average)
 
+    def max_hold(self):
+        """
+        :returns: the largest value of each point in dB, or None if no
+            spectra have been added
+        """
+        return self._to_db(self._max)
 
+    def min_hold(self):
+        """
+        :returns: the smallest value of each point in dB, or None if no
+            spectra have been added
+        """
+        return self._to_db(self._min)
@@ -0,0 +1,501 @@
+"""
+Recording VRT streams to disk and reading them back.
+
+A recording is simply the raw bytes received on the VRT connection,
+written back-to-back to a file.  :class:`VRTRecorder` writes recordings
+from a live connection and :class:`VRTRecording` memory-maps a
+recording and keeps an index of packet headers in a sidecar file so
+that packets may be accessed by position or timestamp without parsing
+or reading the whole recording.
+"""
+
+import os
+import mmap
+import struct
+import bisect
+import time
+import select
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from pyrf.vrt_stream import (decode_headers, headers_at, frame_packets,
+    packet_from_header, payload_view, HEADER_FIELDS, MAX_PACKET_BYTES,
+    TimeIndex)
+from pyrf.vrt import VRTDATA, InvalidDataReceived
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 2
+
+# headers written by VRTRecorder as it records, as raw HEADER_FIELDS records
+HEADERS_SUFFIX = '.headers'
+
+
+class VRTRecording(object):
+    """
+    A memory-mapped recording of a VRT stream.
+
+    :param filename: the recording to open
+    :param index_filename: sidecar index file to use, defaults to
+        *filename* with ``.index`` appended
+    :param rebuild_index: True to ignore any existing index file
+
+    The index is built the first time a recording is opened and saved
+    next to the recording, later opens load it instead of scanning the
+    file.  An index for a recording that has grown since it was written
+    is extended with only the new packets.  The index is rebuilt when the
+    recording's size or modification time has changed and its first and
+    last indexed packet headers no longer match the recording.
+
+    .. code-block:: python
+
+       rec = VRTRecording('capture.vrt')
+       print len(rec), 'packets'
+       pkt = rec[10]
+       iq = rec.payload(rec.data_indexes()[0])
+    """
+    def __init__(self, filename, index_filename=None, rebuild_index=False):
+        self.filename = filename
+        if index_filename is None:
+            index_filename = filename + INDEX_SUFFIX
+        self.index_filename = index_filename
+        self._file = open(filename, 'rb')
+        self._map = None
+        self._size = 0
+        self.headers = None
+        self._indexed_end = 0
+        self._time_index = None
+        self._map_file()
+        if not rebuild_index:
+            self._load_index()
+        self.refresh()
+
+    def _load_index(self):
+        import numpy # import here so docstrings are visible even without numpy
+
+        try:
+            index = numpy.load(self.index_filename)
+        except (IOError, ValueError):
+            self._load_recorder_headers()
+            return
+        try:
+            if int(index['version']) != INDEX_VERSION:
+                return
+            headers = index['headers']
+            indexed_end = int(index['indexed_end'])
+            stat = (int(index['file_size']), float(index['file_mtime']))
+        finally:
+            index.close()
+        if stat != self._file_stat() and not self._headers_match(
+                headers, indexed_end):
+            # recording was replaced or rewritten since it was indexed
+            return
+        self.headers = headers
+        self._indexed_end = indexed_end
+
+    def _load_recorder_headers(self):
+        import numpy
+
+        try:
+            headers = numpy.fromfile(self.filename + HEADERS_SUFFIX,
+                dtype=HEADER_FIELDS)
+        except (IOError, ValueError):
+            return
+        if not len(headers):
+            return
+        last = headers[-1]
+        indexed_end = int(last['offset']) + int(last['size']) * 4
+        if not self._headers_match(headers, indexed_end):
+            return
+        self.headers = headers
+        self._indexed_end = indexed_end
+
+    def _file_stat(self):
+        st = os.fstat(self._file.fileno())
+        return st.st_size, st.st_mtime
+
+    def _headers_match(self, headers, indexed_end):
+        """
+        Check that the first and last packets indexed are still in the
+        recording, so an index is not used for a different file.
+        """
+        if indexed_end > self._size:
+            return False
+        if not len(headers):
+            return True
+        ends = headers[[0, -1]]
+        try:
+            found = headers_at(self._map, [int(h) for h in ends['offset']])
+        except (ValueError, struct.error):
+            return False
+        return bool((found == ends).all())
+
+    def _save_index(self):
+        import numpy
+
+        size, mtime = self._file_stat()
+        tmp = self.index_filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            numpy.savez(f, version=INDEX_VERSION, headers=self.headers,
+                indexed_end=self._indexed_end, file_size=size,
+                file_mtime=mtime)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(self.index_filename):
+            os.remove(self.index_filename)
+        os.rename(tmp, self.index_filename)
+
+    def refresh(self):
+        """
+        Map any data appended to the recording since it was opened and
+        add its complete packets to the index.
+
+        :returns: the number of new packets indexed
+        """
+        import numpy
+
+        self._map_file()
+        if self.headers is None:
+            self.headers, self._indexed_end = decode_headers(self._buffer())
+            self._save_index()
+            return len(self.headers)
+
+        if self._indexed_end == self._size:
+            return 0
+        new, end = decode_headers(self._buffer(), self._indexed_end)
+        if not len(new):
+            return 0
+        self.headers = numpy.concatenate((self.headers, new))
+        self._indexed_end = end
+        self._time_index = None
+        self._save_index()
+        return len(new)
+
+    def _map_file(self):
+        size = os.path.getsize(self.filename)
+        if size != self._size:
+            # the old map is not closed, payload arrays may still view
+            # it and it is unmapped once the last of them is released
+            self._map = None
+            if size:
+                self._map = mmap.mmap(self._file.fileno(), size,
+                    access=mmap.ACCESS_READ)
+            self._size = size
+
+    def _buffer(self):
+        if self._map is None:
+            return b''
+        return self._map
+
+    def close(self):
+        """
+        Close the recording.  The index remains available, and arrays
+        returned by :meth:`payload` stay valid: the memory map is only
+        released once none of them refer to it.
+        """
+        self._map = None
+        self._file.close()
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, n):
+        return self.packet(n)
+
+    def __iter__(self):
+        for n in range(len(self.headers)):
+            yield self.packet(n)
+
+    def packet(self, n):
+        """
+        Read one packet from the recording.
+
+        :param n: the packet index
+        :returns: a :class:`pyrf.vrt.DataPacket` or
+            :class:`pyrf.vrt.ContextPacket`
+        """
+        return packet_from_header(self._map, self.headers[n])
+
+    def payload(self, n):
+        """
+        Return the I, Q values of one data packet without copying them
+        out of the recording.
+
+        :param n: the packet index of a data packet
+        :returns: an (N, 2) int16 NumPy array backed by the memory map,
+            it keeps the map open after :meth:`refresh` or :meth:`close`
+        """
+        header = self.headers[n]
+        if header['ptype'] != VRTDATA:
+            raise ValueError("packet %d is not a data packet" % n)
+        return payload_view(self._map, header)
+
+    def data_indexes(self):
+        """
+        :returns: an array of the indexes of all data packets
+        """
+        import numpy
+
+        return numpy.flatnonzero(self.headers['ptype'] == VRTDATA)
+
+    def time_index(self):
+        """
+        :returns: a :class:`pyrf.vrt_stream.TimeIndex` of all the packets
+            indexed, built on first use
+        """
+        if self._time_index is None:
+            self._time_index = TimeIndex(self.headers)
+        return self._time_index
+
+    def time_range(self, start=None, stop=None):
+        """
+        Find the packets with timestamps in a range, compared at full
+        picosecond resolution.
+
+        :param start: (tsi, tsf) of the first timestamp to include or
+            None for no lower bound
+        :param stop: (tsi, tsf) of the first timestamp to exclude or
+            None for no upper bound
+        :returns: an array of packet indexes
+        """
+        return self.time_index().find_timestamps(start, stop)
+
+
+class VRTRecorder(object):
+    """
+    Record the raw VRT stream from a socket to a series of files.
+
+    :param sock: the connected VRT socket, e.g. from
+        :meth:`pyrf.connectors.blocking.PlainSocketConnector.vrt_socket`
+    :param basename: path and file name prefix for the recordings,
+        files are named ``<basename>-0000.vrt``, ``<basename>-0001.vrt``
+        and so on
+    :param max_file_size: start a new file before exceeding this many bytes
+    :param chunk_size: size of each socket read buffer in bytes
+    :param queue_chunks: number of full buffers that may wait for the
+        writer thread before received data is dropped
+
+    A reader thread drains the socket into large buffers and hands them
+    to a writer thread.  The only per-packet work on the reader thread
+    is finding packet boundaries, so buffers always hold whole packets:
+    every file is a valid recording on its own, and if the writer falls
+    behind whole buffers of packets are dropped and counted.
+
+    Along with each recording the writer saves the packet headers in a
+    ``.headers`` file that :class:`VRTRecording` uses as its index.
+
+    .. code-block:: python
+
+       recorder = VRTRecorder(dut.connector.vrt_socket(), 'capture')
+       recorder.start()
+       dut.capture(1024, 1000)
+       ...
+       recorder.stop()
+       print recorder.stats()
+    """
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, sock, basename, max_file_size=2**30,
+            chunk_size=2**22, queue_chunks=16):
+        if chunk_size < 2 * MAX_PACKET_BYTES:
+            raise ValueError("chunk_size must be at least %d bytes"
+                % (2 * MAX_PACKET_BYTES))
+        self._sock = sock
+        self.basename = basename
+        self.max_file_size = max_file_size
+        self.chunk_size = chunk_size
+        self.filenames = []
+
+        self._full = queue.Queue()
+        self._free = queue.Queue()
+        for i in range(queue_chunks + 1):
+            self._free.put(bytearray(chunk_size))
+
+        self._running = False
+        self._threads = []
+        self._file = None
+        self._headers_file = None
+        self._file_size = 0
+
+        self._start_time = None
+        self._stop_time = None
+        self.bytes_received = 0
+        self.bytes_written = 0
+        self.packets_written = 0
+        self.dropped_bytes = 0
+        self.dropped_packets = 0
+        self.error = None
+
+    def start(self):
+        """
+        Start the reader and writer threads.
+        """
+        self._running = True
+        self._start_time = time.time()
+        self._threads = [
+            threading.Thread(target=self._read_loop, name='VRTRecorder-read'),
+            threading.Thread(target=self._write_loop, name='VRTRecorder-write'),
+            ]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        """
+        Stop reading, wait for all received packets to be written and
+        close the current file.
+
+        :raises: the exception that stopped the reader thread early, e.g.
+            :class:`pyrf.vrt.InvalidDataReceived` if the stream was
+            corrupt.  The packets received before it are still written.
+        """
+        self._running = False
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._stop_time = time.time()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """
+        :returns: a dict of counters: bytes_received, bytes_written,
+            packets_written, dropped_bytes, dropped_packets, files,
+            elapsed (seconds), throughput (bytes written per second) and
+            error, the exception that stopped the reader thread or None
+        """
+        elapsed = 0.0
+        if self._start_time is not None:
+            elapsed = (self._stop_time or time.time()) - self._start_time
+        return {
+            'bytes_received': self.bytes_received,
+            'bytes_written': self.bytes_written,
+            'packets_written': self.packets_written,
+            'dropped_bytes': self.dropped_bytes,
+            'dropped_packets': self.dropped_packets,
+            'files': len(self.filenames),
+            'elapsed': elapsed,
+            'throughput': self.bytes_written / elapsed if elapsed else 0.0,
+            'error': self.error,
+            }
+
+    def _read_loop(self):
+        try:
+            self._read_until_stopped()
+        except Exception as e:
+            # kept for stop() to raise, the thread would only print it
+            self.error = e
+        finally:
+            self._full.put(None)
+
+    def _read_until_stopped(self):
+        buf = self._free.get()
+        view = memoryview(buf)
+        filled = framed = 0
+        offsets = []
+        while self._running:
+            readable, _, _ = select.select([self._sock], [], [],
+                self.POLL_INTERVAL)
+            if not readable:
+                continue
+            space = self.chunk_size - filled
+            received = self._sock.recv_into(view[filled:], space)
+            if not received:
+                break
+            filled += received
+            self.bytes_received += received
+
+            try:
+                new_offsets, framed = frame_packets(buf, framed, filled)
+            except InvalidDataReceived as e:
+                # write the packets received before the corrupt data
+                new_offsets, framed = e.framed
+                offsets.extend(new_offsets)
+                if offsets:
+                    self._full.put((buf, framed, offsets))
+                raise
+            offsets.extend(new_offsets)
+            # keep filling while the writer is busy and a packet still fits
+            if not offsets or (not self._full.empty()
+                    and filled + MAX_PACKET_BYTES <= self.chunk_size):
+                continue
+
+            try:
+                next_buf = self._free.get_nowait()
+            except queue.Empty:
+                # writer has fallen behind, drop these packets
+                self.dropped_bytes += framed
+                self.dropped_packets += len(offsets)
+                next_buf = buf
+            else:
+                self._full.put((buf, framed, offsets))
+            tail = filled - framed
+            next_buf[:tail] = buf[framed:filled]
+            buf = next_buf
+            view = memoryview(buf)
+            filled = tail
+            framed = 0
+            offsets = []
+
+        if offsets:
+            self._full.put((buf, framed, offsets))
+
+    def _write_loop(self):
+        try:
+            while True:
+                item = self._full.get()
+                if item is None:
+                    break
+                buf, end, offsets = item
+                self._write_chunk(buf, end, offsets)
+                self._free.put(buf)
+        finally:
+            self._close_file()
+
+    def _write_chunk(self, buf, end, offsets):
+        ends = offsets[1:] + [end]
+        first = 0
+        while first < len(offsets):
+            if self._file is None:
+                self._open_next_file()
+            start = offsets[first]
+            # whole packets that fit in the current file
+            last = bisect.bisect_right(ends,
+                start + self.max_file_size - self._file_size, first)
+            if last == first:
+                if self._file_size:
+                    self._open_next_file()
+                    continue
+                last = first + 1
+            self._write_packets(buf, offsets[first:last], ends[last - 1])
+            first = last
+
+    def _write_packets(self, buf, offsets, end):
+        start = offsets[0]
+        headers = headers_at(buf, offsets)
+        shift = self._file_size - start
+        headers['offset'] += shift
+        headers['payload_offset'] += shift
+        self._file.write(memoryview(buf)[start:end])
+        headers.tofile(self._headers_file)
+        self._file_size += end - start
+        self.bytes_written += end - start
+        self.packets_written += len(offsets)
+
+    def _open_next_file(self):
+        self._close_file()
+        filename = '%s-%04d.vrt' % (self.basename, len(self.filenames))
+        self._file = open(filename, 'wb')
+        self._headers_file = open(filename + HEADERS_SUFFIX, 'wb')
+        self._file_size = 0
+        self.filenames.append(filename)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._headers_file.close()
+        self._file = self._headers_file = None
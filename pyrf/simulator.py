@@ -0,0 +1,517 @@
+"""
+A simulated WSA4000 that serves SCPI and VRT connections over TCP,
+for testing and benchmarking pyrf without hardware.
+
+Run it with ``python -m pyrf.simulator`` or ``wsa4000sim``, then connect
+to it like a real device:
+
+.. code-block:: python
+
+   dut = WSA4000()
+   dut.connect('127.0.0.1')
+
+Or start one from a test:
+
+.. code-block:: python
+
+   sim = WSA4000Simulator(packet_rate=1000)
+   sim.start()
+   ...
+   sim.stop()
+"""
+
+import math
+import random
+import select
+import socket
+import struct
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from pyrf.connectors.base import SCPI_PORT, VRT_PORT
+from pyrf.vrt import (VRTCONTEXT, VRTCUSTOMCONTEXT, VRTDATA, VRTRECEIVER,
+    VRTDIGITIZER, VRTCUSTOM, CTX_RFFREQ, CTX_GAIN, CTX_BANDWIDTH,
+    CTX_RFOFFSET, CTX_REFERENCELEVEL, CTX_STREAMSTART)
+
+import logging
+logger = logging.getLogger(__name__)
+
+VRTIFDATA = 0x90000003
+
+DEVICE_FULL_SPAN = 125e6
+REFERENCE_LEVEL = -10.0
+
+# SCPI setting: (name, parse, format)
+SETTINGS = {
+    'FREQ:CENTER': ('freq', lambda v: int(float(v)), '%d'),
+    'FREQ:SHIFT': ('fshift', lambda v: int(float(v)), '%d'),
+    'SENSE:DECIMATION': ('decimation', int, '%d'),
+    'INPUT:GAIN:RF': ('gain', lambda v: v.upper(), '%s'),
+    'INPUT:GAIN:IF': ('ifgain', int, '%d'),
+    'INPUT:FILTER:PRESELECT': ('preselect', int, '%d'),
+    'INPUT:ANTENNA': ('antenna', int, '%d'),
+    'TRIGGER:TYPE': ('trigtype', lambda v: v.upper(), '%s'),
+    'TRIGGER:LEVEL': ('triglevel', lambda v: v.replace(' ', ''), '%s'),
+    'TRACE:SPP': ('spp', int, '%d'),
+    'TRACE:BLOCK:PACKETS': ('ppb', int, '%d'),
+    }
+
+DEFAULT_SETTINGS = {
+    'freq': 2400000000,
+    'fshift': 0,
+    'decimation': 1,
+    'gain': 'HIGH',
+    'ifgain': 0,
+    'preselect': 1,
+    'antenna': 1,
+    'trigtype': 'NONE',
+    'triglevel': '50000000,10000000000,-100',
+    'spp': 1024,
+    'ppb': 1,
+    }
+
+# sweep entry fields in the order returned by :sweep:entry:read?
+SWEEP_ENTRY_FIELDS = ['fstart', 'fstop', 'fstep', 'fshift', 'decimation',
+    'antenna', 'gain', 'ifgain', 'spp', 'ppb', 'dwell_s', 'dwell_us',
+    'trigtype', 'level_fstart', 'level_fstop', 'level_amplitude']
+
+DEFAULT_SWEEP_ENTRY = {
+    'fstart': 2400000000, 'fstop': 2400000000, 'fstep': 100000000,
+    'fshift': 0, 'decimation': 0, 'antenna': 1, 'gain': 'VLOW',
+    'ifgain': 0, 'spp': 1024, 'ppb': 1, 'dwell_s': 0, 'dwell_us': 0,
+    'trigtype': 'NONE', 'level_fstart': 50000000,
+    'level_fstop': 10000000000, 'level_amplitude': -100,
+    }
+
+# :sweep:entry: setting: sweep entry fields
+SWEEP_ENTRY_SETTINGS = {
+    'FREQ:CENTER': ('fstart', 'fstop'),
+    'FREQ:STEP': ('fstep',),
+    'FREQ:SHIFT': ('fshift',),
+    'DECIMATION': ('decimation',),
+    'ANTENNA': ('antenna',),
+    'GAIN:RF': ('gain',),
+    'GAIN:IF': ('ifgain',),
+    'SPP': ('spp',),
+    'PPB': ('ppb',),
+    'TRIGGER:TYPE': ('trigtype',),
+    'TRIGGER:LEVEL': ('level_fstart', 'level_fstop', 'level_amplitude'),
+    }
+
+
+def tone_signal(tone_freq=2.45e9, tone_level=0.5, noise_level=0.001):
+    """
+    Return a signal function for :class:`WSA4000Simulator` with a single
+    tone and gaussian noise.
+
+    :param tone_freq: the tone frequency in Hz, only visible when within
+        the span of the capture
+    :param tone_level: the tone amplitude as a fraction of full scale
+    :param noise_level: the noise RMS amplitude as a fraction of full scale
+    """
+    def signal(center_freq, sample_rate, spp):
+        full_scale = 2 ** 13 - 1
+        offset = tone_freq - center_freq
+        if abs(offset) >= sample_rate / 2:
+            amplitude = 0
+        else:
+            amplitude = tone_level * full_scale
+        noise = noise_level * full_scale
+        step = 2 * math.pi * offset / sample_rate
+        samples = []
+        for n in range(spp):
+            i = amplitude * math.cos(step * n) + random.gauss(0, noise)
+            q = amplitude * math.sin(step * n) + random.gauss(0, noise)
+            samples.append((
+                max(-full_scale, min(full_scale, int(round(i)))),
+                max(-full_scale, min(full_scale, int(round(q))))))
+        return samples
+    return signal
+
+
+class WSA4000Simulator(object):
+    """
+    Serve the WSA4000 SCPI commands used by
+    :class:`WSA4000 <pyrf.devices.thinkrf.WSA4000>` and stream synthetic
+    VRT context and data packets for block captures and sweeps.
+
+    :param host: the address to listen on
+    :param scpi_port: the SCPI port to listen on
+    :param vrt_port: the VRT port to listen on
+    :param packet_rate: the most data packets to send per second, None
+        to send them as fast as the connection allows
+    :param signal: a function called with the center frequency, sample
+        rate and samples per packet that returns a list of (i, q) sample
+        values for a packet, defaults to :func:`tone_signal`
+
+    Any number of SCPI connections may be made.  Packets are sent to the
+    most recent VRT connection.  The packet payload for each setting is
+    generated once and repeated with new headers so the simulator can
+    keep up with a fast client.
+    """
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, host='127.0.0.1', scpi_port=SCPI_PORT,
+            vrt_port=VRT_PORT, packet_rate=None, signal=None):
+        self.host = host
+        self.scpi_port = scpi_port
+        self.vrt_port = vrt_port
+        self.packet_rate = packet_rate
+        self.signal = signal or tone_signal()
+
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.sweep_entries = []
+        self._new_entry = None
+        self._lock_owner = None
+        self._sweeping = False
+
+        self._running = False
+        self._threads = []
+        self._listeners = []
+        self._vrt_client = None
+        self._vrt_connected = threading.Event()
+        self._captures = queue.Queue()
+        self._payloads = {}
+        self._counts = {}
+        self._next_packet_time = None
+        self._clock = None
+
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        """
+        Start listening and serving connections.
+        """
+        scpi = self._listen(self.scpi_port)
+        vrt = self._listen(self.vrt_port)
+        self._listeners = [scpi, vrt]
+        self.scpi_port = scpi.getsockname()[1]
+        self.vrt_port = vrt.getsockname()[1]
+        self._running = True
+        self._threads = []
+        for target, name in [(self._accept_loop, 'accept'),
+                (self._stream_loop, 'stream')]:
+            self._start_thread(target, 'WSA4000Simulator-' + name)
+
+    def stop(self):
+        """
+        Stop serving and close all connections.
+        """
+        self._running = False
+        for t in list(self._threads):
+            t.join()
+        for sock in self._listeners:
+            sock.close()
+        self._listeners = []
+        self._close_vrt_client()
+
+    def _close_vrt_client(self):
+        self._vrt_connected.clear()
+        if self._vrt_client:
+            self._vrt_client.close()
+        self._vrt_client = None
+
+    def _start_thread(self, target, name, *args):
+        t = threading.Thread(target=target, name=name, args=args)
+        t.daemon = True
+        t.start()
+        # forget the threads of connections that have closed
+        self._threads = [old for old in self._threads if old.is_alive()]
+        self._threads.append(t)
+
+    def _listen(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, port))
+        sock.listen(5)
+        return sock
+
+    def _accept_loop(self):
+        scpi, vrt = self._listeners
+        while self._running:
+            readable, _, _ = select.select(self._listeners, [], [],
+                self.POLL_INTERVAL)
+            if scpi in readable:
+                client, addr = scpi.accept()
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+                self._start_thread(self._scpi_loop, 'WSA4000Simulator-scpi',
+                    client)
+            if vrt in readable:
+                client, addr = vrt.accept()
+                if self._vrt_client:
+                    self._vrt_client.close()
+                self._vrt_client = client
+                self._vrt_connected.set()
+
+    def _scpi_loop(self, client):
+        received = b''
+        try:
+            while self._running:
+                readable, _, _ = select.select([client], [], [],
+                    self.POLL_INTERVAL)
+                if not readable:
+                    continue
+                data = client.recv(4096)
+                if not data:
+                    break
+                received += data
+                lines = received.split(b'\n')
+                received = lines.pop()
+                responses = []
+                for line in lines:
+                    response = self.scpi(line.decode('ascii'), client)
+                    if response is not None:
+                        responses.append("%s\n" % response)
+                if responses:
+                    client.sendall(''.join(responses).encode('ascii'))
+        except socket.error as e:
+            logger.debug('SCPI connection error: %s', e)
+        finally:
+            if self._lock_owner is client:
+                self._lock_owner = None
+            client.close()
+
+    def scpi(self, line, client=None):
+        """
+        Process one SCPI command.
+
+        :param line: the command received
+        :param client: the connection it was received on, used to track
+            the acquisition lock
+        :returns: the response to send, or None for commands that don't
+            respond
+        """
+        line = line.strip().lstrip(':')
+        if not line:
+            return None
+        header, _, args = line.partition(' ')
+        header = header.upper()
+        args = args.strip()
+        query = header.endswith('?')
+        header = header.rstrip('?')
+
+        if header == '*IDN':
+            return "ThinkRF,WSA4000,SIM000000,pyrf simulator"
+        if header == '*RST':
+            self.settings = dict(DEFAULT_SETTINGS)
+            return None
+        if header in SETTINGS:
+            name, parse, format = SETTINGS[header]
+            if query:
+                return format % self.settings[name]
+            self.settings[name] = parse(args)
+            return None
+        if header == 'TRACE:BLOCK:DATA':
+            s = self.settings
+            self._captures.put(('block', dict(s), s['spp'], s['ppb']))
+            return None
+        if header == 'SYSTEM:LOCK:REQUEST':
+            if self._lock_owner is None:
+                self._lock_owner = client
+            return "1" if self._lock_owner is client else "0"
+        if header == 'SYSTEM:LOCK:HAVE':
+            return "1" if self._lock_owner is client else "0"
+        if header in ('SENSE:LOCK:RF', 'SENSE:LOCK:REFERENCE'):
+            return "1"
+        if header.startswith('SWEEP:'):
+            return self._sweep_command(header[len('SWEEP:'):], args, query)
+
+        logger.warning('unsupported SCPI command %r', line)
+        if query:
+            return ""
+        return None
+
+    def _sweep_command(self, header, args, query):
+        if header == 'ENTRY:NEW':
+            self._new_entry = dict(DEFAULT_SWEEP_ENTRY)
+        elif header == 'ENTRY:SAVE':
+            if self._new_entry:
+                self.sweep_entries.append(self._new_entry)
+            self._new_entry = None
+        elif header == 'ENTRY:DEL':
+            self.sweep_entries = []
+        elif header == 'ENTRY:READ' and query:
+            entry = self.sweep_entries[int(args) - 1]
+            values = [str(entry[f]) for f in SWEEP_ENTRY_FIELDS]
+            if entry['trigtype'] == 'NONE':
+                values = values[:13]
+            return ",".join(values)
+        elif header.startswith('ENTRY:'):
+            fields = SWEEP_ENTRY_SETTINGS.get(header[len('ENTRY:'):])
+            if fields and self._new_entry is not None:
+                values = [v.strip() for v in args.split(',')]
+                for field, value in zip(fields, values):
+                    if field in ('gain', 'trigtype'):
+                        value = value.upper()
+                    else:
+                        value = int(float(value))
+                    self._new_entry[field] = value
+        elif header == 'LIST:START':
+            self._sweeping = True
+            start_id = int(args) if args else None
+            self._captures.put(('sweep', start_id))
+        elif header == 'LIST:STOP':
+            self._sweeping = False
+        elif header == 'FLUSH':
+            pass
+        if query:
+            return ""
+        return None
+
+    def _stream_loop(self):
+        while self._running:
+            try:
+                job = self._captures.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            try:
+                if job[0] == 'block':
+                    self._send_capture(*job[1:])
+                else:
+                    self._send_sweep(*job[1:])
+            except socket.error as e:
+                logger.debug('VRT connection error: %s', e)
+                self._close_vrt_client()
+
+    def _send_sweep(self, start_id):
+        if start_id is not None:
+            self._send(self._custom_context(start_id))
+        while self._running and self._sweeping and self.sweep_entries:
+            if self._vrt_client is None:
+                # nobody to send to, wait for a VRT connection
+                self._vrt_connected.wait(self.POLL_INTERVAL)
+                continue
+            for entry in list(self.sweep_entries):
+                freq = entry['fstart']
+                while freq <= entry['fstop'] and self._sweeping:
+                    settings = dict(self.settings, freq=freq,
+                        fshift=entry['fshift'],
+                        decimation=entry['decimation'],
+                        antenna=entry['antenna'], gain=entry['gain'],
+                        ifgain=entry['ifgain'])
+                    self._send_capture(settings, entry['spp'], entry['ppb'])
+                    if entry['fstep'] <= 0:
+                        break
+                    freq += entry['fstep']
+
+    def _send_capture(self, settings, spp, ppb):
+        decimation = max(1, settings['decimation'])
+        sample_rate = DEVICE_FULL_SPAN / decimation
+        self._send(self._receiver_context(settings))
+        self._send(self._digitizer_context(sample_rate))
+        payload = self._payload(settings['freq'], sample_rate, spp)
+        for n in range(ppb):
+            if not self._running:
+                return
+            self._wait_for_rate()
+            self._send(self._data_packet(payload, spp / sample_rate))
+
+    def _wait_for_rate(self):
+        if not self.packet_rate:
+            return
+        now = time.time()
+        if self._next_packet_time is None or self._next_packet_time < now:
+            self._next_packet_time = now
+        elif self._next_packet_time > now:
+            time.sleep(self._next_packet_time - now)
+        self._next_packet_time += 1.0 / self.packet_rate
+
+    def _payload(self, freq, sample_rate, spp):
+        key = (freq, sample_rate, spp)
+        if key not in self._payloads:
+            samples = self.signal(freq, sample_rate, spp)
+            self._payloads[key] = struct.pack(">%dh" % (2 * spp),
+                *[v for iq in samples for v in iq])
+        return self._payloads[key]
+
+    def _timestamp(self, advance=0):
+        "returns (tsi, tsf) of the simulated sample clock"
+        if self._clock is None:
+            self._clock = time.time()
+        now = self._clock
+        self._clock += advance
+        tsi = int(now)
+        return tsi, int(round((now - tsi) * 10 ** 12)) % 10 ** 12
+
+    def _count(self, stream_id):
+        count = self._counts.get(stream_id, 0)
+        self._counts[stream_id] = (count + 1) % 16
+        return count
+
+    def _context(self, ptype, stream_id, indicators, fields):
+        tsi, tsf = self._timestamp()
+        body = struct.pack(">IIQI", stream_id, tsi, tsf, indicators) + fields
+        size = 1 + len(body) // 4
+        return struct.pack(">I", (ptype << 28)
+            | (self._count(stream_id) << 16) | size) + body
+
+    def _receiver_context(self, settings):
+        gain = {'HIGH': 25.0, 'MEDIUM': 15.0, 'LOW': 5.0, 'VLOW': -5.0}.get(
+            settings['gain'], 0.0)
+        fields = struct.pack(">Qhh", int(settings['freq'] * 2 ** 20),
+            int(gain * 2 ** 7), int(settings['ifgain'] * 2 ** 7))
+        return self._context(VRTCONTEXT, VRTRECEIVER, CTX_RFFREQ | CTX_GAIN,
+            fields)
+
+    def _digitizer_context(self, sample_rate):
+        fields = struct.pack(">Qqhh", int(sample_rate / 2 * 2 ** 20), 0,
+            0, int(REFERENCE_LEVEL * 2 ** 7))
+        return self._context(VRTCONTEXT, VRTDIGITIZER,
+            CTX_BANDWIDTH | CTX_RFOFFSET | CTX_REFERENCELEVEL, fields)
+
+    def _custom_context(self, start_id):
+        return self._context(VRTCUSTOMCONTEXT, VRTCUSTOM, CTX_STREAMSTART,
+            struct.pack(">I", start_id))
+
+    def _data_packet(self, payload, duration):
+        tsi, tsf = self._timestamp(duration)
+        size = 5 + len(payload) // 4 + 1
+        return (struct.pack(">IIIQ", (VRTDATA << 28)
+                | (self._count(VRTIFDATA) << 16) | size,
+                VRTIFDATA, tsi, tsf)
+            + payload + struct.pack(">I", 0))
+
+    def _send(self, packet):
+        client = self._vrt_client
+        if client is None:
+            return
+        client.sendall(packet)
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(description="Simulate a WSA4000 for testing.")
+    parser.add_option('--host', default='127.0.0.1',
+        help="address to listen on [%default]")
+    parser.add_option('--packet-rate', type='float', default=None,
+        help="maximum data packets per second [unlimited]")
+    parser.add_option('--tone-freq', type='float', default=2.45e9,
+        help="tone frequency in Hz [%default]")
+    parser.add_option('--tone-level', type='float', default=0.5,
+        help="tone amplitude as a fraction of full scale [%default]")
+    parser.add_option('--noise-level', type='float', default=0.001,
+        help="noise amplitude as a fraction of full scale [%default]")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = WSA4000Simulator(options.host, packet_rate=options.packet_rate,
+        signal=tone_signal(options.tone_freq, options.tone_level,
+            options.noise_level))
+    sim.start()
+    logger.info('simulating WSA4000 on %s', options.host)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+if __name__ == '__main__':
+    main()
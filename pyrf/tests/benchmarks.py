@@ -0,0 +1,381 @@
+"""
+Throughput and latency benchmarks for pyrf.
+
+Run with::
+
+    python -m pyrf.tests.benchmarks -o results.json
+
+Results are printed and, with ``-o``, saved as JSON so runs from
+different releases may be compared.  The end-to-end benchmarks start a
+:class:`WSA4000Simulator <pyrf.simulator.WSA4000Simulator>` on the
+loopback interface unless ``--host`` names a device or simulator to use
+instead.  This module is not named ``test_*`` so it isn't run with the
+unit tests.
+"""
+
+import json
+import platform
+import struct
+import sys
+import time
+
+from pyrf.vrt import vrt_packet_reader, parse_packet
+from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+SPP_RANGE = [2 ** n for n in range(8, 16)]
+
+
+class FakeDevice(object):
+    "the device attributes compute_fft uses"
+    ADC_DYNAMIC_RANGE = 72.5
+    NOISEFLOOR_CALIBRATION = -10
+    CAPTURE_FREQ_RANGES = [(90 * 10 ** 6, 10000 * 10 ** 6, 'iq')]
+
+
+def measure(func, min_time=0.5):
+    """
+    Call *func* repeatedly for at least *min_time* seconds.
+
+    :returns: the mean number of seconds per call
+    """
+    func()
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < min_time:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+    return elapsed / calls
+
+
+def _stream(spp, packets):
+    samples = [(n % 8192, -(n % 8192)) for n in range(spp)]
+    return context_packet(0, 2.45e9) + b''.join(
+        data_packet(n % 16, samples, tsi=n) for n in range(packets))
+
+
+def bench_packet_reader(spp=1024, packets=1000, min_time=0.5):
+    """
+    Packets per second parsed by vrt_packet_reader, parse_packet and
+    the vectorized decoder from an in-memory stream.
+    """
+    stream = _stream(spp, packets)
+    view = memoryview(stream)
+
+    def packet_reader():
+        offset = [0]
+        def raw_read(num):
+            data = view[offset[0]:offset[0] + num]
+            offset[0] += num
+            return data
+        for n in range(packets + 1):
+            gen = vrt_packet_reader(raw_read)
+            val = None
+            try:
+                while True:
+                    val = gen.send(val)
+            except StopIteration:
+                pass
+
+    def whole_packets():
+        offset = 0
+        for n in range(packets + 1):
+            (word,) = struct.unpack_from(">I", stream, offset)
+            size = (word & 0xffff) * 4
+            parse_packet(view[offset:offset + size])
+            offset += size
+
+    results = {
+        'spp': spp,
+        'vrt_packet_reader_packets_per_s':
+            (packets + 1) / measure(packet_reader, min_time),
+        'parse_packet_packets_per_s':
+            (packets + 1) / measure(whole_packets, min_time),
+        }
+    try:
+        from pyrf.vrt_stream import decode_packets
+    except ImportError:
+        return results
+    results['decode_packets_packets_per_s'] = (packets + 1) / measure(
+        lambda: decode_packets(stream), min_time)
+    return results
+
+
+def bench_iq_conversion(spp=1024, min_time=0.5):
+    """
+    Seconds per packet to convert IQData to a list of tuples, a numpy
+    array, complex and float arrays.
+    """
+    pkt = parse_packet(memoryview(data_packet(0, [(1, -1)] * spp)))
+    data = pkt.data
+
+    # clear the cached conversions to measure creating them
+    def tuples():
+        data._data = None
+        list(data)
+
+    results = {'spp': spp, 'tuples_s': measure(tuples, min_time)}
+    try:
+        import numpy
+    except ImportError:
+        return results
+
+    def numpy_array():
+        data._array = None
+        data.numpy_array()
+
+    results.update({
+        'numpy_array_s': measure(numpy_array, min_time),
+        'to_complex_s': measure(data.to_complex, min_time),
+        'to_float_s': measure(data.to_float, min_time),
+        })
+    return results
+
+
+def bench_compute_fft(spp_range=SPP_RANGE, min_time=0.5):
+    """
+    Spectra per second from compute_fft for each number of samples per
+    packet.
+    """
+    from pyrf.numpy_util import compute_fft
+    dut = FakeDevice()
+    context = {'reflevel': -10.0, 'rffreq': 2.45e9}
+    results = {}
+    for spp in spp_range:
+        samples = [(n % 1000, (n * 7) % 1000) for n in range(spp)]
+        pkt = parse_packet(memoryview(data_packet(0, samples)))
+        results[str(spp)] = 1.0 / measure(
+            lambda: compute_fft(dut, pkt, context), min_time)
+    return results
+
+
+def bench_compute_fft_batch(spp=1024, packets=200, min_time=0.5):
+    """
+    Spectra per second from compute_fft one packet at a time and from
+    compute_fft_batch for a block of packets.
+    """
+    from pyrf.numpy_util import compute_fft, compute_fft_batch, stack_packets
+    dut = FakeDevice()
+    context = {'reflevel': -10.0, 'rffreq': 2.45e9}
+    samples = [(n % 1000, (n * 7) % 1000) for n in range(spp)]
+    pkts = [parse_packet(memoryview(data_packet(n % 16, samples)))
+        for n in range(packets)]
+    return {
+        'spp': spp,
+        'packets': packets,
+        'compute_fft_spectra_per_s': packets / measure(
+            lambda: [compute_fft(dut, pkt, context) for pkt in pkts],
+            min_time),
+        'compute_fft_batch_spectra_per_s': packets / measure(
+            lambda: compute_fft_batch(dut, stack_packets(pkts), context),
+            min_time),
+        }
+
+
+ERROR_LEVELS_DB = (40, 60, 80, 100)
+TONE_AMPLITUDES = (8000, 3000, 500, 50)
+
+
+def impaired_tone(spp, amplitude=3000, seed=0):
+    """
+    Samples of a tone at a random frequency with the impairments of a
+    real capture: DC offsets of +20 and -10 counts, 2% gain and 0.03
+    radian phase imbalance and noise of 1.5 counts RMS.
+    """
+    import numpy
+    rng = numpy.random.RandomState(seed)
+    n = numpy.arange(spp)
+    phase = 2 * numpy.pi * rng.uniform(-0.45, 0.45) * n
+    iq = numpy.column_stack([amplitude * numpy.cos(phase) + 20,
+        amplitude * 1.02 * numpy.sin(phase + 0.03) - 10])
+    iq += rng.normal(0, 1.5, iq.shape)
+    iq = numpy.clip(iq.round(), -8192, 8191).astype(int)
+    return [tuple(s) for s in iq]
+
+
+def single_precision_error(spp, amplitudes=TONE_AMPLITUDES, seeds=3):
+    """
+    The largest difference in dB between the float32 and float64
+    spectra from compute_fft of :func:`impaired_tone` signals.
+
+    :returns: a dict of {level: error} for bins within level dB of the
+        peak, for each level in ERROR_LEVELS_DB
+    """
+    import numpy
+    from pyrf.numpy_util import compute_fft
+    dut = FakeDevice()
+    context = {'reflevel': -10.0, 'rffreq': 2.45e9}
+    worst = dict((level, 0.0) for level in ERROR_LEVELS_DB)
+    for amplitude in amplitudes:
+        for seed in range(seeds):
+            pkt = parse_packet(memoryview(data_packet(0,
+                impaired_tone(spp, amplitude, seed))))
+            double = compute_fft(dut, pkt, context)
+            error = numpy.abs(
+                compute_fft(dut, pkt, context, dtype='float32') - double)
+            for level in ERROR_LEVELS_DB:
+                worst[level] = max(worst[level],
+                    float(error[double > double.max() - level].max()))
+    return worst
+
+
+def bench_single_precision(spp_range=SPP_RANGE, min_time=0.5):
+    """
+    Spectra per second from compute_fft with float64 and float32, and
+    the float32 error from :func:`single_precision_error`.  Requires
+    scipy.
+    """
+    from pyrf.numpy_util import compute_fft
+    dut = FakeDevice()
+    context = {'reflevel': -10.0, 'rffreq': 2.45e9}
+    results = {}
+    for spp in spp_range:
+        pkt = parse_packet(memoryview(data_packet(0, impaired_tone(spp))))
+        float64_rate = 1.0 / measure(
+            lambda: compute_fft(dut, pkt, context), min_time)
+        float32_rate = 1.0 / measure(
+            lambda: compute_fft(dut, pkt, context, dtype='float32'), min_time)
+        results[str(spp)] = {
+            'float64_spectra_per_s': float64_rate,
+            'float32_spectra_per_s': float32_rate,
+            'speedup': float32_rate / float64_rate,
+            'max_error_db': single_precision_error(spp),
+            }
+    return results
+
+
+def _latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'captures': len(latencies),
+        'min_s': latencies[0],
+        'median_s': latencies[len(latencies) // 2],
+        'p95_s': latencies[int(len(latencies) * 0.95)],
+        'max_s': latencies[-1],
+        }
+
+
+def bench_blocking_latency(host, spp=1024, captures=200):
+    """
+    Seconds from requesting a capture with read_data_and_context until
+    the data packet is parsed, with PlainSocketConnector.
+    """
+    from pyrf.devices.thinkrf import WSA4000
+    from pyrf.util import read_data_and_context
+    dut = WSA4000()
+    dut.connect(host)
+    dut.request_read_perm()
+    latencies = []
+    for n in range(captures):
+        start = time.time()
+        read_data_and_context(dut, spp)
+        latencies.append(time.time() - start)
+    dut.disconnect()
+    return dict(_latency_summary(latencies), spp=spp)
+
+
+def bench_twisted_latency(host, spp=1024, captures=200):
+    """
+    Like :func:`bench_blocking_latency` with TwistedConnector.  This
+    runs the Twisted reactor, so it may only be called once.
+    """
+    from twisted.internet import reactor, defer
+    from pyrf.devices.thinkrf import WSA4000
+    from pyrf.connectors.twisted_async import TwistedConnector
+    from pyrf.twisted_util import read_data_and_context
+
+    latencies = []
+    errors = []
+
+    @defer.inlineCallbacks
+    def run():
+        dut = WSA4000(TwistedConnector(reactor))
+        yield dut.connect(host)
+        yield dut.request_read_perm()
+        for n in range(captures):
+            start = time.time()
+            yield read_data_and_context(dut, spp)
+            latencies.append(time.time() - start)
+        dut.disconnect()
+
+    d = run()
+    d.addErrback(errors.append)
+    d.addBoth(lambda result: reactor.stop())
+    reactor.run()
+    if errors:
+        errors[0].raiseException()
+    return dict(_latency_summary(latencies), spp=spp)
+
+
+def run(host=None, quick=False):
+    """
+    Run all the benchmarks.
+
+    :param host: the device or simulator for the end-to-end benchmarks,
+        None to start a simulator on the loopback interface
+    :param quick: True to take fewer measurements
+    :returns: a dict of results
+    """
+    min_time = 0.1 if quick else 0.5
+    captures = 20 if quick else 200
+    results = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'packet_reader': bench_packet_reader(min_time=min_time),
+        'iq_conversion': bench_iq_conversion(min_time=min_time),
+        }
+    try:
+        results['compute_fft_spectra_per_s'] = bench_compute_fft(
+            min_time=min_time)
+        results['compute_fft_batch'] = bench_compute_fft_batch(
+            min_time=min_time)
+        try:
+            results['single_precision'] = bench_single_precision(
+                min_time=min_time)
+        except ImportError:
+            pass
+    except ImportError:
+        pass
+
+    sim = None
+    if host is None:
+        from pyrf.simulator import WSA4000Simulator
+        sim = WSA4000Simulator()
+        sim.start()
+        host = '127.0.0.1'
+    try:
+        results['blocking_latency'] = bench_blocking_latency(host,
+            captures=captures)
+        try:
+            results['twisted_latency'] = bench_twisted_latency(host,
+                captures=captures)
+        except ImportError:
+            pass
+    finally:
+        if sim:
+            sim.stop()
+    return results
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(description="Run the pyrf benchmarks.")
+    parser.add_option('-o', '--output', help="save the results as JSON")
+    parser.add_option('--host', help="device or simulator to use for "
+        "end-to-end benchmarks [start a simulator]")
+    parser.add_option('--quick', action='store_true',
+        help="take fewer measurements")
+    options, args = parser.parse_args()
+
+    results = run(options.host, options.quick)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(text)
+        f.close()
+
+if __name__ == '__main__':
+    main()
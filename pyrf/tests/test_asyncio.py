@@ -0,0 +1,85 @@
+import socket
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from pyrf.devices.thinkrf import WSA4000
+from pyrf.connectors.asyncio_async import AsyncioConnector
+from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+
+@unittest.skipIf(asyncio is None, "asyncio not available")
+class TestAsyncioConnector(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        streams = self.loop.run_until_complete(asyncio.gather(
+            asyncio.open_connection(sock=scpi),
+            asyncio.open_connection(sock=vrt)))
+        connector = AsyncioConnector(self.loop)
+        connector._connected(*streams)
+        self.dut = WSA4000(connector=connector)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.scpi_device.close()
+        self.vrt_device.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_loop(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_pipelined_queries(self):
+        self.scpi_device.sendall(b"2450000000\r\n1\n")
+        freq = self.dut.freq()
+        perm = self.dut.request_read_perm()
+        self.assertEqual(self.run_loop(asyncio.gather(freq, perm)),
+            [2450000000, True])
+        self.dut.freq(100000000)
+        self.run_loop(asyncio.sleep(0))
+        self.assertEqual(self.scpi_device.recv(1000),
+            b"FREQ:CENTER?\n:SYSTEM:LOCK:REQUEST? ACQ\n"
+            b":FREQ:CENTER 100000000\n")
+
+    def test_read(self):
+        self.vrt_device.sendall(context_packet(0, 2.4e9)
+            + data_packet(1, [(5, 6)] * 8))
+        ctx = self.run_loop(self.dut.read())
+        data = self.run_loop(self.dut.read())
+        self.assertEqual(ctx.fields, {'rffreq': 2.4e9})
+        self.assertEqual(list(data.data), [(5, 6)] * 8)
+        self.vrt_device.close()
+        self.assertEqual(self.run_loop(self.dut.raw_read(4)), False)
+        self.assertTrue(self.dut.eof())
+
+    def test_timed_out_query(self):
+        connector = self.dut.connector
+        self.assertRaises(asyncio.TimeoutError, self.run_loop,
+            asyncio.wait_for(connector.scpiget(":FREQ:CENTER?"), 0.01))
+        self.scpi_device.sendall(b"2450000000\n1\n")
+        self.assertEqual(self.run_loop(connector.scpiget(":INPUT:ANTENNA?")),
+            "1")
+
+        # a failed read skips a query that was already cancelled
+        late = connector.scpiget(":FREQ:CENTER?")
+        late.cancel()
+        query = connector.scpiget(":INPUT:ANTENNA?")
+        connector._scpi_reader.set_exception(ConnectionResetError())
+        self.assertRaises(ConnectionResetError, self.run_loop,
+            asyncio.wait_for(query, 5))
+
+    def test_query_at_eof(self):
+        connector = self.dut.connector
+        first = connector.scpiget(":INPUT:ANTENNA?")
+        second = connector.scpiget(":INPUT:ANTENNA?")
+        self.scpi_device.sendall(b"1\r\n2")
+        self.scpi_device.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.run_loop(first), "1")
+        self.assertRaises(socket.error, self.run_loop,
+            asyncio.wait_for(second, 5))
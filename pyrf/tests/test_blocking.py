@@ -0,0 +1,270 @@
+import socket
+import unittest
+
+from pyrf.connectors.blocking import SocketReadBuffer, PlainSocketConnector
+from pyrf.devices.thinkrf import WSA4000
+from pyrf.config import SweepEntry
+from pyrf.vrt import vrt_packet_reader
+from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+
+class TestSocketReadBuffer(unittest.TestCase):
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_slices_stay_valid(self):
+        buf = SocketReadBuffer(self.receiver, 16)
+        self.sender.sendall(b''.join(chr(ord('a') + i) * 6 for i in range(6)))
+        reads = [buf.read(6) for i in range(6)]
+        self.assertEqual([r.tobytes() for r in reads],
+            [chr(ord('a') + i) * 6 for i in range(6)])
+
+    def test_buffers_capped(self):
+        buf = SocketReadBuffer(self.receiver, 16)
+        self.sender.sendall(b''.join(chr(ord('a') + i) * 6 for i in range(12)))
+        reads = [buf.read(6) for i in range(12)]
+        self.assertEqual(len(buf._buffers), buf.MAX_BUFFERS)
+        self.assertTrue(buf._copying)
+        self.assertEqual([r.tobytes() for r in reads],
+            [chr(ord('a') + i) * 6 for i in range(12)])
+
+        # slices are returned again once a buffer is released
+        del reads
+        self.sender.sendall(b'x' * 24)
+        reads = [buf.read(6) for i in range(4)]
+        self.assertFalse(buf._copying)
+        self.assertEqual(len(buf._buffers), buf.MAX_BUFFERS)
+
+    def test_eof(self):
+        buf = SocketReadBuffer(self.receiver, 16)
+        self.sender.sendall(b'abc')
+        self.sender.close()
+        self.assertTrue(buf.has_data())
+        self.assertEqual(buf.read(2).tobytes(), b'ab')
+        self.assertEqual(buf.read(2), False)
+        self.assertTrue(buf.eof)
+
+    def test_packets(self):
+        connector = PlainSocketConnector()
+        connector.VRT_BUFFER_SIZE = 256
+        connector._connected(None, self.receiver)
+        self.sender.sendall(context_packet(0, 2.4e9)
+            + data_packet(1, [(1, 2)] * 20) + data_packet(2, [(3, 4)] * 20))
+        ctx, d1, d2 = [connector.sync_async(
+            vrt_packet_reader(connector.raw_read)) for i in range(3)]
+        self.assertEqual(ctx.fields, {'rffreq': 2.4e9})
+        self.assertEqual(list(d1.data), [(1, 2)] * 20)
+        self.assertEqual(d2.data.numpy_array().tolist(), [[3, 4]] * 20)
+
+
+class TestSCPIPipelining(unittest.TestCase):
+    def setUp(self):
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        self.dut = WSA4000()
+        self.dut.connector._connected(scpi, vrt)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.scpi_device.close()
+        self.vrt_device.close()
+
+    def test_queries_sent_together(self):
+        self.scpi_device.sendall(b"2450000000\n1\nHIGH\n")
+        self.assertEqual(self.dut.scpiget_many(
+            [":FREQ:CENTER?", ":INPUT:ANTENNA?"]), ["2450000000", "1"])
+        self.assertEqual(self.scpi_device.recv(1000),
+            b":FREQ:CENTER?\n:INPUT:ANTENNA?\n")
+        self.assertEqual(self.dut.gain(), 'high')
+
+    def test_lock_queries(self):
+        self.scpi_device.sendall(b"1\n0\n")
+        self.assertTrue(self.dut.request_read_perm())
+        self.assertFalse(self.dut.have_read_perm())
+        self.assertEqual(self.scpi_device.recv(1000),
+            b":SYSTEM:LOCK:REQUEST? ACQ\n:SYSTEM:LOCK:HAVE? ACQ\n")
+
+    def test_sets_coalesced(self):
+        self.dut.capture(1024, 1)
+        self.dut.sweep_add(SweepEntry())
+        sent = self.scpi_device.recv(10000)
+        self.assertEqual(sent.count(b"\n"), 3 + 13)
+        self.assertTrue(sent.endswith(b":sweep:entry:save\n"))
+
+
+class SocketPairConnector(PlainSocketConnector):
+    "connects to socket pairs, keeping the device ends"
+    def connect(self, host):
+        self._host = host
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        self._connected(scpi, vrt)
+
+
+class AnsweringConnector(SocketPairConnector):
+    "sends canned SCPI responses from each new device end"
+    answers = b''
+
+    def connect(self, host):
+        SocketPairConnector.connect(self, host)
+        self.scpi_device.sendall(self.answers)
+
+
+class TestReconnect(unittest.TestCase):
+    def test_settings_restored(self):
+        from pyrf.vrt import ConnectionGap
+        connector = SocketPairConnector(reconnect=True)
+        dut = WSA4000(connector)
+        dut.connect('wsa')
+        dut.freq(2400000000)
+        dut.antenna(2)
+        dut.sweep_start()
+        first_scpi, first_vrt = connector.scpi_device, connector.vrt_device
+        first_vrt.sendall(data_packet(1, [(1, 2)] * 4))
+        first_vrt.close()
+
+        self.assertEqual(list(dut.read().data), [(1, 2)] * 4)
+        gap = dut.read()
+        self.assertTrue(isinstance(gap, ConnectionGap))
+        self.assertFalse(gap.is_data_packet())
+        self.assertEqual(gap.attempts, 1)
+        self.assertFalse(connector.scpi_device is first_scpi)
+        self.assertEqual(connector.scpi_device.recv(1000),
+            b":FREQ:CENTER 2400000000\n:INPUT:ANTENNA 2\n:sweep:list:start\n")
+
+        connector.vrt_device.sendall(data_packet(2, [(3, 4)] * 4))
+        self.assertEqual(dut.read().count, 2)
+        first_scpi.close()
+
+
+    def test_unsent_commands_resent(self):
+        connector = SocketPairConnector(reconnect=True)
+        dut = WSA4000(connector)
+        dut.connect('wsa')
+        dut.freq(2400000000)
+        first_scpi = connector.scpi_device
+        first_scpi.close()
+
+        dut.capture(1024, 1)
+        self.assertFalse(connector.scpi_device is first_scpi)
+        sent = connector.scpi_device.recv(1000)
+        self.assertTrue(sent.startswith(b":FREQ:CENTER 2400000000\n"))
+        self.assertTrue(sent.endswith(b"\n:TRACE:BLOCK:DATA?\n"))
+
+
+    def test_restored_before_batch(self):
+        connector = AnsweringConnector(reconnect=True)
+        dut = WSA4000(connector)
+        dut.connect('wsa')
+        dut.antenna(1)
+        connector.scpi_device.close()
+        connector.answers = b"1\n"
+
+        def batch():
+            yield dut.scpiset(":TRACE:SPP 1024")
+            yield dut.scpiget(":INPUT:ANTENNA?")
+        self.assertEqual(connector.sync_async(batch()), "1")
+        self.assertEqual(connector.scpi_device.recv(1000),
+            b":INPUT:ANTENNA 1\n:TRACE:SPP 1024\n:INPUT:ANTENNA?\n")
+
+
+class TestSettingsCache(unittest.TestCase):
+    def setUp(self):
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        self.dut = WSA4000(cache_settings=True)
+        self.dut.connector._connected(scpi, vrt)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.scpi_device.close()
+        self.vrt_device.close()
+
+    def test_configure_sends_changes(self):
+        self.assertEqual(self.dut.configure(freq=2400000000, antenna=1),
+            ['freq', 'antenna'])
+        self.assertEqual(self.dut.configure(freq=2400000000, antenna=2,
+            ifgain=5), ['ifgain', 'antenna'])
+        self.assertEqual(self.scpi_device.recv(1000),
+            b":FREQ:CENTER 2400000000\n:INPUT:ANTENNA 1\n"
+            b":INPUT:GAIN:IF 5\n:INPUT:ANTENNA 2\n")
+        self.assertRaises(TypeError, self.dut.configure, frequency=1)
+
+    def test_queries_cached_until_reset(self):
+        self.dut.antenna(2)
+        self.scpi_device.sendall(b"HIGH\n")
+        self.assertEqual(self.dut.gain(), 'high')
+        self.assertEqual(self.dut.gain(), 'high')
+        self.assertEqual(self.dut.antenna(), 2)
+        self.dut.update_from_context({'rffreq': 2.45e9})
+        self.assertEqual(self.dut.freq(), 2450000000)
+        self.assertEqual(self.scpi_device.recv(1000),
+            b":INPUT:ANTENNA 2\nINPUT:GAIN:RF?\n")
+
+        self.dut.reset()
+        self.scpi_device.sendall(b"1\n")
+        self.assertEqual(self.dut.antenna(), 1)
+
+
+    def test_context_packets_update_cache(self):
+        self.vrt_device.sendall(context_packet(0, 2.45e9))
+        self.assertTrue(self.dut.read().is_context_packet())
+        self.assertEqual(self.dut.freq(), 2450000000)
+
+    def test_trigger_cache_hit_counted_once(self):
+        from pyrf.config import TriggerSettings
+        from pyrf.metrics import Metrics
+        self.dut.metrics = Metrics()
+        settings = TriggerSettings("NONE")
+        self.dut.trigger(settings)
+        self.assertTrue(self.dut.trigger() is settings)
+        self.assertEqual(
+            self.dut.metrics.snapshot()['counters']['settings_cache_hits'], 1)
+
+    def test_reset_forgets_sweep(self):
+        self.dut.sweep_add(SweepEntry())
+        self.dut.sweep_start()
+        self.dut.reset()
+        self.assertEqual(self.dut._sweep_entries, [])
+        self.assertEqual(self.dut._sweep_start, None)
+
+
+class TestBackgroundReader(unittest.TestCase):
+    def setUp(self):
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        self.dut = WSA4000()
+        self.dut.connector._connected(scpi, vrt)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.scpi_device.close()
+
+    def send_packets(self, count):
+        self.vrt_device.sendall(b''.join(data_packet(n % 16, [(n, -n)])
+            for n in range(count)))
+        self.vrt_device.close()
+
+    def test_block(self):
+        reader = self.dut.background_read(max_packets=2)
+        self.send_packets(10)
+        self.assertEqual([pkt.data[0][0] for pkt in reader], list(range(10)))
+        stats = reader.stats()
+        self.assertEqual(stats['packets_read'], 10)
+        self.assertEqual(stats['dropped_packets'], 0)
+        self.assertEqual(stats['high_water'], 2)
+
+    def test_drop_oldest(self):
+        reader = self.dut.connector.background_reader(max_packets=3,
+            policy='drop_oldest', parse=False)
+        self.send_packets(10)
+        reader.start()
+        reader._thread.join()
+        packets = list(reader)
+        self.assertEqual([p[20:22].tobytes() for p in packets],
+            [b'\0\x07', b'\0\x08', b'\0\x09'])
+        self.assertEqual(reader.stats()['dropped_packets'], 7)
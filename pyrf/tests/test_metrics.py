@@ -0,0 +1,99 @@
+import socket
+import unittest
+
+from pyrf.metrics import Metrics, Histogram, PeriodicExporter
+from pyrf.connectors.blocking import PlainSocketConnector
+from pyrf.devices.thinkrf import WSA4000
+from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+
+class TestMetrics(unittest.TestCase):
+    def test_snapshot(self):
+        m = Metrics('wsa')
+        m.count('packets_received')
+        m.count('bytes_received', 100)
+        m.gauge('queue_depth', 5)
+        m.gauge('queue_depth', 2)
+        m.observe('parse_time', 3e-6)
+        snap = m.snapshot()
+        self.assertEqual(snap['name'], 'wsa')
+        self.assertEqual(snap['counters'],
+            {'packets_received': 1, 'bytes_received': 100})
+        self.assertEqual(snap['gauges'], {'queue_depth': 2})
+        self.assertEqual(snap['gauge_maximums'], {'queue_depth': 5})
+        self.assertEqual(snap['histograms']['parse_time']['count'], 1)
+        self.assertTrue(snap['rates']['bytes_received'] > 0)
+
+        m.count('bytes_received', 100)
+        snap['counters']['bytes_received'] = 0
+        self.assertEqual(m.snapshot()['counters']['bytes_received'], 200)
+
+    def test_rates_since_previous(self):
+        m = Metrics('wsa')
+        m.count('packets_received', 5)
+        first = m.snapshot()
+        m.count('bytes_received', 100)
+        for i in range(2):
+            # other snapshots do not change the rates
+            m.snapshot()
+            snap = m.snapshot(first)
+            self.assertEqual(snap['rates']['packets_received'], 0)
+            self.assertAlmostEqual(snap['rates']['bytes_received'],
+                100 / (snap['time'] - first['time']))
+
+        m.reset()
+        self.assertEqual(m.snapshot(first)['rates'], {})
+
+    def test_histogram(self):
+        h = Histogram([1, 2, 4])
+        for value in [0.5, 1.5, 1.5, 3, 10]:
+            h.observe(value)
+        snap = h.snapshot()
+        self.assertEqual(snap['buckets'], [[1, 1], [2, 2], [4, 1], [None, 1]])
+        self.assertEqual((snap['min'], snap['max'], snap['mean']),
+            (0.5, 10, 3.3))
+        self.assertEqual(snap['p50'], 2)
+        self.assertEqual(snap['p99'], 10)
+
+    def test_exporter(self):
+        exported = []
+        m = Metrics('wsa')
+        m.count('scpi_commands')
+        exporter = PeriodicExporter(exported.append, [m])
+        exporter.export()
+        self.assertEqual(exported[0][0]['counters'], {'scpi_commands': 1})
+        exporter.export()
+        self.assertEqual(exported[1][0]['rates'], {'scpi_commands': 0})
+
+
+class TestConnectorMetrics(unittest.TestCase):
+    def setUp(self):
+        self.scpi_device, scpi = socket.socketpair()
+        self.vrt_device, vrt = socket.socketpair()
+        self.metrics = Metrics()
+        self.dut_metrics = Metrics()
+        self.dut = WSA4000(PlainSocketConnector(metrics=self.metrics),
+            metrics=self.dut_metrics)
+        self.dut.connector._connected(scpi, vrt)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.scpi_device.close()
+        self.vrt_device.close()
+
+    def test_recorded(self):
+        self.scpi_device.sendall(b"2450000000\n")
+        self.dut.freq()
+        self.dut.antenna(1)
+        self.vrt_device.sendall(context_packet(0, 2.4e9)
+            + data_packet(1, [(1, 2)] * 4))
+        self.dut.read()
+        self.dut.read()
+
+        snap = self.metrics.snapshot()
+        self.assertEqual(snap['counters'], {'scpi_queries': 1,
+            'scpi_commands': 1, 'packets_received': 2, 'bytes_received': 72})
+        self.assertEqual(snap['histograms']['scpi_query_latency']['count'], 1)
+        self.assertEqual(snap['histograms']['parse_time']['count'], 2)
+        self.assertEqual(self.dut_metrics.snapshot()['counters'], {
+            'packets_read': 2, 'context_packets': 1, 'data_packets': 1})
@@ -0,0 +1,232 @@
+import math
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import scipy
+except ImportError:
+    scipy = None
+
+from pyrf.vrt import parse_packet, I_ONLY, IQ
+from pyrf.tests.test_vrt_stream import data_packet
+
+
+class FakeDevice(object):
+    ADC_DYNAMIC_RANGE = 72.5
+    NOISEFLOOR_CALIBRATION = -10
+    CAPTURE_FREQ_RANGES = [(0, 40 * 10**6, I_ONLY),
+        (90 * 10**6, 10000 * 10**6, IQ)]
+
+
+def reference_fft(i_data, q_data):
+    "the straightforward computation compute_fft must match"
+    i_data = i_data - numpy.mean(i_data)
+    q_data = q_data - numpy.mean(q_data)
+    samples = len(i_data)
+    amplitude = math.sqrt(sum(i_data ** 2) * 2 / samples)
+    ratio = math.sqrt(sum(i_data ** 2) / sum(q_data ** 2))
+    p = (q_data / amplitude) * ratio * (i_data / amplitude)
+    phi_est = -math.asin(2 * sum(p) / samples)
+    q_data = (math.sin(phi_est) * i_data + ratio * q_data) / math.cos(phi_est)
+    iq = (i_data + 1j * q_data) * numpy.hanning(samples)
+    power = 20 * numpy.log10(numpy.abs(numpy.fft.fftshift(numpy.fft.fft(iq))))
+    median = samples // 2
+    power[median] = (power[median - 1] + power[median + 1]) / 2
+    return power
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestComputeFFT(unittest.TestCase):
+    def setUp(self):
+        n = numpy.arange(256)
+        self.i = (3000 * numpy.cos(n * 0.3) + 7 * (n % 5)).astype(int)
+        self.q = (2800 * numpy.sin(n * 0.3 + 0.05) - 3 * (n % 3)).astype(int)
+        self.pkt = parse_packet(memoryview(data_packet(0,
+            list(zip(self.i, self.q)))))
+
+    def test_matches_reference(self):
+        from pyrf.numpy_util import compute_fft
+        context = {'reflevel': -10.0, 'rffreq': 2.4e9}
+        expected = reference_fft(self.i / 2.0**13, self.q / 2.0**13) - 72.5
+        first = compute_fft(FakeDevice(), self.pkt, context)
+        second = compute_fft(FakeDevice(), self.pkt, context)
+        self.assertTrue(numpy.allclose(first, expected))
+        self.assertFalse(first is second)
+        self.assertTrue(numpy.array_equal(first, second))
+
+    def test_i_only(self):
+        from pyrf.numpy_util import compute_fft
+        context = {'reflevel': -10.0, 'rffreq': 20e6}
+        power = compute_fft(FakeDevice(), self.pkt, context)
+        self.assertEqual(len(power), 127)
+        windowed = self.i / 2.0**13 * numpy.hanning(256)
+        expected = 20 * numpy.log10(numpy.abs(numpy.fft.fft(windowed)[1:128]))
+        self.assertTrue(numpy.allclose(power, expected - 72.5))
+
+    def test_windows(self):
+        from pyrf.numpy_util import get_window, spectrum_engine
+        self.assertTrue(get_window('hann', 64) is get_window('hann', 64))
+        self.assertRaises(ValueError, get_window, 'triangle', 64)
+        for name, cg, enbw in [('hann', 0.5, 1.5),
+                ('blackman-harris', 0.359, 2.0), ('flattop', 0.216, 3.77)]:
+            engine = spectrum_engine(4096, name)
+            self.assertTrue(engine is spectrum_engine(4096, name))
+            self.assertAlmostEqual(engine.coherent_gain, cg, 2)
+            self.assertAlmostEqual(engine.enbw, enbw, 2)
+
+    def test_amplitude_correction(self):
+        from pyrf.numpy_util import spectrum_engine
+        n = numpy.arange(1024)
+        # full scale tone centered on bin 64
+        tone = numpy.exp(2j * math.pi * 64 * n / 1024)
+        iq = numpy.column_stack([tone.real, tone.imag])
+        for name in ('hann', 'blackman-harris', 'flattop'):
+            engine = spectrum_engine(1024, name)
+            power = engine.spectrum(iq) + engine.correction('amplitude')
+            self.assertAlmostEqual(power.max(), 20 * math.log10(1024), 1)
+
+    def test_batch(self):
+        from pyrf.numpy_util import (compute_fft, compute_fft_batch,
+            stack_packets)
+        pkts = [self.pkt, parse_packet(memoryview(data_packet(1,
+            list(zip(self.q, self.i)))))]
+        contexts = [{'reflevel': -10.0, 'rffreq': 2.4e9},
+            {'reflevel': 0.0, 'rffreq': 2.5e9}]
+        iq = stack_packets(pkts)
+        self.assertEqual(iq.shape, (2, 256, 2))
+        spectra = compute_fft_batch(FakeDevice(), iq, contexts)
+        self.assertEqual(spectra.shape, (2, 256))
+        for pkt, context, power in zip(pkts, contexts, spectra):
+            self.assertTrue(numpy.allclose(power,
+                compute_fft(FakeDevice(), pkt, context)))
+
+        complex_iq = iq[..., 0] + 1j * iq[..., 1]
+        self.assertTrue(numpy.allclose(spectra, compute_fft_batch(
+            FakeDevice(), complex_iq, contexts)))
+        self.assertRaises(ValueError, compute_fft_batch, FakeDevice(), iq,
+            {'reflevel': 0.0, 'rffreq': 20e6})
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestSpectrumAccumulator(unittest.TestCase):
+    def setUp(self):
+        # linear powers 1, 100 and 10 at each of two points
+        self.spectra = [numpy.array([0.0, 20.0]), numpy.array([20.0, 0.0]),
+            numpy.array([10.0, 10.0])]
+
+    def test_rms(self):
+        from pyrf.numpy_util import SpectrumAccumulator
+        acc = SpectrumAccumulator()
+        self.assertEqual(acc.average(), None)
+        for s in self.spectra:
+            acc.add(s)
+        expected = 10 * math.log10(111 / 3.0)
+        self.assertTrue(numpy.allclose(acc.average(), [expected, expected]))
+        self.assertTrue(numpy.allclose(acc.max_hold(), [20, 20]))
+        self.assertTrue(numpy.allclose(acc.min_hold(), [0, 0]))
+        acc.reset()
+        self.assertEqual(acc.spectra, 0)
+        self.assertEqual(acc.max_hold(), None)
+
+    def test_exponential(self):
+        from pyrf.numpy_util import SpectrumAccumulator
+        acc = SpectrumAccumulator('exponential', count=2)
+        acc.add(numpy.array(self.spectra))
+        # (1 + 100) / 2 then weighted 1/2 with 10
+        expected = 10 * math.log10((50.5 + 10) / 2)
+        self.assertAlmostEqual(acc.average()[0], expected)
+
+    def test_count(self):
+        from pyrf.numpy_util import SpectrumAccumulator
+        acc = SpectrumAccumulator('count', count=2)
+        acc.add(self.spectra[0])
+        self.assertAlmostEqual(acc.average()[1], 20)
+        acc.add(self.spectra[1])
+        acc.add(self.spectra[2])
+        # the first group of two until the second is complete
+        self.assertAlmostEqual(acc.average()[0], 10 * math.log10(50.5))
+        acc.add(self.spectra[2])
+        self.assertAlmostEqual(acc.average()[0], 10)
+        self.assertRaises(ValueError, SpectrumAccumulator, 'median')
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestIQCorrector(unittest.TestCase):
+    def setUp(self):
+        n = numpy.arange(1024)
+        self.i = 0.5 * numpy.cos(n * math.pi / 32) + 0.01
+        self.q = 0.4 * numpy.sin(n * math.pi / 32 + 0.05) - 0.02
+
+    def test_estimate(self):
+        from pyrf.numpy_util import IQCorrector
+        dc_i, dc_q, ratio, phase = IQCorrector.estimate(self.i, self.q)
+        self.assertAlmostEqual(dc_i, 0.01, 3)
+        self.assertAlmostEqual(dc_q, -0.02, 3)
+        self.assertAlmostEqual(ratio, 1.25, 2)
+        self.assertAlmostEqual(phase, -0.05, 2)
+
+    def test_matches_compute_fft(self):
+        from pyrf.numpy_util import IQCorrector, compute_fft
+        iq = numpy.column_stack([self.i, self.q]) * 2**13
+        pkt = parse_packet(memoryview(data_packet(0,
+            [tuple(s) for s in iq.astype(int)])))
+        context = {'reflevel': -10.0, 'rffreq': 2.4e9}
+        corrector = IQCorrector(interval=1, smoothing=1)
+        self.assertTrue(numpy.allclose(
+            compute_fft(FakeDevice(), pkt, context),
+            compute_fft(FakeDevice(), pkt, context, iq_corrector=corrector)))
+        self.assertEqual(len(corrector.estimates((2.4e9, None))), 4)
+
+    def test_interval_and_settings(self):
+        from pyrf.numpy_util import IQCorrector
+        corrector = IQCorrector(interval=2, smoothing=0.5)
+        corrector.correct(self.i.copy(), self.q.copy(), 'a')
+        first = corrector.estimates('a')
+        # not re-estimated until the interval has passed
+        corrector.correct(self.i + 1, self.q.copy(), 'a')
+        self.assertEqual(corrector.estimates('a'), first)
+        corrector.correct(self.i + 1, self.q.copy(), 'a')
+        self.assertAlmostEqual(corrector.estimates('a')[0], first[0] + 0.5)
+        self.assertEqual(corrector.estimates('b'), None)
+
+        i, q = self.i.copy(), self.q.copy()
+        corrector.correct(i, q, 'b')
+        dc_i, dc_q, ratio, phase = IQCorrector.estimate(i, q)
+        self.assertAlmostEqual(dc_i, 0)
+        self.assertAlmostEqual(dc_q, 0)
+        self.assertAlmostEqual(ratio, 1)
+        self.assertAlmostEqual(phase, 0)
+
+
+@unittest.skipIf(numpy is None or scipy is None, "numpy or scipy not available")
+class TestSinglePrecision(unittest.TestCase):
+    def test_error_bounds(self):
+        from pyrf.numpy_util import SINGLE_PRECISION_ERROR_DB
+        from pyrf.tests.benchmarks import single_precision_error
+        for spp in (256, 4096):
+            error = single_precision_error(spp, seeds=2)
+            for level, bound in SINGLE_PRECISION_ERROR_DB.items():
+                self.assertTrue(error[level] <= bound, (spp, level, error))
+
+    def test_dtypes(self):
+        from pyrf.numpy_util import (compute_fft, compute_fft_batch,
+            stack_packets, SINGLE_PRECISION_ERROR_DB)
+        from pyrf.tests.benchmarks import impaired_tone
+        context = {'reflevel': -10.0, 'rffreq': 2.4e9}
+        pkts = [parse_packet(memoryview(data_packet(0,
+            impaired_tone(1024, amplitude, 1)))) for amplitude in (4000, 80)]
+        batch = compute_fft_batch(FakeDevice(), stack_packets(pkts),
+            context, dtype='float32')
+        self.assertEqual(batch.dtype, numpy.float32)
+        for pkt, row in zip(pkts, batch):
+            double = compute_fft(FakeDevice(), pkt, context)
+            single = compute_fft(FakeDevice(), pkt, context, dtype='float32')
+            self.assertEqual(single.dtype, numpy.float32)
+            compared = double > double.max() - 80
+            self.assertTrue(numpy.abs(single - double)[compared].max()
+                <= SINGLE_PRECISION_ERROR_DB[80])
+            self.assertTrue(numpy.abs(row - double)[compared].max()
+                <= SINGLE_PRECISION_ERROR_DB[80])
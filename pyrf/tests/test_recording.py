@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestVRTRecording(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'capture.vrt')
+        self.write(context_packet(0, 2.4e9, tsi=1)
+            + data_packet(0, [(1, 2)] * 4, tsi=1, tsf=500)
+            + data_packet(1, [(3, 4)] * 4, tsi=2, tsf=0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data, mode='wb'):
+        f = open(self.filename, mode)
+        f.write(data)
+        f.close()
+
+    def test_packets(self):
+        from pyrf.recording import VRTRecording
+        rec = VRTRecording(self.filename)
+        self.assertEqual(len(rec), 3)
+        self.assertTrue(rec[0].is_context_packet())
+        self.assertEqual(rec[0].fields['rffreq'], 2.4e9)
+        self.assertEqual(list(rec[2].data), [(3, 4)] * 4)
+        self.assertEqual(rec.payload(1).tolist(), [[1, 2]] * 4)
+        self.assertRaises(ValueError, rec.payload, 0)
+        rec.close()
+
+    def test_index_reused_and_extended(self):
+        from pyrf.recording import VRTRecording
+        VRTRecording(self.filename).close()
+        self.assertTrue(os.path.exists(self.filename + '.index'))
+
+        self.write(data_packet(2, [(5, 6)] * 4, tsi=3), 'ab')
+        rec = VRTRecording(self.filename)
+        self.assertEqual(len(rec), 4)
+        self.assertEqual(list(rec.data_indexes()), [1, 2, 3])
+        rec.close()
+
+    def test_payload_outlives_map(self):
+        from pyrf.recording import VRTRecording
+        rec = VRTRecording(self.filename)
+        payload = rec.payload(2)
+        self.write(data_packet(2, [(5, 6)] * 4096, tsi=3), 'ab')
+        self.assertEqual(rec.refresh(), 1)
+        self.assertEqual(payload.tolist(), [[3, 4]] * 4)
+        self.assertEqual(int(rec.payload(3).sum()), 11 * 4096)
+        rec.close()
+        self.assertEqual(payload.tolist(), [[3, 4]] * 4)
+
+    def test_index_rebuilt_for_replaced_recording(self):
+        from pyrf.recording import VRTRecording
+        VRTRecording(self.filename).close()
+
+        # same size, different packets
+        self.write(context_packet(0, 2.4e9, tsi=7)
+            + data_packet(0, [(1, 2)] * 4, tsi=8)
+            + data_packet(1, [(3, 4)] * 4, tsi=9))
+        rec = VRTRecording(self.filename)
+        self.assertEqual(list(rec.headers['tsi']), [7, 8, 9])
+        rec.close()
+
+        # shorter than the index
+        self.write(data_packet(0, [(1, 2)] * 4, tsi=10))
+        rec = VRTRecording(self.filename)
+        self.assertEqual(list(rec.headers['tsi']), [10])
+        rec.close()
+
+    def test_time_range(self):
+        from pyrf.recording import VRTRecording
+        rec = VRTRecording(self.filename)
+        self.assertEqual(list(rec.time_range((1, 1), (2, 0))), [1])
+        self.assertEqual(list(rec.time_range(start=(1, 500))), [1, 2])
+        self.assertEqual(list(rec.time_range((1, 501), (2, 1))), [2])
+        rec.close()
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestVRTRecorder(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_and_rotate(self):
+        import socket
+        from pyrf.recording import VRTRecorder, VRTRecording
+        packets = [data_packet(n % 16, [(n, -n)] * 256, tsi=n)
+            for n in range(40)]
+        sender, receiver = socket.socketpair()
+        recorder = VRTRecorder(receiver, os.path.join(self.tmpdir, 'rec'),
+            max_file_size=len(packets[0]) * 25)
+        recorder.start()
+        sender.sendall(b''.join(packets))
+        sender.close()
+        recorder.stop()
+        receiver.close()
+
+        stats = recorder.stats()
+        self.assertEqual(stats['packets_written'], 40)
+        self.assertEqual(stats['dropped_packets'], 0)
+        self.assertEqual(stats['bytes_written'], sum(map(len, packets)))
+
+        recorded = []
+        for filename in recorder.filenames:
+            self.assertTrue(os.path.getsize(filename) <= len(packets[0]) * 25)
+            rec = VRTRecording(filename)
+            recorded.extend(int(t) for t in rec.headers['tsi'])
+            self.assertEqual(list(rec[0].data)[0], (recorded[-len(rec)],
+                -recorded[-len(rec)]))
+            rec.close()
+        self.assertEqual(recorded, list(range(40)))
+
+    def test_corrupt_stream(self):
+        import socket
+        from pyrf.recording import VRTRecorder, VRTRecording
+        from pyrf.vrt import InvalidDataReceived
+        packets = [data_packet(n, [(n, -n)] * 4, tsi=n) for n in range(3)]
+        sender, receiver = socket.socketpair()
+        recorder = VRTRecorder(receiver, os.path.join(self.tmpdir, 'rec'))
+        recorder.start()
+        sender.sendall(b''.join(packets) + b'\xff' * 16)
+        sender.close()
+        self.assertRaises(InvalidDataReceived, recorder.stop)
+        receiver.close()
+
+        stats = recorder.stats()
+        self.assertTrue(isinstance(stats['error'], InvalidDataReceived))
+        self.assertEqual(stats['packets_written'], 3)
+        rec = VRTRecording(recorder.filenames[0])
+        self.assertEqual(len(rec), 3)
+        rec.close()
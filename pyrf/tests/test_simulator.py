@@ -0,0 +1,102 @@
+import socket
+import time
+import unittest
+
+from pyrf.simulator import WSA4000Simulator
+from pyrf.devices.thinkrf import WSA4000
+from pyrf.config import SweepEntry
+from pyrf.util import read_data_and_context
+
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        self.sim = WSA4000Simulator(scpi_port=0, vrt_port=0)
+        self.sim.start()
+        self.dut = WSA4000()
+        # connect to the ephemeral ports the simulator is listening on
+        scpi = socket.create_connection(('127.0.0.1', self.sim.scpi_port))
+        vrt = socket.create_connection(('127.0.0.1', self.sim.vrt_port))
+        self.dut.connector._connected(scpi, vrt)
+
+    def tearDown(self):
+        self.dut.disconnect()
+        self.sim.stop()
+
+    def test_settings(self):
+        self.dut.freq(2450000000)
+        self.dut.gain('low')
+        self.assertEqual(self.dut.freq(), 2450000000)
+        self.assertEqual(self.dut.gain(), 'low')
+        self.assertEqual(self.dut.ifgain(), 0)
+        self.assertTrue(self.dut.request_read_perm())
+        self.assertTrue(self.dut.have_read_perm())
+        self.assertTrue(self.dut.locked('vco'))
+
+    def test_capture(self):
+        self.dut.freq(2440000000)
+        data, context = read_data_and_context(self.dut, 256)
+        self.assertEqual(len(data.data), 256)
+        self.assertEqual(context['rffreq'], 2440000000)
+        self.assertEqual(context['reflevel'], -10.0)
+        # and a second capture on the same stream
+        data, context = read_data_and_context(self.dut, 512)
+        self.assertEqual(len(data.data), 512)
+
+    def test_sweep_list(self):
+        entry = SweepEntry(fstart=2400000000, fstop=2500000000, spp=256)
+        self.dut.sweep_add(entry)
+        read = self.dut.sweep_read(1)
+        self.assertEqual((read.fstart, read.fstop, read.spp),
+            (2400000000, 2500000000, 256))
+        self.dut.sweep_start()
+        freqs = []
+        while len(freqs) < 3:
+            pkt = self.dut.read()
+            if pkt.is_context_packet() and 'rffreq' in pkt.fields:
+                freqs.append(pkt.fields['rffreq'])
+        self.dut.sweep_stop()
+        self.assertEqual(freqs, [2400000000, 2500000000, 2400000000])
+
+
+class TestSimulatorWithoutVRT(unittest.TestCase):
+    def setUp(self):
+        self.sim = WSA4000Simulator(scpi_port=0, vrt_port=0)
+        self.sim.start()
+
+    def tearDown(self):
+        self.sim.stop()
+
+    def connect_scpi(self):
+        dut = WSA4000()
+        scpi = socket.create_connection(('127.0.0.1', self.sim.scpi_port))
+        dut.connector._connected(scpi, socket.socket())
+        return dut
+
+    def test_sweep_waits_for_client(self):
+        captures = []
+        def send_capture(*args):
+            # a spinning sweep would fail here rather than run on
+            captures.append(args)
+            self.sim._sweeping = False
+        self.sim._send_capture = send_capture
+        dut = self.connect_scpi()
+        dut.sweep_add(SweepEntry(fstart=2400000000, fstop=2500000000))
+        dut.sweep_start()
+        dut.locked('vco')
+        time.sleep(3 * self.sim.POLL_INTERVAL)
+        self.assertEqual(captures, [])
+        dut.sweep_stop()
+        dut.connector._sock_scpi.close()
+
+    def test_finished_threads_forgotten(self):
+        for n in range(5):
+            dut = self.connect_scpi()
+            self.assertTrue(dut.locked('vco'))
+            dut.connector._sock_scpi.close()
+            # wait for the simulator to see the connection close
+            deadline = time.time() + 5
+            while (sum(t.is_alive() for t in self.sim._threads) > 2
+                    and time.time() < deadline):
+                time.sleep(0.01)
+        self.connect_scpi().locked('vco')
+        self.assertEqual(len(self.sim._threads), 3)
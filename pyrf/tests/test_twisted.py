@@ -1,11 +1,31 @@
 import unittest
 
-from pyrf.connectors.twisted_async import VRTClient
-from twisted.internet import reactor
+from pyrf.connectors.twisted_async import VRTClient, SCPIClient
+from pyrf.connectors.twisted_async import TwistedConnector
+from twisted.internet import reactor, defer
 
 
 class FakeTransport(object):
-    disconnecting = False
+    def __init__(self):
+        self.written = []
+        self.disconnecting = False
+        self.producing = True
+        self.lost = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def loseConnection(self):
+        self.lost = True
+
+    def pauseProducing(self):
+        self.producing = False
+
+    def resumeProducing(self):
+        self.producing = True
 
 class TestVRTClient(unittest.TestCase):
     def test_client(self):
@@ -20,3 +40,241 @@ class TestVRTClient(unittest.TestCase):
         c.dataReceived(''.join("hello%d" % i for i in range(6)))
 
 
+
+
+class TestVRTPackets(unittest.TestCase):
+    def setUp(self):
+        from pyrf.tests.test_vrt_stream import data_packet, context_packet
+        self.stream = (context_packet(0, 2.4e9)
+            + data_packet(0, [(1, -1), (2, -2)], tsi=7)
+            + data_packet(1, [(3, -3)], tsi=8))
+        self.c = VRTClient()
+        self.c.makeConnection(FakeTransport())
+
+    def test_expecting_packet(self):
+        packets = []
+        self.c.expectingPacket().addCallback(packets.append)
+        self.c.expectingPacket().addCallback(packets.append)
+        self.c.dataReceived(self.stream[:40])
+        self.assertEqual(len(packets), 1)
+        self.assertTrue(packets[0].is_context_packet())
+        self.c.dataReceived(self.stream[40:])
+        self.assertEqual(list(packets[1].data), [(1, -1), (2, -2)])
+        self.c.expectingData(4)
+        self.assertEqual(len(self.c._buf), len(self.stream) - 64 - 4)
+
+    def test_consumer_batches(self):
+        batches = []
+        self.c.setPacketConsumer(batches.append)
+        self.c.dataReceived(self.stream[:-3])
+        self.c.dataReceived(self.stream[-3:])
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(batches[1][0].tsi, 8)
+        self.assertEqual(list(batches[1][0].data), [(3, -3)])
+
+
+class TestFlowControl(unittest.TestCase):
+    def setUp(self):
+        from pyrf.tests.test_vrt_stream import data_packet
+        # 28 byte packets
+        self.packets = [data_packet(n, [(n, n)], tsi=n) for n in range(8)]
+        self.transport = FakeTransport()
+        self.c = VRTClient()
+        self.c.makeConnection(self.transport)
+
+    def test_pause_and_resume(self):
+        self.c.setFlowControl(100, 60)
+        self.c.dataReceived(''.join(self.packets[:4]))
+        self.assertTrue(self.c.paused)
+        self.assertFalse(self.transport.producing)
+        self.c.expectingPacket()
+        self.assertFalse(self.transport.producing)
+        self.c.expectingPacket()
+        self.assertTrue(self.transport.producing)
+        self.assertEqual(self.c.flowStats()['pause_count'], 1)
+
+    def test_drop_packets(self):
+        self.c.setFlowControl(100, 40, drop_packets=True)
+        self.c.dataReceived(''.join(self.packets[:5]))
+        self.assertTrue(self.transport.producing)
+        stats = self.c.flowStats()
+        self.assertEqual(stats['dropped_packets'], 4)
+        self.assertEqual(stats['dropped_bytes'], 112)
+        tsi = []
+        self.c.expectingPacket().addCallback(lambda pkt: tsi.append(pkt.tsi))
+        self.assertEqual(tsi, [4])
+
+
+    def test_packet_larger_than_high_water(self):
+        from pyrf.tests.test_vrt_stream import data_packet
+        packet = data_packet(0, [(1, 1)] * 2048)
+        self.c.setFlowControl(4096)
+        got = []
+        self.c.expectingPacket().addCallback(got.append)
+        self.c.dataReceived(packet[:5000])
+        self.assertTrue(self.transport.producing)
+        self.c.dataReceived(packet[5000:])
+        self.assertEqual(len(got), 1)
+
+        # a read made while paused resumes reading
+        self.c.dataReceived(packet[:5000])
+        self.assertFalse(self.transport.producing)
+        self.c.expectingPacket().addCallback(got.append)
+        self.assertTrue(self.transport.producing)
+        self.c.dataReceived(packet[5000:])
+        self.assertEqual(len(got), 2)
+
+    def test_bounded_packet_queue(self):
+        connector = TwistedConnector(None)
+        connector._vrt = self.c
+        queue = connector.packet_queue(max_size=2)
+        self.c.dataReceived(self.packets[0])
+        self.assertTrue(self.transport.producing)
+        self.c.dataReceived(self.packets[1])
+        self.assertFalse(self.transport.producing)
+
+        # flow control does not resume reading for a full queue
+        self.c.setFlowControl(10)
+        self.c.setFlowControl(None)
+        self.assertFalse(self.transport.producing)
+
+        got = []
+        queue.get().addCallback(got.extend)
+        self.assertTrue(self.transport.producing)
+        queue.get().addCallback(got.extend)
+        self.assertEqual([pkt.tsi for pkt in got], [0, 1])
+        self.assertEqual(len(queue), 0)
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.delayed = []
+
+    def seconds(self):
+        return 10.0
+
+    def callLater(self, delay, func, *args):
+        self.delayed.append((func, args))
+
+
+class FakeOpenConnector(TwistedConnector):
+    "opens protocols with fake transports"
+    def _open(self, host):
+        clients = (SCPIClient(), VRTClient())
+        for client in clients:
+            client.makeConnection(FakeTransport())
+        return defer.succeed(clients)
+
+
+class TestReconnect(unittest.TestCase):
+    def test_gap_after_reconnect(self):
+        from twisted.python.failure import Failure
+        from twisted.internet.error import ConnectionLost
+        from pyrf.devices.thinkrf import WSA4000
+        from pyrf.vrt import ConnectionGap
+        connector = FakeOpenConnector(FakeReactor(), reconnect=True)
+        dut = WSA4000(connector)
+        dut.connect('wsa')
+        dut.ifgain(10)
+        old_vrt = connector._vrt
+        packets = []
+        dut.read().addCallback(packets.append)
+
+        old_vrt.connectionLost(Failure(ConnectionLost()))
+        self.assertTrue(isinstance(packets[0], ConnectionGap))
+        self.assertFalse(connector._vrt is old_vrt)
+        self.assertEqual(connector._scpi.transport.written,
+            [":INPUT:GAIN:IF 10\n"])
+
+
+    def test_commands_held_while_reconnecting(self):
+        from twisted.python.failure import Failure
+        from twisted.internet.error import ConnectionLost
+        reactor = FakeReactor()
+        connector = FakeOpenConnector(reactor, reconnect=True)
+        connector.connect('wsa')
+        old_scpi = connector._scpi
+        restoring = defer.Deferred()
+        connector.reconnect_handler = lambda: restoring
+
+        results = []
+        old_scpi.connectionLost(Failure(ConnectionLost()))
+        connector.scpiset(":TRACE:BLOCK:DATA?")
+        connector.scpiget(":FREQ:CENTER?").addCallback(results.append)
+        self.assertEqual(old_scpi.transport.written, [])
+
+        new_scpi = connector._scpi
+        restoring.callback(None)
+        self.assertEqual(new_scpi.transport.written,
+            [":TRACE:BLOCK:DATA?\n", ":FREQ:CENTER?\n"])
+        new_scpi.dataReceived("2450000000\n")
+        self.assertEqual(results, ["2450000000"])
+
+    def test_failed_restore_closes_connections(self):
+        from twisted.python.failure import Failure
+        from twisted.internet.error import ConnectionLost
+        reactor = FakeReactor()
+        connector = FakeOpenConnector(reactor, reconnect=True)
+        connector.connect('wsa')
+        connector.reconnect_handler = lambda: defer.fail(IOError("lost"))
+
+        connector._vrt.connectionLost(Failure(ConnectionLost()))
+        self.assertTrue(connector._scpi.transport.lost)
+        self.assertTrue(connector._vrt.transport.lost)
+        self.assertEqual(len(reactor.delayed), 1)
+
+        errors = []
+        connector.scpiget(":FREQ:CENTER?").addErrback(errors.append)
+        connector.disconnect()
+        func, args = reactor.delayed.pop()
+        func(*args)
+        self.assertEqual(len(errors), 1)
+
+
+class TestSCPIClient(unittest.TestCase):
+    def test_pipelined_queries(self):
+        c = SCPIClient()
+        transport = FakeTransport()
+        c.makeConnection(transport)
+        results = []
+        c.scpiget(":FREQ:CENTER?\n").addCallback(results.append)
+        c.scpiset(":INPUT:ANTENNA 2\n")
+        c.scpiget(":INPUT:GAIN:RF?\n").addCallback(results.append)
+        self.assertEqual(len(transport.written), 3)
+
+        c.dataReceived("2450000000\nHI")
+        self.assertEqual(results, ["2450000000"])
+        c.dataReceived("GH\n")
+        self.assertEqual(results, ["2450000000", "HIGH"])
+
+
+class TestChunkBuffer(unittest.TestCase):
+    def test_consume(self):
+        from pyrf.connectors.twisted_async import ChunkBuffer
+        b = ChunkBuffer()
+        b.append("abcdef")
+        b.append("gh")
+        b.append("ijkl")
+        self.assertEqual(len(b), 12)
+        part = b.consume(2)
+        self.assertTrue(isinstance(part, memoryview))
+        self.assertEqual(part.tobytes(), "ab")
+        self.assertEqual(b.consume(7), "cdefghi")
+        self.assertEqual(b.consume(4), None)
+        self.assertEqual(b.consume(3).tobytes(), "jkl")
+        self.assertEqual(len(b), 0)
+        whole = "mnop"
+        b.append(whole)
+        self.assertTrue(b.consume(4) is whole)
+
+    def test_zero_bytes(self):
+        from pyrf.connectors.twisted_async import ChunkBuffer
+        b = ChunkBuffer()
+        self.assertEqual(b.peek(0), b'')
+        self.assertEqual(b.consume(0), b'')
+        b.append("ab")
+        b.consume(2)
+        self.assertEqual(b.consume(0), b'')
+        b.append("cd")
+        self.assertEqual(b.peek(0), b'')
+        self.assertEqual(b.consume(2), "cd")
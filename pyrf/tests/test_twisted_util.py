@@ -0,0 +1,92 @@
+import unittest
+
+from twisted.internet import defer
+
+from pyrf.twisted_util import WSAGroup
+
+
+class FakeConnector(object):
+    consumer = None
+
+    def set_packet_consumer(self, consumer):
+        self.consumer = consumer
+
+
+class FakeDevice(object):
+    def __init__(self, host):
+        self.connector = FakeConnector()
+        self.pending = []
+
+    def connect(self, host):
+        if host == 'bad':
+            return defer.fail(IOError("connection refused"))
+        return defer.succeed(None)
+
+    def freq(self, value):
+        d = defer.Deferred()
+        self.pending.append((d, value))
+        return d
+
+
+class TestWSAGroup(unittest.TestCase):
+    def setUp(self):
+        self.group = WSAGroup(['a', 'bad', 'b'], reactor=object(),
+            device_factory=FakeDevice)
+        self.connected = []
+        self.group.connect().addCallback(self.connected.append)
+
+    def test_connect(self):
+        self.assertEqual(self.connected, [['a', 'b']])
+        self.assertEqual(list(self.group.failed), ['bad'])
+
+    def test_call_in_parallel(self):
+        results = []
+        self.group.call('freq', 2450e6).addCallback(results.append)
+        a, b = self.group.devices['a'], self.group.devices['b']
+        # both requests sent before either response
+        self.assertEqual(len(a.pending), 1)
+        self.assertEqual(len(b.pending), 1)
+        b.pending[0][0].callback(2)
+        a.pending[0][0].callback(1)
+        self.assertEqual(results, [{'a': 1, 'b': 2}])
+
+    def test_fan_in(self):
+        received = []
+        self.group.set_packet_consumer(lambda host, packets:
+            received.append((host, packets)))
+        self.group.devices['b'].connector.consumer(['p1', 'p2'])
+        self.group.devices['a'].connector.consumer(['p3'])
+        self.assertEqual(received, [('b', ['p1', 'p2']), ('a', ['p3'])])
+
+
+class TestSpectrumConsumer(unittest.TestCase):
+    def test_consumer(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy not available")
+        from pyrf.numpy_util import SpectrumAccumulator
+        from pyrf.twisted_util import spectrum_consumer
+        from pyrf.vrt import parse_packet, IQ
+        from pyrf.tests.test_vrt_stream import data_packet, context_packet
+
+        class Device(object):
+            ADC_DYNAMIC_RANGE = 72.5
+            NOISEFLOOR_CALIBRATION = -10
+            CAPTURE_FREQ_RANGES = [(0, 10 ** 10, IQ)]
+
+        samples = [(n % 7 * 100, n % 5 * 100) for n in range(64)]
+        packets = [parse_packet(memoryview(p)) for p in [
+            data_packet(0, samples), context_packet(0, 2.4e9),
+            data_packet(1, samples),
+            context_packet(1, 2.4e9, reflevel=-10.0),
+            data_packet(2, samples), data_packet(3, samples)]]
+        acc = SpectrumAccumulator()
+        consumer = spectrum_consumer(Device(), acc)
+        # no reference level yet
+        consumer(packets[:3])
+        self.assertEqual(acc.spectra, 0)
+
+        consumer(packets[3:])
+        self.assertEqual(acc.spectra, 2)
+        self.assertEqual(len(acc.average()), 64)
@@ -0,0 +1,94 @@
+import struct
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyrf.vrt import VRTCONTEXT, VRTRECEIVER, CTX_RFFREQ
+
+
+class TestContextPacket(unittest.TestCase):
+    def make(self, stream_id, indicators, body):
+        from pyrf.vrt import ContextPacket
+        data = struct.pack(">IIQI", stream_id, 5, 6, indicators) + body
+        return ContextPacket(VRTCONTEXT, 3, 1 + len(data) // 4, data)
+
+    def test_all_indicators_decoded(self):
+        from pyrf.vrt import CTX_REFERENCEPOINT, CTX_GAIN, CTX_TEMPERATURE
+        pkt = self.make(VRTRECEIVER,
+            CTX_REFERENCEPOINT | CTX_RFFREQ | CTX_GAIN | CTX_TEMPERATURE,
+            struct.pack(">IQhhI", 0xabc, 100 << 20, 256, -128, 40))
+        self.assertEqual(pkt.get('rffreq'), 100.0)
+        self.assertEqual(pkt.fields, {
+            'refpoint': '0x00000abc',
+            'rffreq': 100.0,
+            'gain': (2.0, -1.0),
+            'temperature': 40,
+            })
+        self.assertEqual((pkt.streamId, pkt.tsi, pkt.tsf), (VRTRECEIVER, 5, 6))
+        self.assertTrue(pkt.is_context_packet("Receiver"))
+        self.assertFalse(pkt.is_context_packet("Digitizer"))
+
+    def test_digitizer(self):
+        from pyrf.vrt import VRTDIGITIZER, CTX_BANDWIDTH, CTX_REFERENCELEVEL
+        pkt = self.make(VRTDIGITIZER, CTX_BANDWIDTH | CTX_REFERENCELEVEL,
+            struct.pack(">Qhh", 125 << 20, 0, -10 << 7))
+        self.assertEqual(pkt.fields, {'bandwidth': 125.0, 'reflevel': -10.0})
+        self.assertTrue('reflevel' in pkt)
+        self.assertEqual(pkt.get('rffreq', 'missing'), 'missing')
+
+    def test_unknown_indicator(self):
+        from pyrf.vrt import VRTCUSTOM, CTX_STREAMSTART
+        pkt = self.make(VRTCUSTOM, CTX_STREAMSTART | (1 << 5),
+            struct.pack(">II", 1, 2))
+        self.assertEqual(pkt.fields['unknown'][0], CTX_STREAMSTART | (1 << 5))
+        self.assertFalse(hasattr(pkt, '__dict__'))
+        self.assertTrue('unknown' in pkt)
+        self.assertEqual(pkt.get('unknown')[0], CTX_STREAMSTART | (1 << 5))
+        self.assertFalse('unknown' in self.make(VRTCUSTOM, CTX_STREAMSTART,
+            struct.pack(">I", 1)))
+
+    def test_layout_cache_bounded(self):
+        from pyrf import vrt
+        vrt._context_layouts.clear()
+        for n in range(vrt.MAX_CONTEXT_LAYOUTS + 10):
+            # unknown stream ids are never cached
+            self.make(n, CTX_RFFREQ, struct.pack(">Q", 0)).fields
+            self.make(VRTRECEIVER, CTX_RFFREQ | n << 10,
+                struct.pack(">Q", 0) + b'\0' * 400).fields
+        self.assertEqual(len(vrt._context_layouts), vrt.MAX_CONTEXT_LAYOUTS)
+        self.assertFalse(any(k[0] != VRTRECEIVER
+            for k in vrt._context_layouts))
+
+
+class TestIQData(unittest.TestCase):
+    def setUp(self):
+        from pyrf.vrt import IQData
+        self.data = IQData(struct.pack(">6h", 1, -1, 200, -200, -8192, 8191))
+
+    def test_sequence(self):
+        self.assertEqual(len(self.data), 3)
+        self.assertEqual(self.data[1], (200, -200))
+        self.assertEqual(list(self.data), [(1, -1), (200, -200), (-8192, 8191)])
+        self.assertEqual(list(reversed(self.data))[0], (-8192, 8191))
+
+    @unittest.skipIf(numpy is None, "numpy not available")
+    def test_slices_are_views(self):
+        self.assertEqual(self.data[1:, 0].tolist(), [200, -8192])
+        self.assertTrue(self.data.numpy_array() is self.data.numpy_array())
+
+    @unittest.skipIf(numpy is None, "numpy not available")
+    def test_conversions(self):
+        c = self.data.to_complex(scale=0.5)
+        self.assertEqual(c.dtype, numpy.complex64)
+        self.assertEqual(c.tolist(), [0.5-0.5j, 100-100j, -4096+4095.5j])
+
+        out = numpy.zeros(3, dtype=numpy.complex128)
+        self.assertTrue(self.data.to_complex(out) is out)
+        self.assertEqual(out[2], -8192+8191j)
+
+        f = self.data.to_float(scale=2.0 ** -13)
+        self.assertEqual(f.dtype, numpy.float32)
+        self.assertEqual(f[2].tolist(), [-1.0, 8191.0 / 8192])
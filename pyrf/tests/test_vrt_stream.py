@@ -0,0 +1,152 @@
+import struct
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyrf.vrt import (VRTDATA, VRTCONTEXT, VRTRECEIVER, CTX_RFFREQ,
+    CTX_REFERENCELEVEL)
+from pyrf.vrt import InvalidDataReceived
+
+
+def data_packet(count, samples, tsi=0, tsf=0, stream_id=0x90000003):
+    payload = struct.pack(">%dh" % (len(samples) * 2),
+        *[v for iq in samples for v in iq])
+    size = 5 + len(samples) + 1
+    return (struct.pack(">IIIQ", (VRTDATA << 28) | (count << 16) | size,
+        stream_id, tsi, tsf) + payload + struct.pack(">I", 0))
+
+def context_packet(count, rffreq, tsi=0, tsf=0, reflevel=None):
+    indicators = CTX_RFFREQ
+    fields = struct.pack(">Q", int(rffreq * 2 ** 20))
+    if reflevel is not None:
+        indicators |= CTX_REFERENCELEVEL
+        fields += struct.pack(">hh", 0, int(reflevel * 2 ** 7))
+    body = struct.pack(">IIQI", VRTRECEIVER, tsi, tsf, indicators) + fields
+    size = 1 + len(body) // 4
+    return struct.pack(">I", (VRTCONTEXT << 28) | (count << 16) | size) + body
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestDecodePackets(unittest.TestCase):
+    def setUp(self):
+        self.stream = (context_packet(0, 2.4e9, tsi=7)
+            + data_packet(0, [(1, -1), (2, -2)], tsi=7, tsf=10)
+            + data_packet(1, [(3, -3), (4, -4), (5, -5)], tsi=8, tsf=20))
+
+    def test_headers(self):
+        from pyrf.vrt_stream import decode_packets
+        headers, payloads, end = decode_packets(self.stream)
+        self.assertEqual(end, len(self.stream))
+        self.assertEqual(list(headers['ptype']), [VRTCONTEXT, VRTDATA, VRTDATA])
+        self.assertEqual(list(headers['count']), [0, 0, 1])
+        self.assertEqual(list(headers['tsi']), [7, 7, 8])
+        self.assertEqual(list(headers['tsf']), [0, 10, 20])
+        self.assertEqual(headers['stream_id'][0], VRTRECEIVER)
+        self.assertEqual(payloads[0], None)
+        self.assertEqual(payloads[2].tolist(), [[3, -3], [4, -4], [5, -5]])
+
+    def test_payload_is_a_view(self):
+        from pyrf.vrt_stream import decode_packets
+        buf = bytearray(self.stream)
+        headers, payloads, end = decode_packets(buf)
+        payloads[1][0, 0] = 99
+        offset = headers['payload_offset'][1]
+        self.assertEqual(struct.unpack(">h", bytes(buf[offset:offset + 2])),
+            (99,))
+
+    def test_partial_packet_carried_over(self):
+        from pyrf.vrt_stream import VRTStreamDecoder
+        decoder = VRTStreamDecoder()
+        headers, payloads = decoder.feed(self.stream[:50])
+        self.assertEqual(len(headers), 1)
+        self.assertEqual(decoder.pending, 50 - headers['size'][0] * 4)
+        headers, payloads = decoder.feed(self.stream[50:])
+        self.assertEqual(list(headers['count']), [0, 1])
+        self.assertEqual(payloads[0].tolist(), [[1, -1], [2, -2]])
+        self.assertEqual(decoder.pending, 0)
+
+    def test_invalid_packet_type(self):
+        from pyrf.vrt_stream import decode_packets
+        self.assertRaises(InvalidDataReceived, decode_packets,
+            struct.pack(">I", (7 << 28) | 2) + b'\0' * 4)
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestContinuityTracker(unittest.TestCase):
+    # 4 samples per packet at 1 MHz: 4 us between packets
+    PERIOD = 4 * 10 ** 6
+
+    def stream(self, counts, times):
+        return b''.join(data_packet(c % 16, [(0, 0)] * 4, tsi=t // 10 ** 12,
+            tsf=t % 10 ** 12) for c, t in zip(counts, times))
+
+    def check(self, counts, times):
+        from pyrf.vrt_stream import ContinuityTracker, decode_packets
+        from pyrf.vrt_stream import packet_from_header
+        buf = self.stream(counts, times)
+        headers, payloads, end = decode_packets(buf)
+
+        vectorized = ContinuityTracker(sample_rate=1e6)
+        events = vectorized.update_headers(headers[:3])
+        events += vectorized.update_headers(headers[3:])
+
+        scalar = ContinuityTracker(sample_rate=1e6)
+        scalar_events = []
+        for h in headers:
+            scalar_events += scalar.update(packet_from_header(buf, h))
+
+        self.assertEqual(events, scalar_events)
+        self.assertEqual(vectorized.totals(), scalar.totals())
+        return [e[0] for e in events], vectorized.totals()
+
+    def test_clean_stream(self):
+        p = self.PERIOD
+        kinds, totals = self.check(range(14, 24), [10 ** 12 - p + n * p
+            for n in range(10)])
+        self.assertEqual(kinds, [])
+        self.assertEqual(totals['packets'], 10)
+
+    def test_anomalies(self):
+        p = self.PERIOD
+        counts = [0, 1, 3, 2, 4, 4, 5, 6]
+        times = [0, p, 3 * p, 2 * p, 4 * p, 4 * p, 5 * p, 9 * p]
+        kinds, totals = self.check(counts, times)
+        self.assertEqual(kinds, ['gap', 'reordered', 'duplicate',
+            'discontinuity'])
+        self.assertEqual(totals['lost'], 0)
+        self.assertEqual(totals['reordered'], 1)
+        self.assertEqual(totals['duplicates'], 1)
+        self.assertEqual(totals['discontinuities'], 1)
+
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class TestTimestamps(unittest.TestCase):
+    def test_conversion(self):
+        from pyrf.vrt_stream import timestamps_ns, timestamps_seconds
+        ns = timestamps_ns([1360000000, 5], [999999999999, 2500])
+        self.assertEqual(ns.tolist(), [1360000000999999999, 5000000002])
+        s = timestamps_seconds([5], [2.5 * 10 ** 11])
+        self.assertEqual(s.tolist(), [5.25])
+
+    def test_time_index(self):
+        from pyrf.vrt_stream import TimeIndex
+        headers = numpy.zeros(5, dtype=[('tsi', 'u4'), ('tsf', 'u8')])
+        headers['tsi'] = [1, 2, 4, 3, 5]
+        index = TimeIndex(headers)
+        self.assertEqual(index.find(2 * 10 ** 9, 4 * 10 ** 9).tolist(), [1, 3])
+        self.assertEqual(index.find(start_ns=4 * 10 ** 9).tolist(), [2, 4])
+        self.assertEqual(index.at(3500000000), 3)
+        self.assertEqual(index.at(0), None)
+
+        # picoseconds apart, out of order
+        headers['tsi'] = [1, 1, 1, 2, 2]
+        headers['tsf'] = [2, 1, 999, 0, 0]
+        index = TimeIndex(headers)
+        self.assertEqual(index.find_timestamps((1, 2), (1, 999)).tolist(), [0])
+        self.assertEqual(index.find_timestamps(stop=(1, 2)).tolist(), [1])
+        self.assertEqual(index.find_timestamps((1, 3)).tolist(), [2, 3, 4])
+        self.assertEqual(index.at(10 ** 9), None)
+        self.assertEqual(index.at(10 ** 9 + 1), 2)
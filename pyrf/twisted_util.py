@@ -25,3 +25,165 @@ def read_data_and_context(dut, points=1024):
 
     defer.returnValue((pkt, context_values))
 
+
+@defer.inlineCallbacks
+def accumulate_spectra(dut, accumulator, count, points=1024):
+    """
+    Capture *count* data packets with :func:`read_data_and_context` and
+    add the spectrum of each to *accumulator*.
+
+    :param accumulator: a :class:`pyrf.numpy_util.SpectrumAccumulator`
+    :returns: a Deferred that fires with accumulator
+    """
+    from pyrf.numpy_util import compute_fft
+
+    for n in range(count):
+        pkt, context_values = yield read_data_and_context(dut, points)
+        accumulator.add(compute_fft(dut, pkt, context_values))
+    defer.returnValue(accumulator)
+
+
+def spectrum_consumer(dut, accumulator):
+    """
+    Create a packet consumer that adds the spectrum of every data packet
+    received to *accumulator*, for use with
+    :meth:`TwistedConnector.set_packet_consumer() <pyrf.connectors.twisted_async.TwistedConnector.set_packet_consumer>`:
+
+    .. code-block:: python
+
+       acc = SpectrumAccumulator('exponential', count=8)
+       dut.connector.set_packet_consumer(spectrum_consumer(dut, acc))
+
+    :param dut: the device the packets are from
+    :param accumulator: a :class:`pyrf.numpy_util.SpectrumAccumulator`
+    :returns: a function to call with lists of packets
+
+    Data packets received before context packets have reported both
+    the reference level and the center frequency are skipped.
+    """
+    from pyrf.numpy_util import compute_fft
+    context_values = {}
+
+    def consumer(packets):
+        for pkt in packets:
+            if not pkt.is_data_packet():
+                context_values.update(pkt.fields)
+            elif ('reflevel' in context_values
+                    and 'rffreq' in context_values):
+                accumulator.add(compute_fft(dut, pkt, context_values))
+    return consumer
+
+
+
+class WSAGroup(object):
+    """
+    Control several WSA4000 devices at once.
+
+    Devices are connected concurrently and settings are sent to all of
+    them without waiting for each device in turn, so a group of devices
+    takes about as long to start as a single one.
+
+    :param hosts: a list of hostnames or IPs
+    :param reactor: the Twisted reactor to use, defaults to the global
+        reactor
+    :param device_factory: a function called with each host that
+        returns an unconnected device, defaults to a
+        :class:`WSA4000 <pyrf.devices.thinkrf.WSA4000>` with a
+        :class:`TwistedConnector <pyrf.connectors.twisted_async.TwistedConnector>`
+
+    .. code-block:: python
+
+       group = WSAGroup(['10.0.0.11', '10.0.0.12'])
+       yield group.connect()
+       yield group.call('freq', 2450e6)
+       group.set_packet_consumer(lambda host, packets: ...)
+       yield group.call('capture', 1024, 1)
+    """
+    def __init__(self, hosts, reactor=None, device_factory=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if device_factory is None:
+            from pyrf.devices.thinkrf import WSA4000
+            from pyrf.connectors.twisted_async import TwistedConnector
+            device_factory = lambda host: WSA4000(TwistedConnector(reactor))
+
+        self.hosts = list(hosts)
+        self.devices = dict((host, device_factory(host))
+            for host in self.hosts)
+        self.failed = {}
+
+    def connect(self):
+        """
+        Connect to all the devices at the same time.  Devices that
+        fail to connect are removed from :attr:`hosts` and
+        :attr:`devices` and their failures saved in :attr:`failed`.
+
+        :returns: a Deferred that fires with the list of hosts connected
+        """
+        d = defer.DeferredList([self.devices[host].connect(host)
+            for host in self.hosts], consumeErrors=True)
+
+        @d.addCallback
+        def connected(results):
+            for host, (success, result) in zip(list(self.hosts), results):
+                if not success:
+                    self.failed[host] = result
+                    self.hosts.remove(host)
+                    del self.devices[host]
+            return list(self.hosts)
+        return d
+
+    def disconnect(self):
+        for host in self.hosts:
+            self.devices[host].disconnect()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a device method on every device without waiting for the
+        previous device to respond.
+
+        :param method: the name of the device method, e.g. ``'freq'``
+        :returns: a Deferred that fires with a dict of {host: result},
+            or fails with the first failure
+        """
+        d = defer.gatherResults([defer.maybeDeferred(
+            getattr(self.devices[host], method), *args, **kwargs)
+            for host in self.hosts], consumeErrors=True)
+        d.addCallback(lambda results: dict(zip(self.hosts, results)))
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    def scpiset(self, cmd):
+        """
+        Send a SCPI command to every device.
+        """
+        for host in self.hosts:
+            self.devices[host].scpiset(cmd)
+
+    def set_packet_consumer(self, consumer):
+        """
+        Merge the VRT packets from all devices into one consumer.
+
+        :param consumer: a function called with the host and a list of
+            packets each time packets are received from a device, or
+            None to stop delivering packets
+        """
+        for host in self.hosts:
+            callback = None
+            if consumer:
+                callback = lambda packets, host=host: consumer(host, packets)
+            self.devices[host].connector.set_packet_consumer(callback)
+
+    def packet_queue(self):
+        """
+        Merge the VRT packets from all devices into one queue.
+
+        :returns: a DeferredQueue of (host, packets) tuples, not bounded:
+            use each connector's
+            :meth:`packet_queue() <pyrf.connectors.twisted_async.TwistedConnector.packet_queue>`
+            to pause reading when packets are not removed quickly enough
+        """
+        queue = defer.DeferredQueue()
+        self.set_packet_consumer(lambda host, packets:
+            queue.put((host, packets)))
+        return queue
@@ -23,6 +23,21 @@ def read_data_and_context(dut, points=1024):
 
     return pkt, context_values
 
+def accumulate_spectra(dut, accumulator, count, points=1024):
+    """
+    Capture *count* data packets with :func:`read_data_and_context` and
+    add the spectrum of each to *accumulator*.
+
+    :param accumulator: a :class:`pyrf.numpy_util.SpectrumAccumulator`
+    :returns: accumulator
+    """
+    from pyrf.numpy_util import compute_fft
+
+    for n in range(count):
+        pkt, context_values = read_data_and_context(dut, points)
+        accumulator.add(compute_fft(dut, pkt, context_values))
+    return accumulator
+
 # avoid breaking pyrf 0.2.x examples:
 read_data_and_reflevel = read_data_and_context
 
@@ -1,6 +1,10 @@
 import struct
 import array
 import sys
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
 
 VRTCONTEXT = 4
 VRTCUSTOMCONTEXT = 5
@@ -27,6 +31,15 @@ class InvalidDataReceived(Exception):
     pass
 
 
+def _as_string(data):
+    """
+    Return memoryview packet data as a string, other data unchanged
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
 def vrt_packet_reader(raw_read):
     """
     Read a VRT packet, parse it and return an object with its data.
@@ -57,100 +70,237 @@ def vrt_packet_reader(raw_read):
         raise InvalidDataReceived("unknown packet type: %s" % packet_type)
 
 
-
-class ContextPacket(object):
+def parse_packet(data):
     """
-    A Context Packet received from :meth:`pyrf.devices.thinkrf.WSA4000.read`
-
-    .. attribute:: fields
+    Parse a complete VRT packet already received.
 
-       a dict containing field names and values from the packet
+    :param data: the packet bytes as a string, bytearray or memoryview;
+        packet payloads are slices of *data*, so pass a memoryview to
+        avoid copying them
+    :returns: a :class:`DataPacket` or :class:`ContextPacket`
     """
+    (word,) = struct.unpack_from(">I", data)
+    packet_type = (word >> 28) & 0x0f
+    count = (word >> 16) & 0x0f
+    size = (word >> 0) & 0xffff
 
-    def __init__(self, packet_type, count, size, tmpstr):
-        self.ptype = packet_type
-        self.count = count
-        self.size = size
-        (self.streamId, self.tsi, self.tsf,indicatorsField,) = struct.unpack(">IIQI", tmpstr[0:20])
-        self.fields = {}
-
-        # now read all the indicators
-        if self.streamId == VRTRECEIVER:
-            self._parseReceiverContext(indicatorsField, tmpstr[20:])
-        elif self.streamId == VRTDIGITIZER:
-            self._parseDigitizerContext(indicatorsField, tmpstr[20:])
-        elif self.streamId == VRTCUSTOM:
-            self._parseCustomContext(indicatorsField, tmpstr[20:])
-
-
-    def _parseReceiverContext(self, indicators, data):
-        i = 0
-
-        if indicators & CTX_REFERENCEPOINT:
-            value = struct.unpack(">I", data[i:i+4])
-            value = "0x%08x" % value
-            self.fields['refpoint'] = value
-            i += 4
-
-        elif indicators & CTX_RFFREQ:
-            (value,) = struct.unpack(">Q", data[i:i+8])
-            value /= 2.0 ** 20
-            self.fields['rffreq'] = value
-            i += 8
-
-        elif indicators & CTX_GAIN:
-            (g1,g2) = struct.unpack(">hh", data[i:i+4])
-            g1 /= 2.0 ** 7
-            g2 /= 2.0 ** 7
-            self.fields['gain'] = (g1, g2)
-            i += 4
-
-        elif indicators & CTX_TEMPERATURE:
-            (value,) = struct.unpack(">I", data[i:i+4])
-            value = value
-            self.fields['temperature'] = value
-            i += 4
+    if packet_type in (VRTCONTEXT, VRTCUSTOMCONTEXT):
+        return ContextPacket(packet_type, count, size, data[4:size * 4])
 
-        else:
-            self.fields['unknown'] = (indicators, data)
+    elif packet_type == VRTDATA:
+        stream_id, tsi, tsf = struct.unpack_from(">IIQ", data, 4)
+        return DataPacket(count, size, stream_id, tsi, tsf,
+            data[20:(size - 1) * 4])
 
-    def _parseDigitizerContext(self, indicators, data):
-        i = 0
+    else:
+        raise InvalidDataReceived("unknown packet type: %s" % packet_type)
 
-        if indicators & CTX_BANDWIDTH:
-            (value,) = struct.unpack(">Q", data[i:i+8])
-            value /= 2.0 ** 20
-            self.fields['bandwidth'] = value
-            i += 8
 
-        elif indicators & CTX_RFOFFSET:
-            (value,) = struct.unpack(">q", data[i:i+8])
-            value /= 2.0 ** 20
-            self.fields['rfoffset'] = value
-            i += 8
+_CONTEXT_HEADER = struct.Struct(">IIQI")
+_CONTEXT_HEADER_SIZE = _CONTEXT_HEADER.size
+_INT16 = struct.Struct(">h")
+_INT16_PAIR = struct.Struct(">hh")
+_UINT32 = struct.Struct(">I")
+_INT64 = struct.Struct(">q")
+_UINT64 = struct.Struct(">Q")
+
+def _hex32(data, i):
+    return "0x%08x" % _UINT32.unpack_from(data, i)
+
+def _uint32(data, i):
+    return _UINT32.unpack_from(data, i)[0]
+
+def _uint64(data, i):
+    return _UINT64.unpack_from(data, i)[0]
+
+def _int64(data, i):
+    return _INT64.unpack_from(data, i)[0]
+
+def _ufreq(data, i):
+    return _UINT64.unpack_from(data, i)[0] / 2.0 ** 20
+
+def _freq(data, i):
+    return _INT64.unpack_from(data, i)[0] / 2.0 ** 20
+
+def _reflevel(data, i):
+    return _INT16.unpack_from(data, i + 2)[0] / 2.0 ** 7
+
+def _gain(data, i):
+    g1, g2 = _INT16_PAIR.unpack_from(data, i)
+    return (g1 / 2.0 ** 7, g2 / 2.0 ** 7)
+
+# context fields for each indicator bit, in the order they appear in
+# the packet: {bit: (field name, size in bytes, decoder)}
+# a size of None marks a variable length field that extends to the
+# end of the packet
+RECEIVER_DIGITIZER_CONTEXT_FIELDS = {
+    31: (None, 0, None), # context field change indicator
+    30: ('refpoint', 4, _hex32),
+    29: ('bandwidth', 8, _ufreq),
+    28: ('iffreq', 8, _freq),
+    27: ('rffreq', 8, _ufreq),
+    26: ('rfoffset', 8, _freq),
+    25: ('ifoffset', 8, _freq),
+    24: ('reflevel', 4, _reflevel),
+    23: ('gain', 4, _gain),
+    22: ('overrange', 4, _uint32),
+    21: ('samplerate', 8, _ufreq),
+    20: ('timestampadjust', 8, _int64),
+    19: ('timestampcal', 4, _uint32),
+    18: ('temperature', 4, _uint32),
+    17: ('deviceid', 8, _uint64),
+    16: ('stateindicators', 4, _uint32),
+    15: ('payloadformat', 8, _uint64),
+    14: ('gps', 44, None),
+    13: ('ins', 44, None),
+    12: ('ecefephemeris', 52, None),
+    11: ('relativeephemeris', 52, None),
+    10: ('ephemerisrefid', 4, _uint32),
+    9: ('gpsascii', None, None),
+    8: ('contextassociation', None, None),
+    }
+
+CUSTOM_CONTEXT_FIELDS = {
+    0: ('startid', 4, _hex32),
+    }
+
+_CONTEXT_FIELDS_BY_STREAM = {
+    VRTRECEIVER: RECEIVER_DIGITIZER_CONTEXT_FIELDS,
+    VRTDIGITIZER: RECEIVER_DIGITIZER_CONTEXT_FIELDS,
+    VRTCUSTOM: CUSTOM_CONTEXT_FIELDS,
+    }
+
+# offset tables cached by (stream id, indicators), only layouts that
+# locate every field are cached, up to a limit so that corrupt or
+# unexpected packets can't grow the cache without bound
+_context_layouts = {}
+MAX_CONTEXT_LAYOUTS = 256
+
+def _context_layout(stream_id, indicators):
+    """
+    Return the (layout, complete) for the context fields in a packet with
+    the given stream id and indicator field, computing and caching it
+    on first use.  layout is a dict of {field name: (offset, size, decoder)}
+    and complete is False if an unrecognized indicator bit prevents some
+    fields from being located.
+    """
+    key = (stream_id, indicators)
+    try:
+        return _context_layouts[key]
+    except KeyError:
+        pass
+
+    table = _CONTEXT_FIELDS_BY_STREAM.get(stream_id, {})
+    layout = {}
+    complete = True
+    offset = 0
+    for bit in range(31, -1, -1):
+        if not indicators & (1 << bit):
+            continue
+        if bit not in table:
+            complete = False
+            break
+        name, size, decoder = table[bit]
+        if name is not None:
+            layout[name] = (offset, size, decoder)
+        if size is None:
+            # nothing can be located after a variable length field
+            complete = complete and not indicators & ((1 << bit) - 1)
+            break
+        offset += size
+
+    if complete and layout and len(_context_layouts) < MAX_CONTEXT_LAYOUTS:
+        _context_layouts[key] = (layout, complete)
+    return layout, complete
 
-        elif indicators & CTX_REFERENCELEVEL:
-            (value,) = struct.unpack(">h", data[i+2:i+4])
-            value /= 2.0 ** 7
-            self.fields['reflevel'] = value
-            i += 4
 
-        else:
-            self.fields['unknown'] = (indicators, data)
+class ContextPacket(object):
+    """
+    A Context Packet received from :meth:`pyrf.devices.thinkrf.WSA4000.read`
 
+    Only the raw packet is stored, the header and context fields are
+    decoded when they are first accessed.
 
-    def _parseCustomContext(self, indicators, data):
-        i = 0
+    .. attribute:: fields
 
-        if indicators & CTX_STREAMSTART:
-            (value,) = struct.unpack(">I", data[i:i+4])
-            value = "0x%08x" % value
-            self.fields['startid'] = value
-            i += 4
+       a dict containing field names and values from the packet
+    """
+    __slots__ = ('ptype', 'count', 'size', '_data', '_header', '_fields')
 
-        else:
-            self.fields['unknown'] = (indicators, data)
+    def __init__(self, packet_type, count, size, tmpstr):
+        self.ptype = packet_type
+        self.count = count
+        self.size = size
+        self._data = tmpstr
+        self._header = None
+        self._fields = None
+
+    def _unpack_header(self):
+        if self._header is None:
+            self._header = _CONTEXT_HEADER.unpack_from(self._data)
+        return self._header
+
+    @property
+    def streamId(self):
+        return self._unpack_header()[0]
+
+    @property
+    def tsi(self):
+        return self._unpack_header()[1]
+
+    @property
+    def tsf(self):
+        return self._unpack_header()[2]
+
+    def _layout(self):
+        stream_id, tsi, tsf, indicators = self._unpack_header()
+        return _context_layout(stream_id, indicators)
+
+    def _decode(self, offset, size, decoder):
+        i = _CONTEXT_HEADER_SIZE + offset
+        if decoder is None:
+            if size is None:
+                return _as_string(self._data[i:])
+            return _as_string(self._data[i:i + size])
+        return decoder(self._data, i)
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            layout, complete = self._layout()
+            fields = {}
+            for name, (offset, size, decoder) in layout.items():
+                fields[name] = self._decode(offset, size, decoder)
+            if not complete or not layout:
+                fields['unknown'] = (self._unpack_header()[3],
+                    _as_string(self._data[_CONTEXT_HEADER_SIZE:]))
+            self._fields = fields
+        return self._fields
+
+    def get(self, name, default=None):
+        """
+        Decode a single field from the packet.
 
+        :param name: the field name, e.g. 'rffreq' or 'reflevel'
+        :param default: the value to return if the field is not present
+        :returns: the field value
+        """
+        if self._fields is not None:
+            return self._fields.get(name, default)
+        layout, complete = self._layout()
+        try:
+            offset, size, decoder = layout[name]
+        except KeyError:
+            if name == 'unknown':
+                return self.fields.get(name, default)
+            return default
+        return self._decode(offset, size, decoder)
+
+    def __contains__(self, name):
+        layout, complete = self._layout()
+        if name == 'unknown':
+            return not complete or not layout
+        return name in layout
 
     def is_data_packet(self):
         """
@@ -169,10 +319,10 @@ class ContextPacket(object):
             return True
 
         elif ptype == "Receiver":
-            return self.ptype == VRTRECEIVER
+            return self.streamId == VRTRECEIVER
 
         elif ptype == "Digitizer":
-            return self.ptype == VRTDIGITIZER
+            return self.streamId == VRTDIGITIZER
 
         else:
             return False
@@ -200,21 +350,33 @@ class IQData(object):
 
        for i, q in iq_data:
            print i, q
+
+    Slicing returns a NumPy array view of the values instead of a
+    sequence of tuples, e.g. ``iq_data[100:200, 0]`` is an array of
+    100 I values.  The conversion methods :meth:`to_complex` and
+    :meth:`to_float` work directly from the packet data and accept an
+    *out* array so that no memory needs to be allocated per packet.
     """
     def __init__(self, binary_data):
         self._strdata = binary_data
         self._data = None
+        self._array = None
 
     def _update_data(self):
         self._data = array.array('h')
-        self._data.fromstring(self._strdata)
+        try:
+            self._data.frombytes(_as_string(self._strdata))
+        except AttributeError: # Python 2
+            self._data.fromstring(_as_string(self._strdata))
         if sys.byteorder == 'little':
             self._data.byteswap()
 
     def __len__(self):
-        return len(self._strdata) / 4
+        return len(self._strdata) // 4
 
     def __getitem__(self, n):
+        if isinstance(n, (slice, tuple)):
+            return self.numpy_array()[n]
         if not self._data:
             self._update_data()
         return tuple(self._data[n * 2:n * 2 + 2])
@@ -222,8 +384,7 @@ class IQData(object):
     def __iter__(self):
         if not self._data:
             self._update_data()
-        for i in range(0, len(self._data), 2):
-            yield tuple(self._data[i:i + 2])
+        return izip(self._data[0::2], self._data[1::2])
 
     def __reversed__(self):
         if not self._data:
@@ -244,12 +405,58 @@ class IQData(object):
                   [-132,   -8],
                   [-124,   56],
                   [ -44,   80]], dtype=int16)
+
+        The array is a read-only, big-endian view of the packet data,
+        it is created once and shared by all callers.
+        """
+        if self._array is None:
+            import numpy
+            if isinstance(self._strdata, memoryview):
+                # numpy.frombuffer can't use memoryviews on Python 2
+                a = numpy.asarray(self._strdata).view('>i2')
+            else:
+                a = numpy.frombuffer(self._strdata, dtype='>i2')
+            a.shape = (-1, 2)
+            self._array = a
+        return self._array
+
+    def to_complex(self, out=None, dtype='complex64', scale=1.0):
+        """
+        Return the I, Q values as a complex array of I + jQ.
+
+        :param out: optional complex array of len(self) values to
+            write the result into
+        :param dtype: 'complex64' or 'complex128', ignored if *out* is passed
+        :param scale: value to multiply I and Q by, e.g. ``2.0 ** -13``
+            for values relative to full scale
+        :returns: *out* or a new complex array
+        """
+        import numpy
+        iq = self.numpy_array()
+        if out is None:
+            out = numpy.empty(len(iq), dtype=dtype)
+        numpy.multiply(iq[:, 0], scale, out=out.real, casting='unsafe')
+        numpy.multiply(iq[:, 1], scale, out=out.imag, casting='unsafe')
+        return out
+
+    def to_float(self, out=None, dtype='float32', scale=1.0):
+        """
+        Return the I, Q values as a floating point array with the same
+        (N, 2) shape as :meth:`numpy_array`.
+
+        :param out: optional (len(self), 2) float array to write the
+            result into
+        :param dtype: 'float32' or 'float64', ignored if *out* is passed
+        :param scale: value to multiply I and Q by, e.g. ``2.0 ** -13``
+            for values relative to full scale
+        :returns: *out* or a new float array
         """
         import numpy
-        a = numpy.frombuffer(self._strdata, dtype=numpy.int16)
-        a = a.newbyteorder('>')
-        a.shape = (-1, 2)
-        return a
+        iq = self.numpy_array()
+        if out is None:
+            out = numpy.empty(iq.shape, dtype=dtype)
+        numpy.multiply(iq, scale, out=out, casting='unsafe')
+        return out
 
 
 class DataPacket(object):
@@ -289,3 +496,37 @@ class DataPacket(object):
 
     def __str__(self):
         return ("Data #%02d [%d.%012d, %d samples]" % (self.count, self.tsi, self.tsf, self.size - 6))
+
+
+class ConnectionGap(object):
+    """
+    Returned in place of a packet by connectors that reconnect
+    automatically, after the connection to the device was lost and
+    re-established.  Any data sent by the device while it was
+    disconnected is lost.
+
+    :param downtime: seconds from detecting the lost connection until
+        the device settings were restored
+    :param attempts: the number of connection attempts made
+    """
+    fields = property(lambda self: {})
+
+    def __init__(self, downtime, attempts):
+        self.downtime = downtime
+        self.attempts = attempts
+
+    def is_data_packet(self):
+        """
+        :returns: False
+        """
+        return False
+
+    def is_context_packet(self, ptype=None):
+        """
+        :returns: False
+        """
+        return False
+
+    def __str__(self):
+        return "Connection gap [%.3f s, %d attempts]" % (
+            self.downtime, self.attempts)
@@ -0,0 +1,642 @@
+"""
+Bulk decoding of buffers holding many back-to-back VRT packets.
+
+:func:`pyrf.vrt.vrt_packet_reader` parses one packet at a time, which is
+convenient but costs several reads and Python objects per packet.  The
+functions here frame a whole buffer at once and return the packet headers
+as a NumPy record array along with zero-copy views of the payloads.
+"""
+
+import struct
+
+from pyrf.vrt import (VRTCONTEXT, VRTCUSTOMCONTEXT, VRTDATA,
+    InvalidDataReceived, ContextPacket, DataPacket)
+
+# dtype specification for the headers returned by decode_packets()
+HEADER_FIELDS = [
+    ('ptype', 'u1'),
+    ('count', 'u1'),
+    ('size', 'u2'),
+    ('stream_id', 'u4'),
+    ('tsi', 'u4'),
+    ('tsf', 'u8'),
+    ('offset', 'i8'),
+    ('payload_offset', 'i8'),
+    ('payload_size', 'i8'),
+    ]
+
+DATA_HEADER_WORDS = 5
+TRAILER_WORDS = 1
+MIN_PACKET_WORDS = 1 + DATA_HEADER_WORDS
+MAX_PACKET_BYTES = 0xffff * 4
+
+_header_word = struct.Struct(">I")
+
+
+def frame_packets(buf, start=0, stop=None):
+    """
+    Find the packet boundaries in *buf*.
+
+    :param buf: a string, bytearray or other buffer of VRT packets
+        starting on a packet boundary at *start*
+    :param start: byte offset of the first packet in *buf*
+    :param stop: byte offset of the end of valid data in *buf*, defaults
+        to the length of *buf*
+    :returns: (offsets, end) where offsets is a list of the byte offsets
+        of each complete packet and end is the offset just past the
+        last complete packet
+    :raises InvalidDataReceived: at the first invalid packet header, the
+        exception's ``framed`` attribute holds the (offsets, end) of the
+        complete packets before it
+    """
+    offsets = []
+    pos = start
+    buf_len = len(buf) if stop is None else stop
+    unpack_from = _header_word.unpack_from
+    error = None
+    while pos + 4 <= buf_len:
+        (word,) = unpack_from(buf, pos)
+        packet_type = (word >> 28) & 0x0f
+        if packet_type not in (VRTDATA, VRTCONTEXT, VRTCUSTOMCONTEXT):
+            error = "unknown packet type: %s" % packet_type
+            break
+        size = word & 0xffff
+        if size < MIN_PACKET_WORDS:
+            error = "invalid packet size: %d" % size
+            break
+        packet_end = pos + size * 4
+        if packet_end > buf_len:
+            break
+        offsets.append(pos)
+        pos = packet_end
+    if error is not None:
+        e = InvalidDataReceived(error)
+        e.framed = (offsets, pos)
+        raise e
+    return offsets, pos
+
+
+def decode_headers(buf, start=0):
+    """
+    Decode the headers of all the complete VRT packets in *buf* without
+    creating any views of their payloads.
+
+    :param buf: a string, bytearray, mmap or other buffer of VRT packets
+    :param start: byte offset of the first packet in *buf*, must be a
+        multiple of 4
+    :returns: (headers, end) as described in :func:`decode_packets`
+    """
+    offsets, end = frame_packets(buf, start)
+    return headers_at(buf, offsets), end
+
+
+def headers_at(buf, offsets):
+    """
+    Decode the headers of the packets at known positions in *buf*.
+
+    :param buf: a string, bytearray, mmap or other buffer of VRT packets
+    :param offsets: a sorted list of the byte offsets of complete
+        packets, as returned by :func:`frame_packets`
+    :returns: a NumPy record array of headers as described in
+        :func:`decode_packets`
+    """
+    import numpy # import here so docstrings are visible even without numpy
+
+    headers = numpy.zeros(len(offsets), dtype=HEADER_FIELDS)
+    if not len(offsets):
+        return headers
+
+    # view only the framed region, every packet is a whole number of words
+    start = offsets[0]
+    (last,) = _header_word.unpack_from(buf, offsets[-1])
+    end = offsets[-1] + (last & 0xffff) * 4
+    words = numpy.frombuffer(buf, dtype='>u4',
+        count=(end - start) // 4, offset=start)
+    offsets = numpy.array(offsets, dtype='i8')
+    idx = (offsets - start) // 4
+
+    first = words[idx]
+    ptype = (first >> 28) & 0x0f
+    headers['ptype'] = ptype
+    headers['count'] = (first >> 16) & 0x0f
+    headers['size'] = first & 0xffff
+    headers['offset'] = offsets
+
+    # stream id and timestamps are at the same position in both
+    # data and context packets
+    headers['stream_id'] = words[idx + 1]
+    headers['tsi'] = words[idx + 2]
+    headers['tsf'] = ((words[idx + 3].astype('u8') << 32)
+        | words[idx + 4].astype('u8'))
+
+    is_data = ptype == VRTDATA
+    sizes = headers['size'].astype('i8')
+    headers['payload_offset'] = numpy.where(is_data,
+        offsets + 4 * DATA_HEADER_WORDS, offsets + 4)
+    headers['payload_size'] = numpy.where(is_data,
+        (sizes - DATA_HEADER_WORDS - TRAILER_WORDS) * 4, (sizes - 1) * 4)
+    return headers
+
+
+def payload_view(buf, header):
+    """
+    Return a zero-copy (N, 2) int16 array of the I, Q values of one
+    data packet in *buf*.
+
+    :param buf: the buffer the header was decoded from
+    :param header: one record from the headers returned by
+        :func:`decode_headers`
+    """
+    import numpy
+
+    return numpy.frombuffer(buf, dtype='>i2',
+        count=int(header['payload_size']) // 2,
+        offset=int(header['payload_offset'])).reshape(-1, 2)
+
+
+def packet_from_header(buf, header):
+    """
+    Create a :class:`pyrf.vrt.DataPacket` or :class:`pyrf.vrt.ContextPacket`
+    for one packet in *buf*, the same object
+    :func:`pyrf.vrt.vrt_packet_reader` would return for it.
+
+    :param buf: the buffer the header was decoded from
+    :param header: one record from the headers returned by
+        :func:`decode_headers`
+    """
+    start = int(header['payload_offset'])
+    body = buf[start:start + int(header['payload_size'])]
+    ptype = int(header['ptype'])
+    if ptype == VRTDATA:
+        return DataPacket(int(header['count']), int(header['size']),
+            int(header['stream_id']), int(header['tsi']),
+            int(header['tsf']), body)
+    return ContextPacket(ptype, int(header['count']), int(header['size']),
+        body)
+
+
+def decode_packets(buf, start=0):
+    """
+    Decode all the complete VRT packets in *buf*.
+
+    :param buf: a string, bytearray or other buffer of VRT packets
+    :param start: byte offset of the first packet in *buf*, must be a
+        multiple of 4
+    :returns: (headers, payloads, end)
+
+    *headers* is a NumPy record array with the fields in
+    :data:`HEADER_FIELDS`.  For data packets *payload_offset* and
+    *payload_size* locate the I/Q samples, for context packets they
+    locate the packet body after the header word (the bytes a
+    :class:`pyrf.vrt.ContextPacket` is built from).  *size* is in
+    32-bit words, as in the packet header.
+
+    *payloads* is a list the same length as *headers* containing an
+    (N, 2) int16 array of I, Q values for each data packet, or None
+    for each context packet.  The arrays are views into *buf*, so no
+    sample data is copied.
+
+    *end* is the byte offset just past the last complete packet; any
+    bytes after it belong to a packet that is not yet complete.
+    """
+    import numpy
+
+    headers, end = decode_headers(buf, start)
+    if not len(headers):
+        return headers, [], end
+
+    samples = numpy.frombuffer(buf, dtype='>i2',
+        count=(end - start) // 2, offset=start)
+    payloads = [None] * len(headers)
+    for n in numpy.flatnonzero(headers['ptype'] == VRTDATA):
+        first_sample = (headers['payload_offset'][n] - start) // 2
+        num = headers['payload_size'][n] // 2
+        payloads[n] = samples[first_sample:first_sample + num].reshape(-1, 2)
+
+    return headers, payloads, end
+
+
+class VRTStreamDecoder(object):
+    """
+    Decode a stream of VRT packets delivered in arbitrary sized chunks,
+    e.g. the data from large socket reads.
+
+    .. code-block:: python
+
+       decoder = VRTStreamDecoder()
+       while True:
+           headers, payloads = decoder.feed(sock.recv(1 << 20))
+           for h, iq in zip(headers, payloads):
+               if iq is not None:
+                   print h['count'], iq[:, 0].mean()
+
+    A packet that is incomplete at the end of one chunk is kept and
+    decoded when the rest of it arrives with the next call to
+    :meth:`feed`.
+    """
+    def __init__(self):
+        self._pending = b''
+        self._buffer = b''
+
+    def feed(self, data):
+        """
+        Decode all the packets completed by *data*.
+
+        :param data: the next chunk of the VRT stream as a string or
+            bytearray
+        :returns: (headers, payloads) as described in
+            :func:`decode_packets`, with offsets relative to
+            :attr:`buffer`
+        """
+        if self._pending:
+            data = self._pending + data
+        self._buffer = data
+        headers, payloads, end = decode_packets(data)
+        self._pending = bytes(data[end:])
+        return headers, payloads
+
+    @property
+    def buffer(self):
+        """
+        The buffer decoded by the last call to :meth:`feed`, the offsets in
+        the headers returned are relative to this buffer.
+        """
+        return self._buffer
+
+    @property
+    def pending(self):
+        """
+        The number of bytes of an incomplete packet carried over to the
+        next call to :meth:`feed`.
+        """
+        return len(self._pending)
+
+
+PICOSECONDS = 10 ** 12
+COUNT_MODULUS = 16
+
+class ContinuityTracker(object):
+    """
+    Follow the packet count and timestamps of each VRT stream to detect
+    lost, duplicated, reordered and discontinuous packets.
+
+    :param sample_rate: the sample rate in Hz used to check that data
+        packet timestamps advance by exactly one packet of samples,
+        None to skip this check
+    :param on_event: optional function called with each event
+
+    Packets are compared with the latest (by timestamp) packet already
+    seen on the same stream id.  Each anomaly found is reported as an
+    event tuple of ``(kind, stream_id, count, tsi, tsf, value)``
+    where kind is one of:
+
+    ``'gap'``
+        *value* packets are missing before this one according to the
+        4-bit packet count.  More than 15 missing packets in a row
+        can't be detected from the count alone.
+    ``'duplicate'``
+        this packet has the same count and timestamp as the previous one
+    ``'reordered'``
+        this packet's timestamp is earlier than one already seen,
+        *value* is how much earlier in picoseconds.  A late packet
+        was counted as lost when the gap was seen, so it is removed
+        from the lost count.
+    ``'discontinuity'``
+        the count is consecutive but the timestamp didn't advance by
+        one packet of samples, *value* is the difference from the
+        expected timestamp in picoseconds.  This is expected between
+        separate block captures.
+
+    Running totals for each stream are kept in :attr:`counters`.
+
+    Use :meth:`update` for single packet objects or
+    :meth:`update_headers` for arrays of headers from
+    :func:`decode_headers`, which does no per-packet work in Python
+    except for packets with anomalies.
+    """
+    def __init__(self, sample_rate=None, on_event=None):
+        self.sample_rate = sample_rate
+        self.on_event = on_event
+        self.counters = {}
+        self._last = {}
+
+    def _stream_counters(self, stream_id):
+        try:
+            return self.counters[stream_id]
+        except KeyError:
+            c = self.counters[stream_id] = {
+                'packets': 0,
+                'lost': 0,
+                'duplicates': 0,
+                'reordered': 0,
+                'discontinuities': 0,
+                }
+            return c
+
+    def totals(self):
+        """
+        :returns: a dict of the counters summed over all streams
+        """
+        totals = dict.fromkeys(['packets', 'lost', 'duplicates',
+            'reordered', 'discontinuities'], 0)
+        for c in self.counters.values():
+            for k in totals:
+                totals[k] += c[k]
+        return totals
+
+    def reset(self):
+        """
+        Forget all streams and clear the counters, e.g. after
+        reconnecting to a device.
+        """
+        self.counters = {}
+        self._last = {}
+
+    def _events(self, events):
+        if self.on_event:
+            for e in events:
+                self.on_event(e)
+        return events
+
+    def update(self, pkt):
+        """
+        Check one packet.
+
+        :param pkt: a :class:`pyrf.vrt.DataPacket` or
+            :class:`pyrf.vrt.ContextPacket`
+        :returns: a list of events found
+        """
+        stream_id = pkt.streamId
+        spp = pkt.size - DATA_HEADER_WORDS - TRAILER_WORDS
+        if not pkt.is_data_packet():
+            spp = -1
+        counters = self._stream_counters(stream_id)
+        counters['packets'] += 1
+        current = (pkt.count, pkt.tsi, pkt.tsf, spp)
+        last = self._last.get(stream_id)
+        if last is None:
+            self._last[stream_id] = current
+            return []
+
+        count, tsi, tsf, last_spp = last
+        dt = (pkt.tsi - tsi) * PICOSECONDS + (pkt.tsf - tsf)
+        delta = (pkt.count - count) % COUNT_MODULUS
+        event = None
+        if dt < 0:
+            counters['reordered'] += 1
+            counters['lost'] = max(0, counters['lost'] - 1)
+            event = ('reordered', -dt)
+        elif delta == 0 and dt == 0:
+            counters['duplicates'] += 1
+            event = ('duplicate', 0)
+        else:
+            self._last[stream_id] = current
+            if delta != 1:
+                lost = (delta - 1) % COUNT_MODULUS
+                counters['lost'] += lost
+                event = ('gap', lost)
+            elif self.sample_rate and last_spp >= 0:
+                error = dt - last_spp * float(PICOSECONDS) / self.sample_rate
+                if abs(error) > PICOSECONDS / 2.0 / self.sample_rate:
+                    counters['discontinuities'] += 1
+                    event = ('discontinuity', error)
+
+        if event is None:
+            return []
+        kind, value = event
+        return self._events([(kind, stream_id, pkt.count, pkt.tsi, pkt.tsf,
+            value)])
+
+    def update_headers(self, headers):
+        """
+        Check a batch of packets.
+
+        :param headers: a NumPy record array of packet headers as
+            returned by :func:`decode_headers` or :func:`decode_packets`
+        :returns: a list of events found
+        """
+        import numpy
+
+        events = []
+        stream_ids = headers['stream_id']
+        for stream_id in numpy.unique(stream_ids):
+            events.extend(self._update_stream(int(stream_id),
+                headers[stream_ids == stream_id]))
+        return self._events(events)
+
+    def _update_stream(self, stream_id, headers):
+        import numpy
+
+        counters = self._stream_counters(stream_id)
+        counters['packets'] += len(headers)
+        count = headers['count'].astype('i8')
+        tsi = headers['tsi'].astype('i8')
+        tsf = headers['tsf'].astype('i8')
+        spp = numpy.where(headers['ptype'] == VRTDATA,
+            headers['size'].astype('i8') - DATA_HEADER_WORDS - TRAILER_WORDS,
+            -1)
+
+        last = self._last.get(stream_id)
+        if last is None:
+            # the first packet seen becomes the reference
+            last = (count[0], tsi[0], tsf[0], spp[0])
+            headers = headers[1:]
+            count, tsi, tsf, spp = count[1:], tsi[1:], tsf[1:], spp[1:]
+        if not len(headers):
+            self._last[stream_id] = tuple(int(v) for v in last)
+            return []
+
+        # element 0 is the reference from previous calls
+        count = numpy.concatenate(([last[0]], count))
+        tsi = numpy.concatenate(([last[1]], tsi))
+        tsf = numpy.concatenate(([last[2]], tsf))
+        spp = numpy.concatenate(([last[3]], spp))
+        ps = (tsi - tsi[0]) * PICOSECONDS + (tsf - tsf[0])
+
+        reordered = ps[1:] < numpy.maximum.accumulate(ps)[:-1]
+        kept = numpy.concatenate(([True], ~reordered))
+        # index of the latest packet not reordered, up to each position
+        ref = numpy.maximum.accumulate(
+            numpy.where(kept, numpy.arange(len(kept)), 0))[:-1]
+        delta = (count[1:] - count[ref]) % COUNT_MODULUS
+        dt = ps[1:] - ps[ref]
+        in_order = ~reordered
+
+        duplicate = in_order & (delta == 0) & (dt == 0)
+        gap = in_order & ~duplicate & (delta != 1)
+        lost = (delta - 1) % COUNT_MODULUS
+        error = numpy.zeros(len(dt))
+        discontinuity = numpy.zeros(len(dt), dtype=bool)
+        if self.sample_rate:
+            error = dt - spp[ref] * float(PICOSECONDS) / self.sample_rate
+            discontinuity = (in_order & (delta == 1) & (spp[ref] >= 0)
+                & (numpy.abs(error) > PICOSECONDS / 2.0 / self.sample_rate))
+
+        num_reordered = int(reordered.sum())
+        counters['reordered'] += num_reordered
+        counters['duplicates'] += int(duplicate.sum())
+        counters['discontinuities'] += int(discontinuity.sum())
+        counters['lost'] = max(0, counters['lost'] + int(lost[gap].sum())
+            - num_reordered)
+
+        last_kept = numpy.flatnonzero(kept)[-1]
+        self._last[stream_id] = (int(count[last_kept]), int(tsi[last_kept]),
+            int(tsf[last_kept]), int(spp[last_kept]))
+
+        events = []
+        for i in numpy.flatnonzero(reordered | duplicate | gap | discontinuity):
+            if reordered[i]:
+                kind, value = 'reordered', int(ps[ref[i]] - ps[i + 1])
+            elif duplicate[i]:
+                kind, value = 'duplicate', 0
+            elif gap[i]:
+                kind, value = 'gap', int(lost[i])
+            else:
+                kind, value = 'discontinuity', float(error[i])
+            events.append((kind, stream_id, int(count[i + 1]),
+                int(tsi[i + 1]), int(tsf[i + 1]), value))
+        return events
+
+
+def timestamps_ns(tsi, tsf):
+    """
+    Convert VRT integer and fractional (picosecond) timestamps to
+    nanoseconds.
+
+    :param tsi: array or list of integer seconds timestamps
+    :param tsf: array or list of fractional timestamps in picoseconds
+    :returns: an int64 NumPy array of nanoseconds; dates up to the
+        year 2262 are representable
+    """
+    import numpy
+
+    tsi = numpy.asarray(tsi, dtype='i8')
+    tsf = numpy.asarray(tsf, dtype='i8')
+    return tsi * 10 ** 9 + tsf // 1000
+
+
+def timestamps_seconds(tsi, tsf):
+    """
+    Convert VRT integer and fractional (picosecond) timestamps to
+    seconds.
+
+    :param tsi: array or list of integer seconds timestamps
+    :param tsf: array or list of fractional timestamps in picoseconds
+    :returns: a float64 NumPy array of seconds; for present-day
+        timestamps the resolution is about 0.2 microseconds, use
+        :func:`timestamps_ns` when that is not enough
+    """
+    import numpy
+
+    tsi = numpy.asarray(tsi, dtype='f8')
+    tsf = numpy.asarray(tsf, dtype='f8')
+    return tsi + tsf / PICOSECONDS
+
+
+def timestamp_ns(timestamp):
+    """
+    :param timestamp: a (tsi, tsf) tuple
+    :returns: the timestamp in nanoseconds as an int
+    """
+    tsi, tsf = timestamp
+    return int(tsi) * 10 ** 9 + int(tsf) // 1000
+
+
+class TimeIndex(object):
+    """
+    A sorted index of packet timestamps for finding packets by time
+    with a binary search.
+
+    :param headers: a NumPy record array of packet headers as returned
+        by :func:`decode_headers`, e.g. :attr:`VRTRecording.headers`
+
+    Timestamps are compared at the full picosecond resolution of the
+    VRT fractional timestamp, as (integer seconds, picoseconds) pairs.
+    Packets are normally received in time order, in that case the index
+    holds only the timestamps.  Otherwise the index is sorted and the
+    original packet positions are kept alongside.
+    """
+    def __init__(self, headers):
+        import numpy
+
+        tsi = numpy.asarray(headers['tsi'], dtype='i8')
+        tsf = numpy.asarray(headers['tsf'], dtype='i8')
+        self._order = None
+        if len(tsi) > 1:
+            dsi = numpy.diff(tsi)
+            if ((dsi < 0) | ((dsi == 0) & (numpy.diff(tsf) < 0))).any():
+                self._order = numpy.lexsort((tsf, tsi))
+                tsi = tsi[self._order]
+                tsf = tsf[self._order]
+        self.tsi = tsi
+        self.tsf = tsf
+
+    def __len__(self):
+        return len(self.tsi)
+
+    def _positions(self, first, last):
+        import numpy
+
+        if self._order is None:
+            return numpy.arange(first, last)
+        return numpy.sort(self._order[first:last])
+
+    def _search(self, timestamp, side):
+        tsi, tsf = timestamp
+        lo = int(self.tsi.searchsorted(tsi, 'left'))
+        hi = int(self.tsi.searchsorted(tsi, 'right'))
+        return lo + int(self.tsf[lo:hi].searchsorted(tsf, side))
+
+    def find_timestamps(self, start=None, stop=None):
+        """
+        Find the packets with timestamps in a range.
+
+        :param start: (tsi, tsf) of the first timestamp to include or
+            None for no lower bound
+        :param stop: (tsi, tsf) of the first timestamp to exclude or
+            None for no upper bound
+        :returns: an array of packet positions in increasing order
+        """
+        first = 0
+        last = len(self.tsi)
+        if start is not None:
+            first = self._search(start, 'left')
+        if stop is not None:
+            last = max(first, self._search(stop, 'left'))
+        return self._positions(first, last)
+
+    def find(self, start_ns=None, stop_ns=None):
+        """
+        Find the packets with timestamps in a range.
+
+        :param start_ns: the first time to include in nanoseconds or
+            None for no lower bound
+        :param stop_ns: the first time to exclude in nanoseconds or
+            None for no upper bound
+        :returns: an array of packet positions in increasing order
+        """
+        if start_ns is not None:
+            start_ns = _ns_timestamp(start_ns)
+        if stop_ns is not None:
+            stop_ns = _ns_timestamp(stop_ns)
+        return self.find_timestamps(start_ns, stop_ns)
+
+    def at(self, time_ns):
+        """
+        Find the last packet with a timestamp at or before a time.
+
+        :param time_ns: the time in nanoseconds
+        :returns: the packet position or None if all packets are later
+        """
+        i = self._search(_ns_timestamp(time_ns), 'right')
+        if not i:
+            return None
+        if self._order is None:
+            return i - 1
+        return int(self._order[i - 1])
+
+
+def _ns_timestamp(time_ns):
+    "nanoseconds to a (tsi, tsf) tuple"
+    tsi, ns = divmod(int(time_ns), 10 ** 9)
+    return tsi, ns * 1000
@@ -63,6 +63,9 @@ setup(
             "wsa4000gui-blocking = pyrf.gui.wsa4000blocking:main",
             "wsa4000gui = pyrf.gui.wsa4000gui:main",
             ],
+        'console_scripts': [
+            "wsa4000sim = pyrf.simulator:main",
+            ],
         },
     **extras
     )